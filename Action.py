@@ -28,9 +28,14 @@ inherit.  An Action runs in stages (as opposed to one-shot commands).  Those
 stages may need to be threaded or deferred.
 """
 
+from RepoContext import RepoContext
+
 class Action(object):
-    def __init__(self):
+    def __init__(self, context=None):
         self.message = ''
+        # facts about the working copy, shared with any other commands
+        # run by this process
+        self.context = RepoContext() if context is None else context
 
     def execute(self, options, quiet=False, **kwargs):
         return False
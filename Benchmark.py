@@ -0,0 +1,399 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Times PyHg commands end to end against throwaway Mercurial repositories
+generated for the purpose, so that changes in performance are easy to
+measure and to compare between versions:
+
+    python Benchmark.py [--files N] [--modified M] [--changesets K] ...
+                        [--output FILE] [--baseline FILE] [benchmark ...]
+
+An upstream repository of N tracked files and K changesets (plus a
+'feature' branch) is cloned into a workspace of working copies; M files
+are modified in them, staging areas are created (with snapshots), and
+microbranches of the sizes given are shelved.  Each benchmark then runs
+PyHg.py in a fresh process, as a user would, with any setup and cleanup
+it needs kept out of the timing.
+
+Results are written as JSON.  Given an earlier run as a '--baseline', each
+benchmark's median is compared with it, and any that got slower by more
+than the '--threshold' are flagged (and the exit code is non-zero).
+"""
+
+import sys
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+
+from argparse import ArgumentParser
+
+RESULTS_VERSION = 1
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PYHG = os.path.join(HERE, 'PyHg.py')
+
+# differences smaller than this (in seconds) are never flagged
+NOISE = 0.02
+
+#--------------------------------------------
+
+class Benchmark(object):
+    """ A PyHg command to time, where, and what must happen around it """
+    def __init__(self, name, folder, args, setup=None, cleanup=None, unavailable=None):
+        self.name = name
+        self.folder = folder
+        self.args = args
+        self.setup = setup
+        self.cleanup = cleanup
+        # why the benchmark cannot be run here (if it cannot)
+        self.unavailable = unavailable
+
+class Sandbox(object):
+    """ The generated repositories, and the means to run commands in them """
+    def __init__(self, folder, options):
+        self.folder = folder
+        self.options = options
+
+        self.upstream = os.path.join(folder, 'upstream')
+        self.workspace = os.path.join(folder, 'workspace')
+        self.mb_root = os.path.join(folder, 'microbranches')
+
+        # working copies: one to look at, one to change, and one kept clean
+        self.reader = os.path.join(self.workspace, 'reader')
+        self.writer = os.path.join(self.workspace, 'writer')
+        self.clean = os.path.join(self.workspace, 'clean')
+
+        self.env = dict(os.environ)
+        self.env.update({
+            'HGUSER'                : 'Benchmark <benchmark@localhost>',
+            'HGENCODING'            : 'utf-8',
+            'PYHG_MICROBRANCH_ROOT' : self.mb_root,
+            'PYHG_NO_DAEMON'        : '1',
+        })
+        if os.name == 'posix':
+            # comments are gathered, but never edited
+            self.env['PYHG_COMMENT_EDITOR'] = 'true'
+
+        self.seven_zip = None
+        for name in ('7za', '7z'):
+            for path in os.environ.get('PATH', '').split(os.pathsep):
+                if os.path.exists(os.path.join(path, name)) or os.path.exists(os.path.join(path, name + '.exe')):
+                    self.seven_zip = name
+                    break
+            if self.seven_zip is not None:
+                break
+
+        self.modified = []
+
+    def hg(self, args, cwd):
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(['hg'] + args, cwd=cwd, env=self.env, stdout=devnull, stderr=subprocess.STDOUT)
+
+    def pyhg(self, args, cwd):
+        """ Run a PyHg command; returns (seconds, returncode, error output) """
+        start = time.time()
+        process = subprocess.Popen([sys.executable, PYHG] + args,
+                                   cwd=cwd,
+                                   env=self.env,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        # (ENTER for any prompt)
+        output, error = process.communicate(b'\n' * 8)
+        elapsed = time.time() - start
+        return (elapsed, process.returncode, error.decode('utf-8', 'replace'))
+
+    def file_name(self, index):
+        return os.path.join('src', 'd%03d' % (index // 50), 'file%05d.cpp' % index)
+
+    def write_file(self, root, index, revision=0):
+        path = os.path.join(root, self.file_name(index))
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            for line in range(self.options.lines):
+                f.write('int value_%d_%d = %d;   // revision %d\n' % (index, line, line * index, revision))
+
+    def modify_file(self, root, index, tag):
+        """ Change a file as a user would: a few lines, with an embedded comment """
+        path = os.path.join(root, self.file_name(index))
+        with open(path) as f:
+            lines = f.readlines()
+        middle = len(lines) // 2
+        lines[middle:middle] = ['// @comment: %s changed file %d\n' % (tag, index),
+                                'int changed_%d = 0;\n' % index]
+        with open(path, 'w') as f:
+            f.writelines(lines)
+
+    def modified_files(self, count, offset=0):
+        step = max(1, self.options.files // max(1, count))
+        return [(offset + i * step) % self.options.files for i in range(count)]
+
+    def create(self):
+        options = self.options
+        os.makedirs(self.workspace)
+        os.makedirs(self.mb_root)
+
+        # the upstream history
+        self.hg(['init', self.upstream], self.folder)
+        for index in range(options.files):
+            self.write_file(self.upstream, index)
+        self.hg(['add', '-q'], self.upstream)
+        self.hg(['commit', '-q', '-m', 'Initial revision'], self.upstream)
+
+        per_changeset = max(1, options.files // 20)
+        for revision in range(1, options.changesets):
+            for i in range(per_changeset):
+                self.write_file(self.upstream, (revision * per_changeset + i) % options.files, revision)
+            self.hg(['commit', '-q', '-m', 'Revision %d' % revision], self.upstream)
+
+        self.hg(['branch', '-q', 'feature'], self.upstream)
+        self.write_file(self.upstream, 0, options.changesets)
+        self.hg(['commit', '-q', '-m', 'Feature work'], self.upstream)
+        self.hg(['update', '-q', 'default'], self.upstream)
+
+        for folder in (self.reader, self.writer, self.clean):
+            self.hg(['clone', '-q', '-u', 'default', self.upstream, folder], self.workspace)
+
+        # microbranches, shelved from a clean working copy
+        if self.seven_zip is not None:
+            for size in options.microbranches:
+                for index in self.modified_files(size):
+                    self.modify_file(self.clean, index, 'microbranch')
+                self.check(self.pyhg(['shelve', '-c', 'Benchmark microbranch', 'mb%d' % size], self.clean), 'shelve')
+                self.revert(self.clean)
+
+        # pending changes, some of them staged
+        self.modified = [self.file_name(index) for index in self.modified_files(options.modified)]
+        for folder in (self.reader, self.writer):
+            for index in self.modified_files(options.modified):
+                self.modify_file(folder, index, 'pending')
+
+        snapshots = self.modified[:options.snapshots]
+        references = self.modified[options.snapshots:options.snapshots * 2]
+        if len(snapshots):
+            self.check(self.pyhg(['stage', '-S'] + snapshots, self.reader), 'stage')
+        if len(references):
+            self.check(self.pyhg(['stage', '-s', 'references'] + references, self.reader), 'stage')
+
+    def check(self, result, what):
+        elapsed, returncode, error = result
+        if returncode != 0:
+            raise RuntimeError('"%s" failed while preparing the repositories:\n%s' % (what, error))
+
+    def revert(self, folder):
+        self.hg(['update', '-q', '-C', 'default'], folder)
+        self.hg(['revert', '-q', '-a', '--no-backup'], folder)
+        self.hg(['--config', 'extensions.purge=', 'purge', '-q'], folder)
+
+    def benchmarks(self):
+        options = self.options
+        # shelving archives with 7-Zip
+        no_archiver = None if self.seven_zip is not None else '7-Zip (7za) was not found'
+        staged = self.modified[options.snapshots * 2:options.snapshots * 2 + max(1, options.modified // 2)]
+
+        benchmarks = [
+            Benchmark('status', self.reader, ['status']),
+            Benchmark('staged', self.reader, ['staged']),
+            Benchmark('log', self.reader, ['log']),
+            Benchmark('shelved', self.reader, ['shelved']),
+            Benchmark('stage', self.writer, ['stage', '-s', 'benchmark'] + staged,
+                      cleanup=lambda: self.pyhg(['unstage', '-s', 'benchmark', '-e'], self.writer)),
+            Benchmark('commit', self.writer, ['commit', '-m', 'Benchmark commit'],
+                      cleanup=lambda: self.hg(['debugstrip', '-q', '--keep', '-r', '.'], self.writer)),
+            Benchmark('shelve', self.writer, ['shelve', '-c', 'Benchmark shelf', 'benchmark'],
+                      cleanup=lambda: self.pyhg(['restore', '-o', 'benchmark'], self.writer),
+                      unavailable=no_archiver),
+            Benchmark('restore', self.writer, ['restore', '-o', 'benchmark'],
+                      setup=lambda: self.pyhg(['shelve', '-c', 'Benchmark shelf', 'benchmark'], self.writer),
+                      unavailable=no_archiver),
+        ]
+
+        for size in options.microbranches:
+            benchmarks.append(Benchmark('restore-mb%d' % size, self.clean, ['restore', '-o', 'mb%d' % size],
+                                        cleanup=lambda: self.revert(self.clean),
+                                        unavailable=no_archiver))
+
+        benchmarks += [
+            Benchmark('switch', self.clean, ['switch', 'feature'],
+                      cleanup=lambda: self.pyhg(['switch', 'default'], self.clean)),
+            Benchmark('update-all', self.workspace, ['update', '--process-all']),
+        ]
+
+        return benchmarks
+
+    def run(self, benchmark, repeat):
+        """ Time a benchmark 'repeat' times; returns its results """
+        result = {'command': ' '.join(benchmark.args), 'runs': []}
+        if benchmark.unavailable is not None:
+            result['skipped'] = benchmark.unavailable
+            return result
+
+        for i in range(repeat):
+            if benchmark.setup is not None:
+                benchmark.setup()
+            elapsed, returncode, error = self.pyhg(benchmark.args, benchmark.folder)
+            if benchmark.cleanup is not None:
+                benchmark.cleanup()
+            if returncode != 0:
+                result['failed'] = error.strip().split('\n')[-1] if len(error.strip()) else 'exit code %d' % returncode
+                break
+            result['runs'].append(elapsed)
+
+        runs = sorted(result['runs'])
+        if len(runs):
+            result['best'] = runs[0]
+            result['median'] = runs[len(runs) // 2] if len(runs) % 2 else (runs[len(runs) // 2 - 1] + runs[len(runs) // 2]) / 2.0
+        return result
+
+def hg_version():
+    try:
+        output = subprocess.check_output(['hg', '--version', '-q'])
+        return output.decode('utf-8', 'replace').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, threshold):
+    """ Note how each result compares with the baseline; returns the names of those that regressed """
+    regressions = []
+    for name, result in results['results'].items():
+        before = baseline.get('results', {}).get(name, {}).get('median', None)
+        after = result.get('median', None)
+        if (before is None) or (after is None):
+            continue
+        result['baseline'] = before
+        result['change'] = (after - before) / before if before else 0.0
+        if (after - before > NOISE) and (result['change'] * 100.0 > threshold):
+            result['regression'] = True
+            regressions.append(name)
+    return regressions
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Hg Suite end-to-end benchmarks", prog='Benchmark')
+    parser.add_argument('names', metavar='BENCHMARK', nargs='*', help='The benchmarks to run (default: all).')
+    parser.add_argument("-n", "--files", dest="files", type=int, default=500, help="The number of tracked files.")
+    parser.add_argument("-L", "--lines", dest="lines", type=int, default=200, help="The number of lines in each file.")
+    parser.add_argument("-m", "--modified", dest="modified", type=int, default=50, help="The number of modified files.")
+    parser.add_argument("-k", "--changesets", dest="changesets", type=int, default=50, help="The number of changesets on the default branch.")
+    parser.add_argument("-S", "--snapshots", dest="snapshots", type=int, default=10, help="The number of modified files staged as snapshots (as many more are staged as references).")
+    parser.add_argument("-b", "--microbranches", dest="microbranches", default='1,10,100', help="The sizes (in files) of the microbranches to shelve and restore, separated by commas.")
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=5, help="Run each benchmark this many times.")
+    parser.add_argument("-o", "--output", dest="output", default='benchmark.json', help="Where to write the results.")
+    parser.add_argument("-c", "--baseline", dest="baseline", default=None, help="Earlier results to compare with.")
+    parser.add_argument("-t", "--threshold", dest="threshold", type=float, default=10.0, help="Flag benchmarks whose median grew by more than this (in percent) over the baseline.")
+    parser.add_argument("-K", "--keep", dest="keep", action="store_true", default=False, help="Keep the generated repositories (their location is printed).")
+    options = parser.parse_args()
+
+    options.microbranches = [int(size) for size in options.microbranches.split(',') if len(size.strip())]
+    options.modified = min(options.modified, options.files)
+    options.microbranches = [min(size, options.files) for size in options.microbranches]
+
+    baseline = None
+    if options.baseline is not None:
+        try:
+            with open(options.baseline) as f:
+                baseline = json.load(f)
+        except (IOError, ValueError) as e:
+            print('ERROR: Could not read the baseline "%s": %s' % (options.baseline, str(e)), file=sys.stderr)
+            sys.exit(1)
+
+    parameters = dict([(key, getattr(options, key)) for key in
+                       ('files', 'lines', 'modified', 'changesets', 'snapshots', 'microbranches', 'repeat')])
+    if (baseline is not None) and (baseline.get('parameters', None) != parameters):
+        print('WARNING: The baseline was run with different parameters; comparisons may not mean much.', file=sys.stderr)
+
+    folder = tempfile.mkdtemp(prefix='pyhg-bench-')
+    try:
+        sandbox = Sandbox(folder, options)
+        print('Generating repositories in "%s"...' % folder)
+        start = time.time()
+        sandbox.create()
+        print('Generated in %.1fs.\n' % (time.time() - start))
+
+        benchmarks = sandbox.benchmarks()
+        if len(options.names):
+            unknown = set(options.names) - set([benchmark.name for benchmark in benchmarks])
+            if len(unknown):
+                print('ERROR: Unknown benchmark(s): %s' % ', '.join(sorted(unknown)), file=sys.stderr)
+                sys.exit(1)
+            benchmarks = [benchmark for benchmark in benchmarks if benchmark.name in options.names]
+
+        results = {
+            'version'       : RESULTS_VERSION,
+            'created'       : time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python'        : platform.python_version(),
+            'mercurial'     : hg_version(),
+            'platform'      : platform.platform(),
+            'parameters'    : parameters,
+            'results'       : {},
+        }
+
+        for benchmark in benchmarks:
+            results['results'][benchmark.name] = sandbox.run(benchmark, options.repeat)
+
+        regressions = []
+        if baseline is not None:
+            regressions = compare(results, baseline, options.threshold)
+
+        print('%-16s %10s %10s %10s  %s' % ('benchmark', 'best', 'median', 'baseline', ''))
+        for benchmark in benchmarks:
+            result = results['results'][benchmark.name]
+            if 'skipped' in result:
+                print('%-16s %10s %10s %10s  skipped: %s' % (benchmark.name, '-', '-', '-', result['skipped']))
+                continue
+            if 'median' not in result:
+                print('%-16s %10s %10s %10s  FAILED: %s' % (benchmark.name, '-', '-', '-', result.get('failed', '')))
+                continue
+            flag = ''
+            if 'failed' in result:
+                flag = 'FAILED: %s' % result['failed']
+            elif result.get('regression', False):
+                flag = '<-- %+.0f%% REGRESSION' % (result['change'] * 100.0)
+            elif 'change' in result:
+                flag = '%+.0f%%' % (result['change'] * 100.0)
+            print('%-16s %8.0fms %8.0fms %10s  %s' % (benchmark.name,
+                                                     result['best'] * 1000.0,
+                                                     result['median'] * 1000.0,
+                                                     ('%.0fms' % (result['baseline'] * 1000.0)) if 'baseline' in result else '-',
+                                                     flag))
+
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('\nResults written to "%s".' % options.output)
+
+        if len(regressions):
+            print('%d benchmark(s) regressed by more than %g%%: %s' % (len(regressions), options.threshold, ', '.join(sorted(regressions))), file=sys.stderr)
+            sys.exit(1)
+    finally:
+        if options.keep:
+            print('Repositories kept in "%s".' % folder)
+        else:
+            shutil.rmtree(folder, ignore_errors=True)
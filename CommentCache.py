@@ -0,0 +1,184 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+A CommentCache remembers the embedded comments found in working copy files,
+so that 'status' and 'staged' do not have to read and scan a file again
+until it changes (files that have changed are scanned together, in
+parallel, by scan_files() in PyHg_lib).  Each working copy keeps its cache
+in .hg/comments.cache; entries are keyed by the file's path and checked
+against its size, modification time and inode.  The least recently used
+entries are dropped once the cache holds more than PYHG_COMMENT_CACHE_ENTRIES
+files, or once it would take more than PYHG_COMMENT_CACHE_BYTES on disk.
+"""
+
+import os
+import time
+
+from collections import OrderedDict
+from itertools import islice
+
+try:
+    import cPickle
+except:
+    import pickle as cPickle
+
+from PyHg_lib import scan_files, DISPLAY_PLAIN
+
+CACHE_VERSION = 1
+# the most files, and the most bytes on disk, that the cache may hold
+CACHE_ENTRIES = 4096
+CACHE_BYTES = 4 * 1024 * 1024
+
+# a file changed this recently might change again within the same
+# timestamp tick, so its comments are not trusted to the cache yet
+RACY_SECONDS = 2
+
+#--------------------------------------------
+
+def file_signature(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)
+    return (st.st_size, mtime_ns, st.st_ino)
+
+class CommentCache(object):
+    def __init__(self, hg_root):
+        self.cache_file = os.path.join(hg_root, 'comments.cache')
+        self.entries = None
+        self.dirty = False
+
+        self.limit = CACHE_ENTRIES
+        if 'PYHG_COMMENT_CACHE_ENTRIES' in os.environ:
+            try:
+                self.limit = max(0, int(os.environ['PYHG_COMMENT_CACHE_ENTRIES']))
+            except ValueError:
+                pass
+
+        self.size_limit = CACHE_BYTES
+        if 'PYHG_COMMENT_CACHE_BYTES' in os.environ:
+            try:
+                self.size_limit = max(0, int(os.environ['PYHG_COMMENT_CACHE_BYTES']))
+            except ValueError:
+                pass
+
+    def load(self):
+        self.entries = OrderedDict()
+        try:
+            with open(self.cache_file, 'rb') as f:
+                version, entries = cPickle.load(f)
+            if version == CACHE_VERSION:
+                self.entries = entries
+        except:
+            pass
+
+    def comments(self, filename, display=DISPLAY_PLAIN):
+        """ The embedded comments in 'filename', read from the file only if it has changed """
+        comments, error = self.comments_all([filename], display)[0]
+        if error is not None:
+            raise Exception(error)
+        return comments
+
+    def comments_all(self, filenames, display=DISPLAY_PLAIN):
+        """
+        A (comments, error) pair for each file, in the order given.  Files
+        that have changed are scanned together with scan_files().
+        """
+        if self.entries is None:
+            self.load()
+
+        # the order of use is saved too, so note whether it changes
+        tail = list(islice(reversed(self.entries), len(filenames)))
+
+        results = [None] * len(filenames)
+        misses = []
+        for i, filename in enumerate(filenames):
+            filename = os.path.abspath(filename)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                results[i] = (None, "The provided file ('%s') does not exist." % filename)
+                continue
+
+            signature = file_signature(st)
+            entry = self.entries.pop(filename, None)
+            if (entry is None) or (entry[0] != signature):
+                self.dirty = self.dirty or (entry is not None)
+                entry = (signature, {})
+
+            # (re)inserted last, as the most recently used
+            self.entries[filename] = entry
+            if display in entry[1]:
+                results[i] = (list(entry[1][display]), None)
+            else:
+                misses.append((i, filename, st))
+
+        scanned = scan_files([filename for i, filename, st in misses], display=display)
+        now = time.time()
+        for (i, filename, st), (comments, error) in zip(misses, scanned):
+            results[i] = (comments, error)
+            if (error is None) and ((now - st.st_mtime) >= RACY_SECONDS):
+                self.entries[filename][1][display] = list(comments)
+                self.dirty = True
+
+        if list(islice(reversed(self.entries), len(filenames))) != tail:
+            self.dirty = True
+
+        while len(self.entries) > self.limit:
+            self.entries.popitem(last=False)
+            self.dirty = True
+
+        return results
+
+    def save(self):
+        """ Write the cache back to disk, if anything in it has changed """
+        if not self.dirty:
+            return True
+        data = cPickle.dumps((CACHE_VERSION, self.entries), -1)
+        while (len(data) > self.size_limit) and len(self.entries):
+            # drop the least recently used entries, as many as the excess
+            # suggests (and a few more, since entries differ in size)
+            keep = int(len(self.entries) * 0.9 * self.size_limit / len(data))
+            while len(self.entries) > keep:
+                self.entries.popitem(last=False)
+            data = cPickle.dumps((CACHE_VERSION, self.entries), -1)
+
+        temp_file = '%s.%d' % (self.cache_file, os.getpid())
+        try:
+            with open(temp_file, 'wb') as f:
+                f.write(data)
+            if hasattr(os, 'replace'):
+                os.replace(temp_file, self.cache_file)
+            else:
+                if os.path.exists(self.cache_file):
+                    os.remove(self.cache_file)
+                os.rename(temp_file, self.cache_file)
+        except (IOError, OSError):
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            return False
+        self.dirty = False
+        return True
@@ -29,17 +29,13 @@ import os
 import shutil
 import subprocess
 
-try:
-    import pyperclip
-except:
-    pass
-
-from Info import Status
+from HgClient import hg_output
+from HgQuery import get_changed_lines
+from Push import Push
 from PyHg_lib import wrap_line, \
                      wrap_lines, \
                      find_hg_root, \
-                     is_valid, \
-                     extract_comments, \
+                     scan_files, \
                      DISPLAY_COMMENT, \
                      Colors
 from Stage import StageEntry, StageIO, Staged
@@ -47,13 +43,13 @@ from Stage import StageEntry, StageIO, Staged
 #--------------------------------------------
 
 class Commit(object):
-    def __init__(self, options):
+    def __init__(self, options, context):
         if not options.branch:
             return
 
         working_dir = os.getcwd()
 
-        staged_entries = Staged().get_staged_entries(options)
+        staged_entries = Staged(context).get_staged_entries(options)
         if len(staged_entries) and len(options.args):
             print("ERROR: You have staged entries pending; those must be committed or cleared.", file=sys.stderr)
             sys.exit(1)
@@ -74,17 +70,18 @@ class Commit(object):
         if len(staged_entries):
             # staged entries are all relative to the root of the working copy
             # so we need to put ourselves there...
-            root = find_hg_root()
+            root = find_hg_root(context)
             if root is None:
                 print("ERROR: Could not find the root of the working copy.", file=sys.stderr)
                 sys.exit(1)
 
             # need root before we alter it
             stage_name = list(staged_entries.keys())[0]
-            stage_path = StageIO().get_staging_root(root, options)
+            stage_io = StageIO(context)
+            stage_path = stage_io.get_staging_root(root, options)
             stage_db_path = os.path.join(stage_path, stage_name)
             stage_db_file = os.path.join(stage_db_path, 'stage.db')
-            stage_db = StageIO().load_stage_db(stage_db_file)
+            stage_db = stage_io.load_stage_db(stage_db_file)
 
             lines = stage_db.keys()
 
@@ -92,9 +89,10 @@ class Commit(object):
             os.chdir("..")
             root = os.getcwd()
         else:
+            # entries are relative to the folder given, which is where
+            # each file is looked for below ('root')
             command = ['hg', 'status', '-q', '.']
-            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-            lines = output.split('\n')
+            lines = ['%s %s' % (entry.state, entry.path) for entry in context.status(command, cwd=root)]
 
         if len(options.args):
             newlines = []
@@ -114,6 +112,8 @@ class Commit(object):
             lines = newlines
 
         all_comments = {}
+        extract_files = []
+        modified_paths = []
 
         batch_text = ''
         if os.name == 'nt':
@@ -195,18 +195,14 @@ class Commit(object):
 
                     snapshot_backups = True
 
-            comments = None
-
             if ((status == 'M') or (status == 'A')):
                 if len(stage_db) or len(options.args):
                     files_to_commit.append(filename)
-                if (options.log_file is None) and (options.commit_message is None) and is_valid(filename):
-                    try:
-                        comments = extract_comments(full_path, display=DISPLAY_COMMENT)
-                    except Exception as e:
-                        os.chdir(working_dir)
-                        print(str(e), file=sys.stderr)
-                        comments = None
+                if (options.log_file is None) and (options.commit_message is None):
+                    # comments are extracted from all the (text) files together, below
+                    extract_files.append((filename, full_path))
+                    if status == 'M':
+                        modified_paths.append(full_path)
 
             stage_prefix = ''
             if len(stage_db):
@@ -219,11 +215,6 @@ class Commit(object):
             else:
                 print('%s%s' % (stage_prefix, line))
 
-            if comments:
-                all_comments[filename] = comments
-                #all_comments.append('[ %s ]' % file)
-                #all_comments += comments
-
         if options.ansi_color:
             if options.ansi_color_requires_batch:
                 if os.name == 'nt':
@@ -231,6 +222,27 @@ class Commit(object):
                 open(options.batch_file_name, 'w').write(batch_text)
                 os.system(options.batch_file_name)
 
+        # with --changed-lines, only comments on the lines being committed
+        # are taken (and removed) from modified files
+        ranges = None
+        if options.changed_lines:
+            changed = get_changed_lines(modified_paths, options.working_dir)
+            if changed is not None:
+                ranges = dict([(path, changed.get(os.path.normpath(path), [])) for path in modified_paths])
+
+        extracted = scan_files([full_path for filename, full_path in extract_files],
+                               display=DISPLAY_COMMENT,
+                               delete_comments=True,
+                               ranges=ranges)
+        for (filename, full_path), (comments, error) in zip(extract_files, extracted):
+            if error is not None:
+                os.chdir(working_dir)
+                print(error, file=sys.stderr)
+            elif comments:
+                all_comments[filename] = comments
+                #all_comments.append('[ %s ]' % file)
+                #all_comments += comments
+
         comment_count = len(all_comments.keys())
 
         if comment_count > 0:
@@ -292,10 +304,16 @@ class Commit(object):
         else:
             command = ['hg', 'commit'] + files_to_commit
 
+        # without a log file, Mercurial will want to launch its own editor
+        interactive = len(all_comments) == 0
+
         if len(stage_db):
-            output = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=root).communicate()[0].decode("utf-8")
+            output = hg_output(command, cwd=root, interactive=interactive)
         else:
-            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+            output = hg_output(command, interactive=interactive)
+
+        # the working copy has changed underneath the context
+        context.invalidate()
 
         first_line = True
         lines = output.split('\n')
@@ -310,13 +328,14 @@ class Commit(object):
             options.args = []
             if options.push_external:
                 options.args = ["extern"]
-            Push(options)
+            Push(options, context)
 
         # put the comment text on the system clipboard (if available)
 
         if len(all_comments):
             comment_text = open(options.batch_file_name).readlines()
             try:
+                import pyperclip
                 pyperclip.copy(comment_text)
             except:
                 pass
@@ -339,7 +358,7 @@ class Commit(object):
                             if entry.state == 'A':
                                 # execute an add on the file
                                 command = ['hg', 'add', key]
-                                output = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=root).communicate()[0].decode("utf-8")
+                                output = hg_output(command, cwd=root)
                                 if len(output.strip()) != 0:
                                     print('ERROR: Failed to restore snapshot backup for entry "%s" in the "%s" staging area.' % (key, list(staged_entries.keys())[0]), file=sys.stderr)
                                     sys.exit(1)
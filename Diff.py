@@ -27,21 +27,22 @@ from __future__ import print_function
 import sys
 import os
 import re
-import subprocess
+
+from HgClient import hg_run, hg_output, hg_call
 
 #from Info import Status
 
 #--------------------------------------------
 
 class Diff(object):
-    def __init__(self, options, command=['hg', 'wdiff'], database=False, target_branch=None, ignore_branch=False):
+    def __init__(self, options, context, command=['hg', 'wdiff'], database=False, target_branch=None, ignore_branch=False):
         if not options.branch:
             return
 
         self.options = options
 
         command_ = ['hg', 'status', '--subrepos', '-q', '.']
-        output = subprocess.Popen(command_, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+        output = hg_output(command_)
         lines = output.split('\n')
         if len(lines) == 0:
             print('No modified files detected for Diff operation!')
@@ -69,9 +70,8 @@ class Diff(object):
 
         for file in files_to_diff:
             command_ = command + [file]
-            try:
-                output = subprocess.check_output(command_, stderr=subprocess.STDOUT)
-            except subprocess.CalledProcessError as e:
-                if (e.returncode != 0) and len(e.output):
-                    # fall back to the command line HG diff
-                    subprocess.call(['hg', 'diff', file])
+            # the diff tool may need the terminal, so bypass the command server
+            returncode, output, error = hg_run(command_, interactive=True)
+            if (returncode != 0) and len(output + error):
+                # fall back to the command line HG diff
+                hg_call(['hg', 'diff', file])
@@ -0,0 +1,574 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+This module is the connection layer between the Hg Suite and Mercurial.
+Instead of paying Mercurial's start-up cost for every query, each working
+copy gets a single long-lived backend that all commands are sent to:
+
+1. if the 'mercurial' package is importable, the repository is opened
+   in-process and commands are dispatched to it directly
+2. otherwise, a command server ('hg serve --cmdserver pipe') is started
+   and commands are sent over its channel protocol
+3. if neither is available, commands fall back to running 'hg' as a
+   subprocess
+
+Commands are passed in the same form the rest of the suite builds them
+(e.g., ['hg', 'status', '-q', '.']), and output is returned as text.
+
+Output can also be consumed as it is produced, with hg_stream().
+
+Independent queries can be handed to hg_run_all() together.  They are
+spread over a small pool of command servers (PYHG_JOBS of them) and run
+concurrently, with results returned in the order the queries were given.
+"""
+
+import sys
+import os
+import io
+import struct
+import atexit
+import contextlib
+import threading
+
+# (subprocess and friends are imported where they are used, so that
+# commands which never reach Mercurial do not pay for them)
+
+#--------------------------------------------
+
+class CommandServerError(Exception):
+    pass
+
+class StreamWriter(object):
+    """ A file-like object that hands each write to a callback """
+    def __init__(self, write):
+        self.write = write
+
+    def flush(self):
+        pass
+
+class CommandServer(object):
+    def __init__(self, root):
+        self.root = root
+        self.server = None
+        self.encoding = 'UTF-8'
+        self.lock = threading.Lock()
+
+    def open(self):
+        env = dict(os.environ)
+        env['HGENCODING'] = 'UTF-8'
+
+        import subprocess
+
+        command = ['hg', 'serve', '--cmdserver', 'pipe', '--config', 'ui.interactive=False']
+        try:
+            with open(os.devnull, 'w') as f:
+                self.server = subprocess.Popen(command,
+                                               stdin=subprocess.PIPE,
+                                               stdout=subprocess.PIPE,
+                                               stderr=f,
+                                               cwd=self.root,
+                                               env=env)
+        except OSError:
+            self.server = None
+            return False
+
+        # the server introduces itself with a 'hello' on the output channel
+        try:
+            channel, data = self.__read_channel()
+        except CommandServerError:
+            self.close()
+            return False
+
+        if (channel != b'o') or (b'runcommand' not in data):
+            self.close()
+            return False
+
+        for line in data.split(b'\n'):
+            if line.startswith(b'encoding: '):
+                self.encoding = line[10:].strip().decode('ascii')
+
+        return True
+
+    def close(self):
+        if self.server is None:
+            return
+        try:
+            self.server.stdin.close()
+            self.server.wait()
+        except:
+            pass
+        self.server = None
+
+    def is_open(self):
+        return self.server is not None
+
+    def __read_channel(self):
+        header = self.server.stdout.read(5)
+        if len(header) < 5:
+            raise CommandServerError('Mercurial command server closed its channel.')
+        channel, length = struct.unpack('>cI', header)
+        if channel in (b'I', b'L'):
+            # input requests carry the size of the input wanted, not data
+            return (channel, length)
+        data = self.server.stdout.read(length)
+        if len(data) < length:
+            raise CommandServerError('Mercurial command server closed its channel.')
+        return (channel, data)
+
+    def runcommand(self, args, cwd, write=None):
+        """
+        Run a command (less the leading 'hg'); returns (returncode, output,
+        error) as bytes.  If 'write' is given, output is passed to it as it
+        arrives instead of being returned.
+        """
+        args = ['--cwd', cwd] + list(args)
+        args = [a if isinstance(a, bytes) else a.encode(self.encoding) for a in args]
+        data = b'\0'.join(args)
+
+        with self.lock:
+            try:
+                self.server.stdin.write(b'runcommand\n' + struct.pack('>I', len(data)) + data)
+                self.server.stdin.flush()
+            except (IOError, OSError):
+                self.close()
+                raise CommandServerError('Mercurial command server is not responding.')
+
+            output = []
+            error = []
+            try:
+                while True:
+                    channel, data = self.__read_channel()
+                    if channel == b'o':
+                        if write is not None:
+                            write(data)
+                        else:
+                            output.append(data)
+                    elif channel == b'e':
+                        error.append(data)
+                    elif channel == b'r':
+                        return (struct.unpack('>i', data)[0], b''.join(output), b''.join(error))
+                    elif channel in (b'I', b'L'):
+                        # we have nothing to offer; signal end of input
+                        self.server.stdin.write(struct.pack('>I', 0))
+                        self.server.stdin.flush()
+                    elif channel.isupper():
+                        # a required channel we don't understand
+                        raise CommandServerError('Unexpected Mercurial command server channel "%s".' % channel.decode('ascii'))
+            except (CommandServerError, IOError, OSError, struct.error) as e:
+                # the command may have been partially executed, so it is
+                # not safe to simply run it again
+                self.close()
+                return (255, b''.join(output), b''.join(error) + ('%s\n' % str(e)).encode('utf-8'))
+
+class InProcessServer(object):
+    def __init__(self, root):
+        self.root = root
+        self.ui = None
+        self.repo = None
+        self.request = None
+        self.dispatch = None
+        self.encoding = 'UTF-8'
+        self.lock = threading.Lock()
+
+    def open(self):
+        try:
+            from mercurial import ui as uimod, hg, dispatch, encoding
+        except Exception:
+            return False
+
+        try:
+            self.request = dispatch.request
+        except AttributeError:
+            from mercurial.main_script import request   # Mercurial 7+
+            self.request = request
+        self.dispatch = dispatch.dispatch
+
+        # match the encoding we ask of the command server
+        encoding.encoding = b'UTF-8'
+
+        root = self.root
+        if not isinstance(root, bytes):
+            root = root.encode(sys.getfilesystemencoding())
+
+        try:
+            self.ui = uimod.ui.load()
+            self.ui.setconfig(b'ui', b'interactive', b'False', b'pyhg')
+            self.ui.setconfig(b'ui', b'paginate', b'never', b'pyhg')
+            self.repo = hg.repository(self.ui, root)
+        except Exception:
+            self.repo = None
+            return False
+
+        return True
+
+    def close(self):
+        if self.repo is not None:
+            try:
+                self.repo.close()
+            except:
+                pass
+        self.repo = None
+
+    def is_open(self):
+        return self.repo is not None
+
+    def runcommand(self, args, cwd, write=None):
+        """
+        Run a command (less the leading 'hg'); returns (returncode, output,
+        error) as bytes.  If 'write' is given, output is passed to it as it
+        is written instead of being returned.
+        """
+        args = ['--cwd', cwd] + list(args)
+        args = [a if isinstance(a, bytes) else a.encode(self.encoding) for a in args]
+
+        output = io.BytesIO() if write is None else StreamWriter(write)
+        error = io.BytesIO()
+        with self.lock:
+            # other processes (and interactive commands) may have changed
+            # the repository since our last command
+            self.repo.invalidateall()
+            # '--cwd' changes the folder of the whole process
+            saved_cwd = os.getcwd()
+            try:
+                request = self.request(args, self.ui.copy(), self.repo, io.BytesIO(), output, error)
+                returncode = self.dispatch(request) & 255
+            except Exception as e:
+                returncode = 255
+                error.write(('%s\n' % str(e)).encode('utf-8'))
+            finally:
+                os.chdir(saved_cwd)
+        return (returncode, output.getvalue() if write is None else b'', error.getvalue())
+
+#--------------------------------------------
+
+__servers = {}
+__servers_lock = threading.Lock()
+
+def find_repository(path):
+    """ The top folder of the working copy containing 'path' (or None) """
+    path = os.path.abspath(path)
+    while True:
+        if os.path.isdir(os.path.join(path, '.hg')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+def __shutdown():
+    for key in __servers:
+        if __servers[key] is not None:
+            __servers[key].close()
+
+atexit.register(__shutdown)
+
+def get_server(cwd=None, slot=0):
+    """
+    Return the backend for the working copy containing 'cwd' (or None).
+    Each 'slot' is a separate backend, so that concurrent queries are not
+    queued behind one another; only slot 0 may be in-process, since the
+    others exist to run in parallel.
+    """
+    backends = []
+    if ('PYHG_NO_INPROCESS' not in os.environ) and (slot == 0):
+        backends.append(InProcessServer)
+    if 'PYHG_NO_CMDSERVER' not in os.environ:
+        backends.append(CommandServer)
+    if len(backends) == 0:
+        return None
+
+    root = find_repository(os.getcwd() if cwd is None else cwd)
+    if root is None:
+        return None
+
+    key = (root, slot)
+    with __servers_lock:
+        if key not in __servers:
+            __servers[key] = None
+            for backend in backends:
+                server = backend(root)
+                if server.open():
+                    __servers[key] = server
+                    break
+        server = __servers[key]
+
+    if (server is not None) and (not server.is_open()):
+        return None
+    return server
+
+def __decode(data):
+    return data.decode('utf-8', 'replace')
+
+# commands that reach another repository, and so may have to ask for
+# credentials (or for a host key to be accepted); backends run without a
+# terminal, so these always run as subprocesses that share ours
+REMOTE_COMMANDS = ['push', 'pull', 'incoming', 'outgoing', 'clone']
+
+def hg_run(command, cwd=None, interactive=False, slot=0):
+    """
+    Run an 'hg' command; returns (returncode, output, error) as text.
+    Commands that may need the terminal (e.g., editors or merge tools)
+    should be run 'interactive' so they bypass the command server; those
+    in REMOTE_COMMANDS always do.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+
+    if (len(command) > 1) and (command[1] in REMOTE_COMMANDS):
+        interactive = True
+
+    server = None if interactive else get_server(cwd, slot)
+    if server is not None:
+        try:
+            returncode, output, error = server.runcommand(command[1:], cwd)
+            return (returncode, __decode(output), __decode(error))
+        except CommandServerError:
+            pass    # the request never reached the server; fall back
+
+    import subprocess
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    except OSError as e:
+        return (255, '', '%s\n' % str(e))
+    output, error = process.communicate()
+    return (process.returncode, __decode(output), __decode(error))
+
+def hg_stream(command, cwd=None):
+    """
+    Run an 'hg' command, yielding its output (as bytes) in pieces as it is
+    produced instead of all at once.  Error output is passed along to our
+    own stderr once the command is done, as hg_output() does.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+
+    server = get_server(cwd)
+    if server is not None:
+        try:
+            import queue
+        except ImportError:
+            import Queue as queue
+
+        # the backend runs the command on a thread of its own, and hands
+        # output over as it comes; None marks the end of it
+        chunks = queue.Queue()
+        failed = []
+        errors = []
+        def run():
+            try:
+                errors.append(server.runcommand(command[1:], cwd, write=chunks.put)[2])
+            except CommandServerError:
+                failed.append(True)     # the request never reached the server
+            finally:
+                chunks.put(None)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        while True:
+            chunk = chunks.get()
+            if chunk is None:
+                break
+            yield chunk
+        thread.join()
+        if len(failed) == 0:
+            if len(errors) and len(errors[0]):
+                sys.stderr.write(__decode(errors[0]))
+            return
+
+    import subprocess
+    try:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd)
+    except OSError as e:
+        sys.stderr.write('%s\n' % str(e))
+        return
+
+    # drained on a thread of its own, so a chatty command cannot stall on
+    # a full pipe while we are reading its output
+    errors = []
+    thread = threading.Thread(target=lambda: errors.append(process.stderr.read()))
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = os.read(process.stdout.fileno(), 65536)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        process.stdout.close()
+        process.wait()
+        thread.join()
+        process.stderr.close()
+        if len(errors) and len(errors[0]):
+            sys.stderr.write(__decode(errors[0]))
+
+def get_jobs():
+    """ The number of queries hg_run_all() may run at once (PYHG_JOBS) """
+    if 'PYHG_JOBS' in os.environ:
+        try:
+            return max(1, int(os.environ['PYHG_JOBS']))
+        except ValueError:
+            pass
+    try:
+        import multiprocessing
+        return min(4, multiprocessing.cpu_count())
+    except (ImportError, NotImplementedError):
+        return 1
+
+def hg_run_all(commands, cwd=None, jobs=None):
+    """
+    Run a set of independent 'hg' commands concurrently; returns a list of
+    (returncode, output, error) in the same order as 'commands'.
+    """
+    if cwd is None:
+        cwd = os.getcwd()
+    if jobs is None:
+        jobs = get_jobs()
+    jobs = min(jobs, len(commands))
+
+    if jobs <= 1:
+        return [hg_run(command, cwd) for command in commands]
+
+    try:
+        import queue
+    except ImportError:
+        import Queue as queue
+
+    results = [None] * len(commands)
+    pending = queue.Queue()
+    for index in range(len(commands)):
+        pending.put(index)
+
+    def worker(slot):
+        while True:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                return
+            results[index] = hg_run(commands[index], cwd, slot=slot)
+
+    threads = [threading.Thread(target=worker, args=(slot,)) for slot in range(jobs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return results
+
+def hg_output(command, cwd=None, merge_stderr=False, interactive=False):
+    """
+    Run an 'hg' command and return its output.  Error text is either
+    appended to the output, or passed along to our own stderr.
+    """
+    returncode, output, error = hg_run(command, cwd, interactive)
+    if merge_stderr:
+        return output + error
+    if len(error):
+        sys.stderr.write(error)
+    return output
+
+def __encode_path(file_name):
+    """ Encode a file name for Mercurial, restoring any bytes that were not UTF-8 """
+    if isinstance(file_name, bytes):
+        return file_name
+    if sys.version_info[0] < 3:
+        return file_name.encode('utf-8')
+    return file_name.encode('utf-8', 'surrogateescape')
+
+@contextlib.contextmanager
+def file_list(files):
+    """
+    A 'listfile0:' pattern naming all of 'files', so that a list of files
+    given to a command is never limited by the size of a command line; the
+    list is removed again when the block is left.
+    """
+    import tempfile
+
+    (_file, list_file_name) = tempfile.mkstemp(suffix='.lst')
+    try:
+        with os.fdopen(_file, 'wb') as f:
+            f.write(b'\0'.join([__encode_path(file_name) for file_name in files]))
+        yield 'listfile0:%s' % list_file_name
+    finally:
+        os.remove(list_file_name)
+
+def hg_run_files(command, files, cwd=None):
+    """
+    Run an 'hg' command over a list of files passed in a file_list()
+    pattern.  Returns (returncode, output, error) as hg_run() does.
+    """
+    with file_list(files) as pattern:
+        return hg_run(command + [pattern], cwd)
+
+def hg_batch(command, files, cwd=None):
+    """
+    Run an 'hg' command once over a whole list of files.  Returns
+    (returncode, failures), where 'failures' maps each file that Mercurial
+    complained about to its messages; complaints that name no particular
+    file are kept under None.  Only a command that fails has failures; the
+    warnings of one that succeeds (e.g., "x already tracked!" from 'hg add')
+    are passed along to our own stderr.
+    """
+    import re
+
+    failures = {}
+    if len(files) == 0:
+        return (0, failures)
+
+    returncode, output, error = hg_run_files(command, files, cwd)
+    if returncode == 0:
+        if len(error):
+            sys.stderr.write(error)
+        return (returncode, failures)
+
+    # Mercurial names the file in each complaint ("x: No such file or
+    # directory", "not removing x: file is untracked"); the longest match
+    # wins so that 'a/b.txt' is not blamed on 'b.txt'
+    names = sorted(files, key=len, reverse=True)
+    for line in error.split('\n'):
+        if len(line.strip()) == 0:
+            continue
+        owner = None
+        for file_name in names:
+            if re.search(r'(^|\s)%s(:|\s|$)' % re.escape(file_name), line):
+                owner = file_name
+                break
+        failures.setdefault(owner, []).append(line)
+
+    if len(failures) == 0:
+        failures[None] = ['%s exited with code %d' % (' '.join(command), returncode)]
+
+    return (returncode, failures)
+
+def hg_call(command, cwd=None):
+    """ Run an 'hg' command attached to the terminal; returns its exit code """
+    import subprocess
+    try:
+        return subprocess.call(command, cwd=cwd)
+    except OSError:
+        return 255
@@ -0,0 +1,271 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Structured access to Mercurial's output.  Rather than scraping the text
+Mercurial formats for people, commands are run with '-Tjson' and decoded
+in a single pass into the records below.  This keeps branch names and
+descriptions containing unusual characters from confusing the parsers.
+"""
+
+import sys
+import os
+import re
+import time
+
+from HgClient import hg_run, hg_run_all, hg_run_files, hg_stream, file_list, find_repository
+
+#--------------------------------------------
+
+class StatusEntry(object):
+    __slots__ = ["state", "path", "source"]
+    def __init__(self, state, path, source=None):
+        # Mercurial's status code ('M', 'A', 'R', ...)
+        self.state = state
+        self.path = path
+        # if the entry was copied (or renamed), the file it came from
+        self.source = source
+
+class Changeset(object):
+    __slots__ = ["rev", "node", "branch", "user", "date", "tags",
+                 "bookmarks", "parents", "phase", "files", "description",
+                 "manifest", "extra", "changes"]
+    def __init__(self, data):
+        self.rev = data.get('rev', -1)
+        self.node = data.get('node', '')
+        self.branch = data.get('branch', 'default')
+        self.user = data.get('user', '')
+        self.date = tuple(data.get('date', (0, 0)))
+        self.tags = data.get('tags', [])
+        self.bookmarks = data.get('bookmarks', [])
+        self.parents = data.get('parents', [])
+        self.phase = data.get('phase', '')
+        # 'files' is only reported with --verbose (--debug reports them
+        # by state instead); None means "not known"
+        files = data.get('files', None)
+        if files is None and ('modified' in data):
+            files = data['modified'] + data.get('added', []) + data.get('removed', [])
+        self.files = files or None
+        self.description = data.get('desc', '').split('\n')
+        # only reported with --debug (or CHANGESET_TEMPLATE)
+        self.manifest = data.get('manifest', None)
+        self.extra = data.get('extra', data.get('extras', None))
+        # the files changed, as status records against the first parent;
+        # only reported with CHANGESET_TEMPLATE, None means "not known"
+        self.changes = None
+        if 'file_mods' in data:
+            copies = data.get('file_copies', {})
+            self.changes = [StatusEntry('M', path) for path in data['file_mods']] + \
+                           [StatusEntry('A', path, copies.get(path, None)) for path in data['file_adds']] + \
+                           [StatusEntry('R', path) for path in data['file_dels']]
+
+    @property
+    def changeset(self):
+        """ The 'rev:node' identifier, as Mercurial displays it """
+        return '%d:%s' % (self.rev, self.node[:12])
+
+class Branch(object):
+    __slots__ = ["name", "rev", "node", "active", "closed", "current"]
+    def __init__(self, data):
+        self.name = data.get('branch', '')
+        self.rev = data.get('rev', -1)
+        self.node = data.get('node', '')
+        self.active = data.get('active', False)
+        self.closed = data.get('closed', False)
+        self.current = data.get('current', False)
+
+#--------------------------------------------
+
+# a '-T' template reporting everything a Changeset holds, including the
+# per-file changes, so that no separate 'hg status --change' is needed
+CHANGESET_TEMPLATE = 'json(rev, node, branch, user, date, tags, bookmarks, parents, phase, desc, files, ' \
+                     'manifest, extras, file_mods, file_adds, file_dels, file_copies)'
+
+def decode_json(output):
+    """ Decode a '-Tjson' list from command output; returns None if there is none """
+    # some commands (e.g., incoming) chat a bit before the data
+    start = 0 if output.startswith('[') else output.find('\n[')
+    if start < 0:
+        return None
+    import json
+    try:
+        return json.loads(output[start:])
+    except ValueError:
+        return None
+
+def run_json(command, cwd=None, template='json'):
+    """ Run an 'hg' command with a JSON template; returns (returncode, items, error) """
+    returncode, output, error = hg_run(command + ['-T', template], cwd)
+    return (returncode, decode_json(output), error)
+
+def run_json_all(commands, cwd=None, template='json'):
+    """ Run independent 'hg' commands concurrently with a JSON template; returns a list of (returncode, items, error) """
+    results = hg_run_all([command + ['-T', template] for command in commands], cwd)
+    return [(returncode, decode_json(output), error) for returncode, output, error in results]
+
+def quote_revset(value):
+    """ Quote a value (e.g., a branch name) for use inside a revset """
+    return '"%s"' % value.replace('\\', '\\\\').replace('"', '\\"')
+
+def format_date(date):
+    """ Format a Mercurial (timestamp, offset) date the way 'hg log' does """
+    timestamp, offset = date
+    sign = '-' if offset > 0 else '+'
+    hours, minutes = divmod(abs(offset) // 60, 60)
+    text = time.strftime('%a %b %d %H:%M:%S %Y', time.gmtime(timestamp - offset))
+    return '%s %s%02d%02d' % (text, sign, hours, minutes)
+
+def decode_path(data):
+    """ Decode a file name from Mercurial, keeping any bytes that are not UTF-8 """
+    if sys.version_info[0] < 3:
+        return data.decode('utf-8', 'replace')
+    return data.decode('utf-8', 'surrogateescape')
+
+def parse_status(chunks):
+    """
+    Yield StatusEntry records from the NUL-delimited ('-0') output of an
+    'hg status' command, given as pieces of bytes.  With '-C', a copy's
+    source follows its entry as a record of its own, so each entry is held
+    until the next one arrives.
+    """
+    pending = None
+    remainder = b''
+    for chunk in chunks:
+        records = (remainder + chunk).split(b'\0')
+        remainder = records.pop()
+        for record in records:
+            if len(record) == 0:
+                continue
+            if record.startswith(b'  '):
+                if pending is not None:
+                    pending.source = decode_path(record[2:])
+                continue
+            if pending is not None:
+                yield pending
+            pending = StatusEntry(decode_path(record[:1]), decode_path(record[2:]))
+
+    if pending is not None:
+        yield pending
+
+def iter_status(command, cwd=None):
+    """
+    Run an 'hg status' command, yielding StatusEntry records as Mercurial
+    reports them.  Output is read NUL-delimited ('-0'), so any file name
+    comes through intact; paths are as Mercurial prints them, which is
+    relative to 'cwd' when the command names files or folders (e.g., '.').
+    """
+    for entry in parse_status(hg_stream(command + ['-0'], cwd)):
+        yield entry
+
+def get_status(command, cwd=None):
+    """ Run an 'hg status' command; returns a list of StatusEntry records """
+    return list(iter_status(command, cwd))
+
+def get_file_status(command, files, cwd=None):
+    """ Run an 'hg status' command over just the given files (or folders) """
+    if len(files) == 0:
+        return []
+    # read as bytes, so that file names that are not UTF-8 survive
+    with file_list(files) as pattern:
+        return list(iter_status(command + [pattern], cwd))
+
+# '@@ -a,b +c,d @@' (either count is left out when it is 1)
+__hunk_re = re.compile(r'@@ -\d+(?:,(\d+))? \+(\d+)(?:,(\d+))? @@')
+
+def get_changed_lines(files, cwd=None):
+    """
+    Find the lines of each of the given files that differ from the working
+    copy's parent, with a single 'hg diff -U0' over all of them.  Returns a
+    dictionary of each file's absolute path to a list of (first, last)
+    line numbers of its changed lines; a file that only lost lines has an
+    empty list, and one Mercurial reports no differences for is left out.
+    Returns None if the differences could not be found.
+    """
+    changed = {}
+    if len(files) == 0:
+        return changed
+
+    root = find_repository(cwd or os.getcwd())
+    if root is None:
+        return None
+
+    command = ['hg', 'diff', '-U0', '--nodates',
+               '--config', 'diff.git=no',
+               '--config', 'diff.noprefix=no',
+               '--config', 'diff.showfunc=no']
+    returncode, output, error = hg_run_files(command, files, cwd)
+    if returncode != 0:
+        return None
+
+    ranges = None
+    skip = 0        # the lines of the current hunk
+    for line in output.split('\n'):
+        if line.startswith('\\ '):
+            continue    # '\ No newline at end of file'
+        if skip > 0:
+            skip -= 1
+        elif line.startswith('+++ '):
+            path = line[4:]
+            if path.startswith('b/'):
+                path = path[2:]
+            ranges = changed.setdefault(os.path.normpath(os.path.join(root, path)), [])
+        elif line.startswith('@@ ') and (ranges is not None):
+            result = __hunk_re.match(line)
+            if result is not None:
+                removed = 1 if result.group(1) is None else int(result.group(1))
+                first = int(result.group(2))
+                added = 1 if result.group(3) is None else int(result.group(3))
+                if added:
+                    ranges.append((first, first + added - 1))
+                skip = removed + added
+
+    return changed
+
+def get_changesets(command, cwd=None, template='json'):
+    """
+    Run a changeset-producing command (log, incoming, outgoing, heads);
+    returns a list of Changeset records, or None if the command failed.
+    Use CHANGESET_TEMPLATE as the 'template' to have 'changes' filled in.
+    """
+    returncode, items, error = run_json(command, cwd, template)
+    if items is None:
+        return None
+    return [Changeset(item) for item in items]
+
+def get_changesets_all(commands, cwd=None, template='json'):
+    """
+    Run independent changeset-producing commands concurrently; returns a
+    list of Changeset lists in the same order (None where the command failed).
+    """
+    results = []
+    for returncode, items, error in run_json_all(commands, cwd, template):
+        results.append(None if items is None else [Changeset(item) for item in items])
+    return results
+
+def get_branches(cwd=None):
+    """ Returns a list of Branch records for the repository """
+    returncode, items, error = run_json(['hg', 'branches'], cwd)
+    return [Branch(item) for item in items or []]
@@ -0,0 +1,116 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Support for the test_*.py modules: scratch Mercurial repositories, built
+with the 'hg' found on the PATH, in a temporary folder that is removed
+again when the test is done.  Run the tests from this folder with:
+
+    python -m unittest discover -p "test_*.py"
+
+(or with pytest, which finds the same tests).
+"""
+
+import sys
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+# scratch repositories are not to be affected by the user's own settings
+os.environ['HGRCPATH'] = ''
+os.environ['HGUSER'] = 'test'
+os.environ['HGENCODING'] = 'UTF-8'
+os.environ['PYHG_NO_DAEMON'] = '1'
+
+SUITE = os.path.dirname(os.path.abspath(__file__))
+
+def hg_available():
+    try:
+        with open(os.devnull, 'w') as f:
+            return subprocess.call(['hg', 'version', '-q'], stdout=f, stderr=f) == 0
+    except OSError:
+        return False
+
+#--------------------------------------------
+
+class HgTestCase(unittest.TestCase):
+    """ A test case with a scratch folder ('self.folder') to build repositories in """
+    def setUp(self):
+        if not hg_available():
+            self.skipTest("Mercurial ('hg') is not available")
+        self.saved_cwd = os.getcwd()
+        self.folder = os.path.realpath(tempfile.mkdtemp(prefix='pyhg_test_'))
+
+    def tearDown(self):
+        os.chdir(self.saved_cwd)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def path(self, *names):
+        return os.path.join(self.folder, *names)
+
+    def hg(self, args, cwd):
+        """ Run 'hg' with 'args' in 'cwd'; returns its output """
+        process = subprocess.Popen(['hg'] + args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, cwd=cwd)
+        output = process.communicate()[0].decode('utf-8', 'replace')
+        if process.returncode not in (0, 1):
+            raise AssertionError('hg %s failed:\n%s' % (' '.join(args), output))
+        return output
+
+    def write(self, path, text, mode='w'):
+        folder = os.path.dirname(path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        with open(path, mode) as f:
+            f.write(text)
+
+    def make_repo(self, name, files=None, clone_of=None):
+        """
+        Create a repository (or a clone of one) beneath the scratch folder,
+        committing 'files' (a name -> text mapping) to it; returns its path.
+        """
+        root = self.path(name)
+        if clone_of is None:
+            self.hg(['init', root], self.folder)
+        else:
+            self.hg(['clone', '-q', clone_of, root], self.folder)
+        if files:
+            for file_name in sorted(files):
+                self.write(os.path.join(root, file_name), files[file_name])
+            self.hg(['add', '-q'], root)
+            self.hg(['commit', '-q', '-m', 'Initial revision'], root)
+        return root
+
+    def pyhg(self, args, cwd, stdin=''):
+        """ Run a PyHg command in 'cwd'; returns (exit code, output) """
+        process = subprocess.Popen([sys.executable, os.path.join(SUITE, 'PyHg.py')] + args,
+                                   stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   cwd=cwd)
+        output = process.communicate(stdin.encode('utf-8'))[0].decode('utf-8', 'replace')
+        return (process.returncode, output)
@@ -0,0 +1,111 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Reports what each PyHg command costs to import, so that start-up
+regressions are easy to spot.  Each command is loaded in a fresh
+interpreter run with '-X importtime' (Python 3.7+), exactly as PyHg.py
+would load it:
+
+    python ImportTime.py [--top N] [--fail-over MS] [command ...]
+
+With no commands named, every registered command is measured.
+"""
+
+import sys
+import os
+import subprocess
+
+from argparse import ArgumentParser
+
+#--------------------------------------------
+
+def measure(command):
+    """ Returns a list of (self_us, cumulative_us, depth, module) for loading 'command' """
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = 'import PyHg; PyHg.COMMANDS[%r].load()' % command
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', code],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               cwd=here)
+    output, error = process.communicate()
+
+    imports = []
+    for line in error.decode('utf-8', 'replace').split('\n'):
+        if not line.startswith('import time:'):
+            continue
+        fields = line[12:].split('|')
+        if len(fields) != 3:
+            continue
+        try:
+            self_us = int(fields[0])
+            cumulative_us = int(fields[1])
+        except ValueError:
+            continue    # the column headings
+        # nesting is shown by indenting two spaces past the first
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((self_us, cumulative_us, depth, name.strip()))
+    return imports
+
+if __name__ == "__main__":
+    if sys.version_info < (3, 7):
+        print('ERROR: "-X importtime" requires Python 3.7 or later.', file=sys.stderr)
+        sys.exit(1)
+
+    parser = ArgumentParser(description="Hg Suite import times", prog='ImportTime')
+    parser.add_argument('commands', metavar='COMMAND', nargs='*', help='The commands to measure (default: all).')
+    parser.add_argument("-t", "--top", dest="top", type=int, default=5, help="The number of most expensive modules to list per command.")
+    parser.add_argument("-f", "--fail-over", dest="fail_over", type=float, default=0, help="Exit with an error if any command takes longer (in ms) to import.")
+    options = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from PyHg import COMMANDS
+
+    commands = options.commands if len(options.commands) else sorted(COMMANDS.keys())
+
+    result = 0
+    for command in commands:
+        if command not in COMMANDS:
+            print('ERROR: Unknown command "%s".' % command, file=sys.stderr)
+            result = 1
+            continue
+
+        imports = measure(command)
+        # the top-level imports account for everything
+        total = sum([imp[1] for imp in imports if imp[2] == 0]) / 1000.0
+
+        flag = ''
+        if options.fail_over and (total > options.fail_over):
+            flag = '  <-- over %gms' % options.fail_over
+            result = 1
+
+        print('%-12s %8.1fms%s' % (command, total, flag))
+        imports.sort(key=lambda imp: imp[0], reverse=True)
+        for self_us, cumulative_us, depth, name in imports[:options.top]:
+            print('    %-28s %6.1fms (%.1fms with its imports)' % (name, self_us / 1000.0, cumulative_us / 1000.0))
+
+    sys.exit(result)
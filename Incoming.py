@@ -24,84 +24,38 @@ from __future__ import print_function
 # IN THE SOFTWARE.
 #------------------------------------------------------------------------------
 
-import sys
 import os
-import re
-import subprocess
 
-from PyHg_lib import Changeset, Colors
+from HgQuery import get_changesets, get_changesets_all, CHANGESET_TEMPLATE
+from PyHg_lib import Colors
 
 #--------------------------------------------
 
 class Incoming(object):
     (STYLE_UNDEFINED, STYLE_PLAIN, STYLE_COLOR) = (0, 1, 2)
 
-    def __init__(self, options, command=['hg', 'incoming', '-v', '-n', '-M'], database=False, target_branch=None, ignore_branch=False):
+    # the most changesets named in a single revset
+    REVSET_LIMIT = 500
+
+    def __init__(self, options, context, command=['hg', 'incoming', '-v', '-n', '-M'], database=False, target_branch=None, ignore_branch=False):
         if not options.branch:
             return
 
         self.options = options
-
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        lines = output.split('\n')
+        self.context = context
 
         self.changesets = []
 
-        max_lines = len(lines)
-        i = 0
-
-        while True:
-            try:
-                line = lines[i].strip()
-            except:
-                break
-
-            result = re.search('changeset:(.+)$', line)
-            if result:
-                cs = Changeset()
-                setattr(cs, 'changeset', result.group(1).strip())
-
-                while not line.startswith('description:'):
-                    result = re.search('(\w+)\s*:\s*(.+)$', line)
-                    key = result.group(1).strip()
-                    value = result.group(2).strip()
-                    if key == 'files':
-                        value = value.split()
-                    setattr(cs, key, value)
-
-                    i += 1
-                    line = lines[i].rstrip()
-
-                # this is the "description" line, so we need to gather up
-                # the description before pressing on.
-
-                desc = []
-                while True:
-                    i += 1
-
-                    try:
-                        line = lines[i].rstrip()
-                    except:
-                        break
-
-                    if line.startswith('changeset:'):
-                        break
-
-                    desc.append(line)
-
-                setattr(cs, 'description', desc)
-
-                if ignore_branch:
-                    self.changesets.append(cs)
-                else:
-                    if target_branch:
-                        if target_branch == getattr(cs, 'branch', None):
-                            self.changesets.append(cs)
-                    else:
-                        if self.options.branch == getattr(cs, 'branch', 'default'):
-                            self.changesets.append(cs)
+        for cs in get_changesets(command) or []:
+            if ignore_branch:
+                self.changesets.append(cs)
             else:
-                i += 1
+                if target_branch:
+                    if target_branch == cs.branch:
+                        self.changesets.append(cs)
+                else:
+                    if self.options.branch == cs.branch:
+                        self.changesets.append(cs)
 
         if not database:
             self.print_()
@@ -110,28 +64,24 @@ class Incoming(object):
         if len(self.changesets) == 0:
             return
 
-        for cs in self.changesets:
-            # see if this changeset is known locally.  if not,
-            # don't modify the 'files' attribute
+        # one revset covers every changeset.  'id()' quietly matches nothing
+        # for a changeset that is not known locally, so whatever comes back
+        # also answers which of them we have; the others keep their 'files'.
+        # (very long lists are split up to keep command lines reasonable.)
+        nodes = [cs.node for cs in self.changesets]
+        commands = []
+        for i in range(0, len(nodes), self.REVSET_LIMIT):
+            revset = ' or '.join(['id(%s)' % node for node in nodes[i:i + self.REVSET_LIMIT]])
+            commands.append(['hg', 'log', '-r', revset])
+
+        changes = {}
+        for known in get_changesets_all(commands, template=CHANGESET_TEMPLATE):
+            for cs in known or []:
+                changes[cs.node] = cs.changes
 
-            output = subprocess.Popen(['hg', 'status', '--rev', cs.changeset], stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0].decode("utf-8")
-            if 'unknown revision' not in output:
-                output = subprocess.Popen(['hg', 'status', '--change', cs.changeset], stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-                lines = output.split('\n')
-
-                files = []
-                for file in lines:
-                    if file.endswith('\n'):
-                        file = file.rstrip()
-                    if (len(file) == 0) or (' ' not in file):
-                        continue
-                    try:
-                        files.append(file.split(' ')[1])
-                    except:
-                        print("ERROR: Invalid format detected: '%s'" % file, file=sys.stderr)
-
-                if len(files):
-                    setattr(cs, 'files', files)
+        for cs in self.changesets:
+            if changes.get(cs.node, None):
+                cs.files = [entry.path for entry in changes[cs.node]]
 
     def format(self, style=0, no_changes_message="No changes pending for branch"):
         lines = []
@@ -270,6 +220,7 @@ class Incoming(object):
                     except:
                         pass
                     lines.extend(cs.description)
+                    lines.append('')
 
         return lines
 
@@ -26,124 +26,211 @@ from __future__ import print_function
 
 import sys
 import os
-import subprocess
 
 import Stage
 
 from Action import Action
+from RepoContext import RepoContext
+from HgClient import hg_output, get_jobs
+from HgQuery import get_changesets, get_changed_lines, format_date, CHANGESET_TEMPLATE
 from PyHg_lib import find_hg_root, \
-                     MyParser, \
                      colorize_status, \
-                     fixup_renames, \
-                     is_valid, \
-                     marshall_comments, \
+                     fixup_status, \
+                     iter_fixup_status, \
+                     index_status, \
+                     parse_status_line, \
+                     emit_records, \
+                     scan_files, \
                      format_seconds, \
-                     Colors
+                     Colors, \
+                     DISPLAY_PLAIN, \
+                     DISPLAY_RAW
 
 #--------------------------------------------
 
 class Status(Action):
-    def __init__(self):
-        super(Status, self).__init__()
+    def __init__(self, context=None):
+        super(Status, self).__init__(context)
 
     def execute(self, options, quiet=False, **kwargs):
-        def process_workingcopy():
-            #command = ['hg', 'status', '--subrepos', '-q', '.']
-            command = ['hg', 'status', '--subrepos', '-q', '-C', '.']
-            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-            lines = fixup_renames(output.split('\n'))
+        if options.process_all:
+            return self.process_all(options)
 
-            # decorate entries based on any staging information
+        if not options.branch:
+            self.message = 'ERROR: No valid branch could found under current folder.'
+            return False
+
+        return self.process_workingcopy(options)
+
+    def process_workingcopy(self, options):
+        #command = ['hg', 'status', '--subrepos', '-q', '.']
+        command = ['hg', 'status', '--subrepos', '-q', '-C', '.']
+
+        root = find_hg_root(self.context)
+
+        stage_io = Stage.StageIO(self.context)
+        stage_path = stage_io.get_staging_root(root, options)
+        if (not os.path.exists(stage_path)) or (len(os.listdir(stage_path)) == 0):
+            # with no staging information to decorate them, entries can be
+            # shown as Mercurial reports them
+            lines = iter_fixup_status(self.context.iter_status(command))
+            if options.changed_lines:
+                # (all at once, so one diff covers every modified file)
+                lines = list(lines)
+            if options.output_format != 'text':
+                self.report((status_record(line) for line in lines), options)
+            else:
+                self.process_lines(lines, options)
+            return True
 
-            orphaned_tag = '^'
-            orphaned_count = 0
+        lines = fixup_status(self.context.status(command))
+        status_index = index_status(lines)
 
-            root = find_hg_root()
+        # (the same, for --format)
+        records = [status_record(line) for line in lines]
 
-            stage_path = Stage.StageIO().get_staging_root(root, options)
-            if os.path.exists(stage_path):
-                stage_names = os.listdir(stage_path)
+        # decorate entries based on any staging information
 
-                # if len(stage_names) and len(lines) == 0:
-                #     msg = 'ERROR: Orphaned staged entries found in the following areas:\n'
-                #     for stage_name in stage_names:
-                #         msg += '  [%s]\n' % stage_name
-                #     msg += '\nUse "unstage --erase" to clear them.'
-                #     self.message = msg
-                #     return False
+        orphaned_tag = '^'
+        orphaned_count = 0
 
-                for stage_name in stage_names:
+        if os.path.exists(stage_path):
+            stage_names = os.listdir(stage_path)
 
-                    # reference_count = 0
-                    # capture_count = 0
+            # if len(stage_names) and len(lines) == 0:
+            #     msg = 'ERROR: Orphaned staged entries found in the following areas:\n'
+            #     for stage_name in stage_names:
+            #         msg += '  [%s]\n' % stage_name
+            #     msg += '\nUse "unstage --erase" to clear them.'
+            #     self.message = msg
+            #     return False
 
-                    stage_db_path = os.path.join(stage_path, stage_name)
-                    stage_db_file = os.path.join(stage_db_path, 'stage.db')
-                    if not os.path.exists(stage_db_file):
-                        continue    # odd... should probably print a message
+            for stage_name in stage_names:
 
-                    stage_db = Stage.StageIO().load_stage_db(stage_db_file)
+                # reference_count = 0
+                # capture_count = 0
 
-                    # (yes, yes, I know...quadratic complexity: I don't care :)
-                    for key in stage_db:
-                        staged_entry = stage_db[key]
-                        found = False
-                        for i in range(len(lines)):
-                            if key == lines[i][2:]:
-                                # reference_count += 1 if staged_entry.snapshot is None else 0
-                                # capture_count += 1 if staged_entry.snapshot is not None else 0
+                stage_db_path = os.path.join(stage_path, stage_name)
+                stage_db_file = os.path.join(stage_db_path, 'stage.db')
+                if not os.path.exists(stage_db_file):
+                    continue    # odd... should probably print a message
 
-                                snap = Stage.StageIO().get_staged_entry_tag(stage_db_path, staged_entry, key)
+                stage_db = stage_io.load_stage_db(stage_db_file)
 
-                                lines[i] = '%s [%s] %s (%s)' % (lines[i][:1], stage_name, key, snap)
+                for key in stage_db:
+                    staged_entry = stage_db[key]
+                    i = status_index.get(key, None)
+                    if i is not None:
+                        # reference_count += 1 if staged_entry.snapshot is None else 0
+                        # capture_count += 1 if staged_entry.snapshot is not None else 0
 
-                                found = True
-                                break
-                        if not found:
-                            snap = Stage.StageIO().get_staged_entry_tag(stage_db_path, staged_entry, key)
-                            # if this is a refernce, it's orphaned
-                            orphaned = ''
-                            if staged_entry.snapshot is None:
-                                # reference_count += 1
-                                orphaned = orphaned_tag
-                                orphaned_count += 1
-                            lines.append('%s [%s] %s%s (%s)' % (staged_entry.state, stage_name, orphaned, key, snap))
+                        snap = stage_io.get_staged_entry_tag(stage_db_path, staged_entry, key)
 
-            self.process_lines(lines, options)
+                        lines[i] = '%s [%s] %s (%s)' % (lines[i][:1], stage_name, key, snap)
+                        records[i].update(stage=stage_name, snapshot=snap)
 
-            if orphaned_count != 0:
-                print('\n(Use the "staged" command to purge %sorphaned references)' % orphaned_tag)
+                        # once decorated, the line no longer matches its key
+                        del status_index[key]
+                    else:
+                        snap = stage_io.get_staged_entry_tag(stage_db_path, staged_entry, key)
+                        # if this is a refernce, it's orphaned
+                        orphaned = ''
+                        if staged_entry.snapshot is None:
+                            # reference_count += 1
+                            orphaned = orphaned_tag
+                            orphaned_count += 1
+                        lines.append('%s [%s] %s%s (%s)' % (staged_entry.state, stage_name, orphaned, key, snap))
+                        records.append(status_record('%s %s' % (staged_entry.state, key), stage_name, snap, len(orphaned) != 0))
 
+        if options.output_format != 'text':
+            self.report(records, options)
             return True
 
-        if options.process_all:
-            # look at each subfolder of the current folder, and determine if it is a Mercurial folder
-
-            working_copies = False
+        self.process_lines(lines, options)
 
-            for entry in os.listdir('.'):
-                hgrc = os.path.join(entry, '.hg', 'hgrc')
-                if os.path.isdir(entry) and os.path.exists(hgrc):
-                    d = MyParser(hgrc).as_dict()
-                    dest = d['paths']['default']
+        if orphaned_count != 0:
+            print('\n(Use the "staged" command to purge %sorphaned references)' % orphaned_tag)
 
-                    working_copies = True
+        return True
 
-                    os.chdir(entry)
+    def process_all(self, options):
+        """
+        Look for Mercurial working copies beneath the current folder (see
+        Workspace.py), and report the status of each.  Working copies are
+        processed concurrently by a pool of worker processes (PYHG_JOBS of
+        them); each one's output is held until it is done, and printed in
+        folder order.
+        """
+        import time
+        from Workspace import Workspace
+
+        working_copies = [(wc.path, wc.default) for wc in Workspace('.').working_copies()]
+
+        if len(working_copies) == 0:
+            self.message = 'ERROR: No valid Mercurial working copies found under current folder.'
+            return False
+
+        start = time.time()
+
+        work = [(WorkerOptions(options, os.path.abspath(entry)), entry) for entry, dest in working_copies]
+
+        machine = (options.output_format != 'text')
+
+        results = None
+        if options.ansi_color_requires_batch and not machine:
+            # output comes from a batch file and cannot be held, so working
+            # copies are processed one at a time, as they are announced
+            results = []
+            for (entry, dest), args in zip(working_copies, work):
+                print('Scanning %s (%s)...' % (entry, dest))
+                results.append(gather_status(args, hold_output=False))
+        else:
+            jobs = min(get_jobs(), len(work))
+            if jobs > 1:
+                try:
+                    import multiprocessing
+                    pool = multiprocessing.Pool(jobs, scan_serially)
+                except (ImportError, OSError):
+                    pool = None
+                if pool is not None:
+                    try:
+                        results = pool.map(gather_status, work, 1)
+                    finally:
+                        pool.close()
+                        pool.join()
+            if results is None:
+                results = [gather_status(args) for args in work]
+
+        timings = []
+        failures = []
+        records = []
+        for (entry, dest), (output, errors, failure, elapsed) in zip(working_copies, results):
+            if machine:
+                # workers report in 'ndjson'; each record gains its working copy
+                import json
+                for line in output.splitlines():
+                    record = json.loads(line)
+                    record['working_copy'] = entry
+                    records.append(record)
+            else:
+                if not options.ansi_color_requires_batch:
                     print('Scanning %s (%s)...' % (entry, dest))
-                    process_workingcopy()
-                    os.chdir('..')
-
-            if not working_copies:
-                self.message = 'ERROR: No valid Mercurial working copies found under current folder.'
-                return False
+                sys.stdout.write(output)
+                sys.stdout.flush()
+            sys.stderr.write(errors)
+            timings.append('%s %.1fs' % (entry, elapsed))
+            if failure is not None:
+                failures.append('%s: %s' % (entry, failure))
+
+        summary = 'Scanned %d working copies in %.1fs (%s)' % (len(working_copies), time.time() - start, ', '.join(timings))
+        if machine:
+            emit_records(records, options.output_format)
+            print(summary, file=sys.stderr)
         else:
-            if not options.branch:
-                self.message = 'ERROR: No valid branch could found under current folder.'
-                return False
-
-            if not process_workingcopy():
-                return False
+            print('\n%s' % summary)
+        if len(failures):
+            self.message = 'ERROR: %d working copies could not be scanned:\n  %s' % (len(failures), '\n  '.join(failures))
+            return False
 
         return True
 
@@ -152,50 +239,128 @@ class Status(Action):
 
     # make our status colorization code available to other classes
 
+    def report(self, records, options):
+        """ Print status records (see status_record()) in the form chosen with --format """
+        def complete():
+            for batch in status_batches(records):
+                self.add_comments(batch, options)
+                for record in batch:
+                    yield record
+
+        emit_records(complete(), options.output_format)
+
+    def add_comments(self, records, options):
+        """ Attach the embedded comments of modified and added files to their status records """
+        scan_paths = []
+        modified_paths = []
+        for record in records:
+            full_path = os.path.join(options.working_dir, record['path'])
+            # (files that are not text are weeded out as they are scanned)
+            if (record['state'] in ('M', 'A')) and os.path.exists(full_path):
+                scan_paths.append(full_path)
+                if record['state'] == 'M':
+                    modified_paths.append(full_path)
+
+        scanned = self.scan_comments(scan_paths, modified_paths, options, DISPLAY_RAW)
+
+        comment_cache = self.context.comment_cache(options.working_dir)
+        if comment_cache is not None:
+            comment_cache.save()
+
+        for record in records:
+            full_path = os.path.join(options.working_dir, record['path'])
+            comments, error = scanned.get(full_path, (None, None))
+            if error is not None:
+                print(error, file=sys.stderr)
+            record['comments'] = comments or []
+
+    def scan_comments(self, scan_paths, modified_paths, options, display=DISPLAY_PLAIN):
+        """
+        Gather the embedded comments of the given files; returns a dictionary
+        of each one's path to a (comments, error) pair.  With --changed-lines,
+        only the changed lines of the 'modified_paths' among them are looked
+        at; otherwise, results are taken from the comment cache, if possible.
+        """
+        if getattr(options, 'changed_lines', False):
+            # what is found depends on the parent revision, too, so none
+            # of it is cached
+            changed = get_changed_lines(modified_paths, options.working_dir)
+            ranges = None
+            if changed is not None:
+                ranges = dict([(path, changed.get(os.path.normpath(os.path.abspath(path)), [])) for path in modified_paths])
+            return dict(zip(scan_paths, scan_files(scan_paths, display=display, ranges=ranges)))
+
+        comment_cache = self.context.comment_cache(options.working_dir)
+        if comment_cache is None:
+            scanned = scan_files(scan_paths, display=display)
+        else:
+            scanned = comment_cache.comments_all(scan_paths, display=display)
+        return dict(zip(scan_paths, scanned))
+
     def process_lines(self, lines, options):
         batch_text = ''
         if os.name == 'nt':
             batch_text = '@echo off\n'
             batch_text += 'set FG=%_fg\n'
             batch_text += 'set BG=%_bg\n'
-        lines = colorize_status(lines)
-
-        for line in lines:
-            filename = line[1]
 
-            full_path = os.path.join(options.working_dir, filename)
-
-            #if not os.path.exists(full_path):
-            #    continue
-
-            comments = None
-
-            if ((line[0] == '!') or (line[0] == '+')) and \
-               os.path.exists(full_path) and \
-               is_valid(filename):
-                try:
-                    comments = marshall_comments(full_path)
-                except Exception as e:
-                    print(str(e), file=sys.stderr)
-                    comments = None
-
-            if options.ansi_color:
-                if options.ansi_color_requires_batch:
-                    batch_text += 'echo %s\n' % line[3]
-                    if comments:
-                        for comment in comments:
-                            batch_text += 'echo %s%s\n' % (Colors['BrightGreen'], comment)
+        for batch in status_batches(lines):
+            batch = colorize_status(batch)
+
+            # gather the embedded comments of the batch's files up front, so
+            # the files can be scanned together (and those unchanged since the
+            # last run not scanned at all)
+            scan_paths = []
+            modified_paths = []
+            for line in batch:
+                full_path = os.path.join(options.working_dir, line[1])
+                # (files that are not text are weeded out as they are scanned)
+                if ((line[0] == '!') or (line[0] == '+')) and os.path.exists(full_path):
+                    scan_paths.append(full_path)
+                    if line[0] == '!':
+                        modified_paths.append(full_path)
+
+            scanned = self.scan_comments(scan_paths, modified_paths, options)
+
+            for line in batch:
+                filename = line[1]
+
+                full_path = os.path.join(options.working_dir, filename)
+
+                #if not os.path.exists(full_path):
+                #    continue
+
+                comments = None
+
+                if full_path in scanned:
+                    comments, error = scanned[full_path]
+                    if error is not None:
+                        print(error, file=sys.stderr)
+
+                if options.ansi_color:
+                    if options.ansi_color_requires_batch:
+                        batch_text += 'echo %s\n' % line[3]
+                        if comments:
+                            for comment in comments:
+                                batch_text += 'echo %s%s\n' % (Colors['BrightGreen'], comment)
+                    else:
+                        print(line[3])
+                        if comments:
+                            for comment in comments:
+                                print('%s%s' % (Colors['BrightGreen'], comment))
+                        print(Colors['Reset'], end='')    # reset color
                 else:
-                    print(line[3])
+                    print(line[0], line[1])
                     if comments:
                         for comment in comments:
-                            print('%s%s' % (Colors['BrightGreen'], comment))
-                    print(Colors['Reset'], end='')    # reset color
-            else:
-                print(line[0], line[1])
-                if comments:
-                    for comment in comments:
-                        print(comment)
+                            print(comment)
+
+            # let each batch be seen as soon as it is ready
+            sys.stdout.flush()
+
+        comment_cache = self.context.comment_cache(options.working_dir)
+        if comment_cache is not None:
+            comment_cache.save()
 
         if options.ansi_color:
             if options.ansi_color_requires_batch:
@@ -204,8 +369,127 @@ class Status(Action):
                 open(options.batch_file_name, 'w').write(batch_text)
                 os.system(options.batch_file_name)
 
+def changeset_record(cs):
+    """ The --format form of a changeset, with its file changes as status records """
+    return {
+        'rev'         : cs.rev,
+        'node'        : cs.node,
+        'branch'      : cs.branch,
+        'user'        : cs.user,
+        'date'        : format_date(cs.date),
+        'timestamp'   : cs.date[0],
+        'tags'        : cs.tags,
+        'bookmarks'   : cs.bookmarks,
+        'phase'       : cs.phase,
+        'parents'     : cs.parents,
+        'description' : '\n'.join(cs.description),
+        'changes'     : [status_record(line) for line in fixup_status(cs.changes or [])],
+    }
+
+def status_record(line, stage=None, snapshot=None, orphaned=False):
+    """
+    The --format form of a fixup_status() line: its state ('M', 'A', 'R',
+    'V' for renamed or 'C' for copied), path and source, and where it is
+    staged, the staging area, the snapshot tag shown in the colored output
+    ('&' for a reference, '=' for an unchanged snapshot, otherwise its age)
+    and whether it is an orphaned reference.
+    """
+    state, path, source = parse_status_line(line)
+    return {
+        'state'    : state,
+        'path'     : path,
+        'source'   : source,
+        'stage'    : stage,
+        'snapshot' : snapshot,
+        'orphaned' : orphaned,
+    }
+
+def status_batches(lines):
+    """
+    Split status lines into batches for process_lines().  A list is taken
+    whole; lines still arriving from Mercurial are taken in batches that
+    start small, so output begins promptly, and grow, so that comment
+    scanning still has enough files at once to spread over its workers.
+    """
+    if isinstance(lines, list):
+        yield lines
+        return
+
+    batch = []
+    size = 8
+    for line in lines:
+        batch.append(line)
+        if len(batch) == size:
+            yield batch
+            batch = []
+            size = min(size * 2, 1024)
+    if len(batch):
+        yield batch
+
+class WorkerOptions(object):
+    """ A copy of the command options that can be handed to a worker process """
+    def __init__(self, options, working_dir):
+        for key, value in vars(options).items():
+            if isinstance(value, (type(None), bool, int, float, str, list, tuple)):
+                setattr(self, key, value)
+        self.working_dir = working_dir
+        self.process_all = False
+        if options.output_format != 'text':
+            self.output_format = 'ndjson'
+        if options.ansi_color_requires_batch:
+            self.batch_file_name = options.batch_file_name
+
+def scan_serially():
+    """
+    Set up a 'status --process-all' worker process.  Working copies are
+    already spread over the processors, and worker processes may not start
+    processes of their own, so each scans its files itself (see scan_files()).
+    """
+    os.environ['PYHG_SCAN_JOBS'] = '1'
+
+def gather_status(args, hold_output=True):
+    """
+    Report the status of one working copy for 'status --process-all'.
+    Returns (output, errors, failure, seconds), with the output held
+    rather than printed unless 'hold_output' is False.
+
+    Status is gathered relative to the current folder, so this changes
+    into the working copy for the duration; it normally runs in a worker
+    process of its own, leaving the command's own folder untouched.
+    """
+    import time
+    try:
+        from StringIO import StringIO
+    except ImportError:
+        from io import StringIO
+
+    options, entry = args
+
+    start = time.time()
+    saved = (os.getcwd(), sys.stdout, sys.stderr)
+    output = StringIO()
+    errors = StringIO()
+    failure = None
+    try:
+        os.chdir(options.working_dir)
+        if hold_output:
+            sys.stdout = output
+            sys.stderr = errors
+        status = Status(RepoContext())
+        if not status.process_workingcopy(options):
+            failure = status.message or 'status failed'
+    except KeyboardInterrupt:
+        raise
+    except BaseException as e:
+        failure = str(e) or e.__class__.__name__
+    finally:
+        os.chdir(saved[0])
+        sys.stdout, sys.stderr = saved[1:]
+
+    return (output.getvalue(), errors.getvalue(), failure, time.time() - start)
+
 class Log(object):
-    def __init__(self, options):
+    def __init__(self, options, context):
         if not options.branch:
             return
 
@@ -234,70 +518,56 @@ class Log(object):
         if options.detailed:
             command.append('--debug')
 
-        if len(options.log_template):
+        if options.output_format != 'text':
+            changesets = get_changesets(command, template=CHANGESET_TEMPLATE)
+            if changesets is None:
+                print("ERROR: Invalid revision provided", file=sys.stderr)
+                sys.exit(1)
+            emit_records([changeset_record(cs) for cs in changesets], options.output_format)
+        elif len(options.log_template):
             command += ['-T', options.log_template]
-            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+            output = hg_output(command)
             print(output)
         else:
-            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-            if len(output) == 0:
+            changesets = get_changesets(command, template=CHANGESET_TEMPLATE)
+            if not changesets:
                 print("ERROR: Invalid revision provided", file=sys.stderr)
                 sys.exit(1)
 
-            lines = output.split('\n')
-
-            blank_count = 0
-            has_file_changes = False
-            id = ''
-
-            i = 0
-            while i < len(lines):
-                line = lines[i]
-                if line.startswith('changeset: '):
-                    if len(id) != 0:
-                        print('-' * 40)
-                    id = line.split(' ')[-1]
-                    if ':' in id:
-                        id = id.split(':')[1]
-                    print('%s%s%s' % (Colors['BrightGreen'], line, Colors['Reset']))
-                    has_file_changes = False
-                elif line.startswith('description:'):
-                    print(line)
-
-                    blank_count = 0
-                    i += 1
-                    while i < len(lines):
-                        if len(lines[i].strip()) == 0:
-                            blank_count += 1
-                        else:
-                            if blank_count:
-                                print('\n' * blank_count)
-                                blank_count = 0
-                            print('%s%s%s' % (Colors['BrightYellow'], lines[i], Colors['Reset']))
-
-                        i += 1
-                        try:
-                            if(lines[i].startswith('changeset: ')):
-                                i -= 1 
-                                break
-                        except IndexError:
-                            pass    # we've exceeded the array bounds
-
-                    if has_file_changes:
-                        print('changes:')
-                        command = ['hg', 'status', '-C', '--change', id]
-                        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-                        if len(output) == 0:
-                            print("ERROR: Invalid revision provided", file=sys.stderr)
-                            sys.exit(1)
-
-                        change_lines = fixup_renames(output.split('\n'))
-                        Status().process_lines(change_lines, options)
-
-                    print(Colors['Reset'])
-                elif line.startswith('files:'):
-                    has_file_changes = True
-                else:
-                    print(line)
-
-                i += 1
+            for cs in changesets:
+                if cs is not changesets[0]:
+                    print('-' * 40)
+
+                node = cs.node if options.detailed else cs.node[:12]
+                print('%schangeset:   %d:%s%s' % (Colors['BrightGreen'], cs.rev, node, Colors['Reset']))
+                if cs.branch != 'default':
+                    print('branch:      %s' % cs.branch)
+                for bookmark in cs.bookmarks:
+                    print('bookmark:    %s' % bookmark)
+                for tag in cs.tags:
+                    print('tag:         %s' % tag)
+                if options.detailed:
+                    print('phase:       %s' % cs.phase)
+                if options.detailed or (len(cs.parents) > 1):
+                    for parent in cs.parents:
+                        print('parent:      %s' % (parent if options.detailed else parent[:12]))
+                if options.detailed and cs.manifest:
+                    print('manifest:    %s' % cs.manifest)
+                print('user:        %s' % cs.user)
+                print('date:        %s' % format_date(cs.date))
+                if options.detailed and cs.extra:
+                    for key in sorted(cs.extra):
+                        print('extra:       %s=%s' % (key, cs.extra[key]))
+
+                print('description:')
+                for line in cs.description:
+                    if len(line.strip()) == 0:
+                        print('')
+                    else:
+                        print('%s%s%s' % (Colors['BrightYellow'], line, Colors['Reset']))
+
+                if cs.files and cs.changes:
+                    print('changes:')
+                    Status(context).process_lines(fixup_status(cs.changes), options)
+
+                print(Colors['Reset'])
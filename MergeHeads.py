@@ -26,24 +26,21 @@ from __future__ import print_function
 
 import sys
 import os
-import subprocess
+
+from HgClient import hg_run, hg_output, hg_call
+from HgQuery import get_changesets
 
 #--------------------------------------------
 
 class MergeHeads(object):
-    def __init__(self, options):
+    def __init__(self, options, context):
         if not options.branch:
             return
 
         # if there's more than one 'changeset:' tag, then there are multiple heads
 
         command = ['hg', 'heads', '.']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        lines = output.split('\n')
-        changeset_count = 0
-        for line in lines:
-            if line.startswith('changeset:'):
-                changeset_count += 1
+        changeset_count = len(get_changesets(command) or [])
 
         if changeset_count < 2:
             print('Branch only contains a single head!')
@@ -52,20 +49,19 @@ class MergeHeads(object):
         # if there are uncommitted changes, then we abort
 
         command = ['hg', 'status', '-q', '.']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+        output = hg_output(command)
         if len(output):
             print('Cannot merge heads while uncommitted changes exist!')
             sys.exit(0)
 
-        try:
-            subprocess.check_call(['hg', 'merge'])
-        except:
+        # merge tools may need the terminal, so bypass the command server
+        if hg_call(['hg', 'merge']) != 0:
             print('Merge failed!')
             sys.exit(0)
 
-        try:
-            subprocess.check_call(['hg', 'commit', '-m', 'merged heads'])
-        except:
+        returncode, output, error = hg_run(['hg', 'commit', '-m', 'merged heads'])
+        print(output + error, end='')
+        if returncode != 0:
             print('Commit failed!')
             sys.exit(0)
 
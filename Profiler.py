@@ -0,0 +1,210 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Profiling for PyHg's global '--profile' option.  The whole command is run
+under cProfile; its statistics are saved in a file that pstats (and the
+viewers built on it) can read, the most expensive calls are listed on
+stderr, and the profile can also be written as collapsed stacks, which is
+what flame graph tools (flamegraph.pl, inferno, speedscope) accept:
+
+    --profile[=PATH]          save the statistics (by default, as
+                              pyhg-COMMAND.prof in the temp folder)
+    --profile-stacks[=PATH]   also write collapsed stacks (by default,
+                              next to the statistics, as .folded)
+    --profile-top=N           list this many entries (default: 20)
+
+These may appear anywhere on the command line, even before the command,
+and a value may also be given as the next argument ('--profile PATH').
+"""
+
+import sys
+import os
+import time
+
+DEFAULT_TOP = 20
+
+# where PyHg hands work to Mercurial; time spent below these is time spent
+# waiting on (or running) Mercurial rather than in PyHg itself
+HG_ENTRY_POINTS = ['hg_run', 'hg_run_all', 'hg_run_files', 'hg_stream', 'hg_output', 'hg_call']
+
+# stacks accounting for less than this (in seconds) are left out
+MIN_STACK_TIME = 0.00001
+
+#--------------------------------------------
+
+def frame_name(func):
+    """ How a pstats function key (file, line, name) appears in a stack """
+    filename, line, name = func
+    if filename == '~':
+        return name     # a built-in
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
+
+class Profiler(object):
+    def __init__(self, path, stacks_path=None, top=DEFAULT_TOP):
+        self.path = path
+        self.stacks_path = stacks_path
+        self.top = top
+
+    @staticmethod
+    def from_arguments(argv, commands=()):
+        """
+        Take the profiling options out of 'argv' (in place); returns a
+        Profiler, or None if profiling was not asked for.  A value may be
+        given as '--profile=PATH' or as '--profile PATH'; in the latter
+        form, an argument that starts with '-' or names one of 'commands'
+        is not taken as the value.
+        """
+        path = None
+        stacks_path = None
+        profile = False
+        top = DEFAULT_TOP
+
+        remaining = [argv[0]]
+        index = 1
+        while index < len(argv):
+            arg = argv[index]
+            index += 1
+            name, equals, value = arg.partition('=')
+            if name not in ('--profile', '--profile-stacks', '--profile-top'):
+                remaining.append(arg)
+                continue
+
+            if (not equals) and (index < len(argv)) and \
+               (not argv[index].startswith('-')) and (argv[index] not in commands):
+                value = argv[index]
+                index += 1
+
+            if name == '--profile':
+                profile = True
+                path = value if len(value) else None
+            elif name == '--profile-stacks':
+                profile = True
+                stacks_path = value if len(value) else ''
+            else:
+                try:
+                    top = max(0, int(value))
+                except ValueError:
+                    print('WARNING: Ignoring "%s"; a number is needed.' % ' '.join([arg, value]).strip(), file=sys.stderr)
+        argv[:] = remaining
+
+        if not profile:
+            return None
+
+        if path is None:
+            import tempfile
+            command = argv[1] if (len(argv) > 1) and not argv[1].startswith('-') else 'pyhg'
+            path = os.path.join(tempfile.gettempdir(), 'pyhg-%s.prof' % command)
+        if stacks_path == '':
+            stacks_path = '%s.folded' % os.path.splitext(path)[0]
+
+        return Profiler(path, stacks_path, top)
+
+    def run(self, function, *args):
+        """ Call 'function' under the profiler, and report on it (even if it exits) """
+        import cProfile
+
+        profile = cProfile.Profile()
+        start = time.time()
+        profile.enable()
+        try:
+            return function(*args)
+        finally:
+            profile.disable()
+            self.report(profile, time.time() - start)
+
+    def report(self, profile, elapsed):
+        import pstats
+
+        sys.stdout.flush()
+
+        profile.dump_stats(self.path)
+        stats = pstats.Stats(profile, stream=sys.stderr)
+
+        print('', file=sys.stderr)
+        print('Profile: %.3fs, of which %.3fs was spent in Mercurial.' % (elapsed, self.hg_time(stats.stats)), file=sys.stderr)
+        print('Statistics saved to "%s" (view with: python -m pstats %s).' % (self.path, self.path), file=sys.stderr)
+
+        if self.stacks_path is not None:
+            count = self.write_stacks(stats.stats, self.stacks_path)
+            print('Collapsed stacks (%d) saved to "%s".' % (count, self.stacks_path), file=sys.stderr)
+
+        if self.top:
+            stats.sort_stats('cumulative').print_stats(self.top)
+
+    def hg_time(self, stats):
+        """ The time spent in HG_ENTRY_POINTS, counting only the outermost calls """
+        total = 0.0
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            if (os.path.basename(func[0]) != 'HgClient.py') or (func[2] not in HG_ENTRY_POINTS):
+                continue
+            for caller, caller_stats in callers.items():
+                if os.path.basename(caller[0]) != 'HgClient.py':
+                    total += caller_stats[3]
+        return total
+
+    def write_stacks(self, stats, path):
+        """
+        Write the profile as collapsed stacks ('frame;frame;frame count',
+        with counts in microseconds).  cProfile records calls between pairs
+        of functions, not whole stacks, so each function's time is shared
+        among the paths that reach it in proportion to what each of its
+        callers spent in it.  Returns the number of stacks written.
+        """
+        callees = {}
+        for func, (cc, nc, tt, ct, callers) in stats.items():
+            for caller in callers:
+                callees.setdefault(caller, []).append(func)
+
+        roots = [func for func, entry in stats.items() if len(entry[4]) == 0]
+
+        stacks = {}
+        pending = [([func], 1.0) for func in roots]
+        while len(pending):
+            stack, share = pending.pop()
+            func = stack[-1]
+            cc, nc, tt, ct, callers = stats[func]
+
+            self_time = tt * share
+            if self_time >= MIN_STACK_TIME:
+                key = ';'.join([frame_name(f) for f in stack])
+                stacks[key] = stacks.get(key, 0.0) + self_time
+
+            for callee in callees.get(func, []):
+                if callee in stack:
+                    continue    # recursion is shown once
+                callee_ct = stats[callee][3]
+                edge_ct = stats[callee][4][func][3]
+                if callee_ct <= 0:
+                    continue
+                callee_share = share * edge_ct / callee_ct
+                if callee_ct * callee_share >= MIN_STACK_TIME:
+                    pending.append((stack + [callee], callee_share))
+
+        with open(path, 'w') as f:
+            for key in sorted(stacks):
+                f.write('%s %d\n' % (key, int(round(stacks[key] * 1000000))))
+        return len(stacks)
@@ -26,26 +26,22 @@ from __future__ import print_function
 
 import sys
 import os
-import subprocess
 
+from HgClient import hg_run
+from HgQuery import get_changesets as query_changesets
 from PyHg_lib import MyParser
 
 #--------------------------------------------
 
 class Push(object):
-    def __init__(self, options):
+    def __init__(self, options, context):
         def get_changesets():
             command = ['hg', 'outgoing']
-            output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0].decode("utf-8")
-            if ('no changes found' in output) or ('abort:' in output):
+            changesets = query_changesets(command)
+            if not changesets:
                 return (None, None, None)
 
-            changesets = []
-            lines = output.split('\n')
-            for line in lines:
-                line = line.rstrip()
-                if line.startswith('changeset:   '):
-                    changesets.append(line[13:].strip())
+            changesets = [cs.changeset for cs in changesets]
 
             changeset_count = len(changesets)
             label = 'changesets' if changeset_count > 1 else 'changeset'
@@ -71,11 +67,12 @@ class Push(object):
             print('Pushing %d %s to %s' % (changeset_data[1], changeset_data[2], destination))
             while True:
                 command = ['hg', 'push']
-                push_process = subprocess.Popen(command, stdout=subprocess.PIPE)
-                output = push_process.communicate()[0].decode("utf-8")
+                returncode, output, error = hg_run(command)
+                if len(error):
+                    sys.stderr.write(error)
 
-                if push_process.returncode:
-                    print("ERROR: Push operation failed with %d." % push_process.returncode, file=sys.stderr)
+                if returncode:
+                    print("ERROR: Push operation failed with %d." % returncode, file=sys.stderr)
                     print(output, file=sys.stderr)
                     sys.exit(1)
 
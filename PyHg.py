@@ -23,22 +23,161 @@ from __future__ import print_function
 # FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
 # IN THE SOFTWARE.
 #------------------------------------------------------------------------------
-
 import sys
 import os
-import subprocess
-import struct
-import tempfile
-import atexit
 
 from argparse import ArgumentParser
-from PyHg_lib import format_seconds, Colors
+from PyHg_lib import Colors
+from RepoContext import RepoContext
+
+#--------------------------------------------
+# the command registry
+#
+# each command declares the options it accepts and where its implementation
+# lives.  only the parser for the command being run is built, and only its
+# module is imported, so start-up costs the same however many commands exist.
+
+def option(*flags, **kwargs):
+    return (flags, kwargs)
+
+class Command(object):
+    def __init__(self, name, module, entry, arguments, action=False, finish=None):
+        self.name = name
+        # the module and class that implement the command
+        self.module = module
+        self.entry = entry
+        # the parser options it accepts
+        self.arguments = arguments
+        # Actions are constructed with the context and then run in stages
+        # (execute() and cleanup()); other commands do their work when they
+        # are constructed with (options, context)
+        self.action = action
+        # an optional function to adjust the parsed options
+        self.finish = finish
+
+    def load(self):
+        """ Import the implementing module and return the entry class """
+        module = __import__(self.module)
+        return getattr(module, self.entry)
+
+COMMANDS = {}
+
+def register(name, module, entry, arguments=[], action=False, finish=None):
+    COMMANDS[name] = Command(name, module, entry, arguments, action, finish)
+
+STAGE_NAME = [
+    option("-s", "--stage-name", dest="stage_name", default=None, help="Specify the default staging area to use."),
+]
+
+PROCESS_ALL = [
+    option("-a", "--process-all", action="store_true", dest="process_all", default=False, help="Process all in commands that have multiple processing options available."),
+]
+
+ERASE_CACHE = [
+    option("-e", "--erase", action="store_true", dest="erase_cache", help="Erase any cache the command may have available or may have created."),
+]
+
+OVERWRITE = [
+    option("-o", "--overwrite", action="store_true", dest="overwrite", default=False, help="Force replacement of modified destination (no merge check)."),
+]
+
+# commands whose output other programs may want to read
+OUTPUT_FORMAT = [
+    option("-F", "--format", dest="output_format", choices=['text', 'json', 'ndjson'], default='text', help="Print records for other programs (one JSON array, or one object per line) instead of colored text."),
+]
+
+# commands that report embedded comments
+CHANGED_LINES = [
+    option("-C", "--changed-lines", action="store_true", dest="changed_lines", default=False, help="Only report embedded comments on lines changed since the parent revision (added files are scanned whole)."),
+]
+
+# 'switch' may invoke 'shelve', so it accepts these as well
+SHELVE = [
+    option('shelf_name', metavar='MICROBRANCH', default='', nargs='?', help='Optional microbranch id for the operation.'),
+    option("-n", "--no-revert", dest="no_revert", action="store_true", default=False, help="Bypass any implicit reverting of changes in the working copy."),
+    option("-c", "--comment", dest="comment", default='', help="Provide a comment for shelved microbranch."),
+    option("-p", "--path", dest="use_path", default=".", help="Specify a path on which to operate."),
+    option("-i", "--include", dest="include_filter", default=None, help="Specify a filter value to include detected modifications."),
+    option("-X", "--exclude", action="append", dest="exclude_filter", default=[], help="Specify a filter value to exclude detected modifications."),
+    option("-r", "--extra", dest="extra_files", action="append", default=[], help="Specify additional, non-managed files to be processed."),
+    option("-V", "--ide-state", dest="ide_state", action="store_true", default=False, help="When shelving, save the current state of the Visual Studio IDE for all defined solutions."),
+]
+
+register('update', 'Update', 'Update', PROCESS_ALL)
+
+register('status', 'Info', 'Status', STAGE_NAME + PROCESS_ALL + OUTPUT_FORMAT + CHANGED_LINES, action=True)
+
+register('log', 'Info', 'Log', [
+    option("-l", "--limit", dest="log_limit", default=0, help="Limit the number of log entries displayed."),
+    option("-r", "--revision", dest="log_rev", default='', help="Display log info for the specified changeset revision."),
+    option("-u", "--user", dest="log_user", default='', help="Display log info for changes applied by a specific user."),
+    option("-b", "--branch", dest="log_branch", default='', help="Display log info for the specified branch."),
+    option("-d", "--date", dest="log_date", default='', help="Select revisions matching the provided date spec."),
+    option("-k", "--keyword", dest="log_keyword", default='', help="Select revisions containing the case-insensitive text."),
+    option("-M", "--no-merges", dest="log_no_merges", action="store_true", default=False, help="Exclude revisions that are merges."),
+    option("-T", "--template", dest="log_template", default='', help="Display with template."),
+    option("-v", "--verbose", dest="detailed", action="store_true", default=False, help="Include as much detail as possible."),
+] + OUTPUT_FORMAT)
+
+register('incoming', 'Incoming', 'Incoming')
+
+def finish_commit(options):
+    if options.log_file and not os.path.exists(options.log_file):
+        options.log_file = None
+    if not options.commit_message:
+        options.commit_message = None
+    if options.push_external:
+        options.push_changes = True
+
+register('commit', 'Commit', 'Commit', STAGE_NAME + [
+    option("-l", "--log", dest="log_file", default=None, help="Use the specified text file as the commit log."),
+    option("-m", "--message", dest="commit_message", default=None, help="Enter a message for use by the command."),
+    option("-w", "--wrap", dest="wrap_at", default=80, help="Set the column offset for wrapping log text."),
+    option("-P", "--push", action="store_true", dest="push_changes", default=False, help="Push committed changes upstream."),
+    option("-x", "--pushex", action="store_true", dest="push_external", default=False, help="Push committed changes to an external destination."),
+    option("-A", "--authtoken", dest="auth_token", default=None, help="Insert an authorization token for the commit."),
+] + CHANGED_LINES, finish=finish_commit)
+
+register('stage', 'Stage', 'Stage', STAGE_NAME + [
+    option("-S", "--snapshot", dest="snapshot", action="store_true", default=False, help="Perform an action that is time-based."),
+] + ERASE_CACHE)
+
+register('unstage', 'Stage', 'Unstage', STAGE_NAME + ERASE_CACHE)
+
+register('staged', 'Stage', 'Staged', STAGE_NAME + OUTPUT_FORMAT, action=True)
+
+register('rebase', 'Rebase', 'Rebase', [
+    option('source_branch', metavar='BRANCH', type=str, help='Required source branch for the rebase operation.'),
+    option("-M", "--mergeonly", action="store_true", dest="merge_only", default=False, help="Skip the final commit step in a rebase operation."),
+])
+
+register('shelve', 'Shelf', 'Shelve', STAGE_NAME + SHELVE, action=True)
+
+register('shelved', 'Shelf', 'Shelved', SHELVE + [
+    option("-v", "--verbose", dest="detailed", action="store_true", default=False, help="Include as much detail as possible."),
+] + OUTPUT_FORMAT, action=True)
+
+register('restore', 'Shelf', 'Restore', STAGE_NAME + [
+    option('shelf_name', metavar='MICROBRANCH', type=str, default='', nargs='?', help='Optional source microbranch for the restore operation.'),
+] + OVERWRITE + ERASE_CACHE, action=True)
+
+register('conflicts', 'Shelf', 'Conflicts', [
+    option('shelf_name', metavar='MICROBRANCH', default='', nargs='?', help='Optional microbranch id for the operation.'),
+])
+
+register('push', 'Push', 'Push')
+
+register('mergeheads', 'MergeHeads', 'MergeHeads')
+
+register('diff', 'Diff', 'Diff')
+
+register('switch', 'Switch', 'Switch', SHELVE + OVERWRITE, action=True)
 
 #--------------------------------------------
 
 class Options(object):
-    def __init__(self):
-        self.batch_file_name = ''
+    def __init__(self, context):
+        self.__batch_file_name = ''
 
         if sys.platform == 'darwin':
             self.seven_zip = '7za'
@@ -84,82 +223,28 @@ class Options(object):
         # first, look at the action being executed.  we will customize
         # the options being parsed by the action
 
-        cmd_set = ['update', 'commit', 'stage', 'unstage', 'staged', 'incoming',
-                   'status', 'log', 'rebase', 'shelve', 'shelved', 'restore', #'backup',
-                   'conflicts', 'push', 'mergeheads', 'diff', 'switch']
-        StageIO_dependents = ['stage', 'unstage', 'staged', 'commit', 'status', 'shelve', 'restore']
-
         self.action = None
-        if sys.argv[1] in cmd_set:
-            self.action = sys.argv[1]
-            del sys.argv[1]     # remove it so positional arguments don't get confused
-        else:
-            print("ERROR: Unknown action:", sys.argv[1], file=sys.stderr)
-            sys.exit(1)
+        self.command = None
+        if len(sys.argv) > 1:
+            if sys.argv[1] in COMMANDS:
+                self.action = sys.argv[1]
+                self.command = COMMANDS[self.action]
+                del sys.argv[1]     # remove it so positional arguments don't get confused
+            else:
+                print("ERROR: Unknown action:", sys.argv[1], file=sys.stderr)
+                sys.exit(1)
 
         # now process any command-line options for the current action
 
         parser = ArgumentParser(description="Hg Suite", prog=self.action)
         parser.add_argument("-B", "--use-batch", dest="ansi_color_requires_batch", default=((os.name == 'nt') and ('CMDER_ROOT' not in os.environ)), type=bool, help="Run output through a batch file for ANSI processing.")
-        if self.action == 'log':
-            parser.add_argument("-l", "--limit", dest="log_limit", default=0, help="Limit the number of log entries displayed.")
-            parser.add_argument("-r", "--revision", dest="log_rev", default='', help="Display log info for the specified changeset revision.")
-            parser.add_argument("-u", "--user", dest="log_user", default='', help="Display log info for changes applied by a specific user.")
-            parser.add_argument("-b", "--branch", dest="log_branch", default='', help="Display log info for the specified branch.")
-            parser.add_argument("-d", "--date", dest="log_date", default='', help="Select revisions matching the provided date spec.")
-            parser.add_argument("-k", "--keyword", dest="log_keyword", default='', help="Select revisions containing the case-insensitive text.")
-            parser.add_argument("-M", "--no-merges", dest="log_no_merges", action="store_true", default=False, help="Exclude revisions that are merges.")
-            parser.add_argument("-T", "--template", dest="log_template", default='', help="Display with template.")
-            parser.add_argument("-v", "--verbose", dest="detailed", action="store_true", default=False, help="Include as much detail as possible.")
-        else:
-            # many commands are dependent on this
-            if self.action in StageIO_dependents:
-                parser.add_argument("-s", "--stage-name", dest="stage_name", default=None, help="Specify the default staging area to use.")
-
-            if self.action == 'commit':
-                parser.add_argument("-l", "--log", dest="log_file", default=None, help="Use the specified text file as the commit log.")
-                parser.add_argument("-m", "--message", dest="commit_message", default=None, help="Enter a message for use by the command.")
-                parser.add_argument("-w", "--wrap", dest="wrap_at", default=80, help="Set the column offset for wrapping log text.")
-                parser.add_argument("-P", "--push", action="store_true", dest="push_changes", default=False, help="Push committed changes upstream.")
-                parser.add_argument("-x", "--pushex", action="store_true", dest="push_external", default=False, help="Push committed changes to an external destination.")
-                parser.add_argument("-A", "--authtoken", dest="auth_token", default=None, help="Insert an authorization token for the commit.")
-
-            # 'switch' may invoke 'shelve', so pass along a subset of its options
-            if ('shelve' in self.action) or (self.action == 'switch'):
-                parser.add_argument('shelf_name', metavar='MICROBRANCH', default='', nargs='?', help='Optional microbranch id for the operation.')
-                parser.add_argument("-n", "--no-revert", dest="no_revert", action="store_true", default=False, help="Bypass any implicit reverting of changes in the working copy.")
-                parser.add_argument("-c", "--comment", dest="comment", default='', help="Provide a comment for shelved microbranch.")
-                parser.add_argument("-p", "--path", dest="use_path", default=".", help="Specify a path on which to operate.")
-                parser.add_argument("-i", "--include", dest="include_filter", default=None, help="Specify a filter value to include detected modifications.")
-                parser.add_argument("-X", "--exclude", action="append", dest="exclude_filter", default=[], help="Specify a filter value to exclude detected modifications.")
-                parser.add_argument("-r", "--extra", dest="extra_files", action="append", default=[], help="Specify additional, non-managed files to be processed.")
-                parser.add_argument("-V", "--ide-state", dest="ide_state", action="store_true", default=False, help="When shelving, save the current state of the Visual Studio IDE for all defined solutions.")
-                if self.action == 'shelved':
-                    parser.add_argument("-v", "--verbose", dest="detailed", action="store_true", default=False, help="Include as much detail as possible.")
-
-            if self.action == 'conflicts':
-                parser.add_argument('shelf_name', metavar='MICROBRANCH', default='', nargs='?', help='Optional microbranch id for the operation.')
-
-            if self.action == 'switch':
-                parser.add_argument("-o", "--overwrite", action="store_true", dest="overwrite", default=False, help="Force replacement of modified destination (no merge check).")
-
-            if self.action == 'restore':
-                parser.add_argument('shelf_name', metavar='MICROBRANCH', type=str, default='', nargs='?', help='Optional source microbranch for the restore operation.')
-                parser.add_argument("-o", "--overwrite", action="store_true", dest="overwrite", default=False, help="Force replacement of modified destination (no merge check).")
-                parser.add_argument("-e", "--erase", action="store_true", dest="erase_cache", help="Erase any cache the command may have available or may have created.")
-
-            if self.action == 'rebase':
-                parser.add_argument('source_branch', metavar='BRANCH', type=str, help='Required source branch for the rebase operation.')
-                parser.add_argument("-M", "--mergeonly", action="store_true", dest="merge_only", default=False, help="Skip the final commit step in a rebase operation.")
-
-            if 'stage' in self.action:
-                if self.action == 'stage':
-                    parser.add_argument("-S", "--snapshot", dest="snapshot", action="store_true", default=False, help="Perform an action that is time-based.")
-                if (self.action == 'stage') or (self.action == 'unstage'):
-                    parser.add_argument("-e", "--erase", action="store_true", dest="erase_cache", help="Erase any cache the command may have available or may have created.")
-
-            if (self.action == 'update') or (self.action == 'status'):
-                parser.add_argument("-a", "--process-all", action="store_true", dest="process_all", default=False, help="Process all in commands that have multiple processing options available.")
+        # listed for help only; main() has already taken these out of sys.argv
+        parser.add_argument("--profile", metavar="PATH", nargs='?', help="Profile the command, saving the statistics to PATH (default: pyhg-<action>.prof in the temp folder).")
+        parser.add_argument("--profile-stacks", metavar="PATH", nargs='?', help="Also write the profile as collapsed stacks for flame graph tools.")
+        parser.add_argument("--profile-top", metavar="N", type=int, help="With --profile, the number of entries to list (default: 20).")
+        if self.command is not None:
+            for flags, kwargs in self.command.arguments:
+                parser.add_argument(*flags, **kwargs)
 
         options, args = parser.parse_known_args()
 
@@ -168,178 +253,96 @@ class Options(object):
         # use ANSI terminal color codes?
         self.ansi_color = True # options.ansi_color
 
-        # will the interpreter only process color codes from a batch file?
-        self.ansi_color_requires_batch = options.ansi_color_requires_batch
-
-        if self.action == 'log':
-            self.log_limit = options.log_limit
-            self.log_rev = options.log_rev
-            self.detailed = options.detailed
-            self.log_user = options.log_user
-            self.log_branch = options.log_branch
-            self.log_date = options.log_date
-            self.log_keyword = options.log_keyword
-            self.log_no_merges = options.log_no_merges
-            self.log_template = options.log_template
-        else:
-            if self.action == 'commit':
-                self.log_file = None
-                if options.log_file and os.path.exists(options.log_file):
-                    self.log_file = options.log_file
-                self.commit_message = None
-                if options.commit_message:
-                    self.commit_message = options.commit_message
-                self.wrap_at = options.wrap_at
-                self.push_external = options.push_external
-                self.push_changes = True if options.push_external else options.push_changes
-                self.auth_token = options.auth_token
-
-            if ('shelve' in self.action) or (self.action == 'switch'):
-                self.shelf_name = options.shelf_name
-                self.no_revert  = options.no_revert
-                self.comment = options.comment
-                self.use_path = options.use_path
-                self.include_filter = options.include_filter
-                self.exclude_filter = options.exclude_filter
-                self.extra_files = options.extra_files
-                self.ide_state = options.ide_state
-                if self.action == 'shelved':
-                    self.detailed = options.detailed
-
-            if self.action == 'conflicts':
-                self.shelf_name = options.shelf_name
-
-            if self.action == 'switch':
-                self.overwrite = options.overwrite
-
-            if self.action == 'restore':
-                self.overwrite = options.overwrite
-                self.erase_cache = options.erase_cache
-                self.shelf_name = options.shelf_name
-
-            if self.action == 'rebase':
-                self.source_branch = options.source_branch
-                self.merge_only = options.merge_only
-
-            if 'stage' in self.action:
-                if self.action == 'stage':
-                    self.snapshot = options.snapshot
-                if (self.action == 'stage') or (self.action == 'unstage'):
-                    self.erase_cache = options.erase_cache
-
-            if (self.action == 'update') or (self.action == 'status'):
-                self.process_all = options.process_all
-
-            if self.action in StageIO_dependents:
-                self.stage_name = options.stage_name
+        # everything else the command declared is adopted as-is
+        for key, value in vars(options).items():
+            setattr(self, key, value)
+
+        if (self.command is not None) and (self.command.finish is not None):
+            self.command.finish(self)
 
         # gather some information about the Mercurial working copy
 
-        command = ['hg', 'branch']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0].decode("utf-8")
-        self.branch = output.split('\n')[0]
-        if 'no repository found' in self.branch:
-            self.branch = None
+        self.branch = context.branch()
 
         self.args = args
 
-        # generate a batch file name for global use
-        if os.name == 'nt':
-            (_file, _file_name) = tempfile.mkstemp(text=True, suffix='.bat')
-        else:
-            (_file, _file_name) = tempfile.mkstemp(text=True, suffix='.sh')
-        os.close(_file)
-        self.batch_file_name = _file_name
-
         self.working_dir = os.getcwd()
 
-        atexit.register(self.cleanup)
+    @property
+    def batch_file_name(self):
+        """ A batch file name for global use, generated the first time it is needed """
+        if len(self.__batch_file_name) == 0:
+            import tempfile
+            if os.name == 'nt':
+                (_file, _file_name) = tempfile.mkstemp(text=True, suffix='.bat')
+            else:
+                (_file, _file_name) = tempfile.mkstemp(text=True, suffix='.sh')
+            os.close(_file)
+            self.__batch_file_name = _file_name
+        return self.__batch_file_name
 
     def cleanup(self):
-        if len(self.batch_file_name) and os.path.exists(self.batch_file_name):
-            os.remove(self.batch_file_name)
-
-if __name__ == "__main__":
-    options = Options()
-
-    if options.action not in 'update|status|shelved':
-        if (options.branch == None) and (len(options.args) == 0):
-            print('You must be in a valid Mercurial working folder!')
-            sys.exit(0)
-
-    if not options.action:
-        print('Nothing to do!  Please specify an action.')
-        sys.exit(0)
-
-    result = 0
-    pyhg_action = None
-
-    if options.action == 'update':
-        from Update import Update
-        Update(options)
-    elif options.action == 'status':
-        from Info import Status
-        pyhg_action = Status()
-    elif options.action == 'log':
-        from Info import Log
-        Log(options)
-    elif options.action == 'incoming':
-        from Incoming import Incoming
-        Incoming(options)
-    elif options.action == 'commit':
-        from Commit import Commit
-        Commit(options)
-    elif options.action == 'stage':
-        from Stage import Stage
-        Stage(options)
-    elif options.action == 'unstage':
-        from Stage import Unstage
-        Unstage(options)
-    elif options.action == 'staged':
-        from Stage import Staged
-        pyhg_action = Staged()
-    elif options.action == 'rebase':
-        from Rebase import Rebase
-        Rebase(options)
-    # elif options.action == 'backup':
-    #     from Backup import Backup
-    #     Backup(options)
-    elif options.action == 'shelve':
-        from Shelf import Shelve
-        pyhg_action = Shelve()
-    elif options.action == 'shelved':
-        from Shelf import Shelved
-        pyhg_action = Shelved()
-    elif options.action == 'restore':
-        from Shelf import Restore
-        pyhg_action = Restore()
-    elif options.action == 'conflicts':
-        from Shelf import Conflicts
-        Conflicts(options)
-    elif options.action == 'push':
-        from Push import Push
-        Push(options)
-    elif options.action == 'mergeheads':
-        from MergeHeads import MergeHeads
-        MergeHeads(options)
-    elif options.action == 'diff':
-        from Diff import Diff
-        Diff(options)
-    elif options.action == 'switch':
-        from Switch import Switch
-        pyhg_action = Switch()
-
-    if pyhg_action:
-        if not pyhg_action.execute(options):
-            print(pyhg_action.message, file=sys.stderr)
-            result = 1
+        if len(self.__batch_file_name) and os.path.exists(self.__batch_file_name):
+            os.remove(self.__batch_file_name)
+
+def main(context=None):
+    """
+    Run the command named in sys.argv; returns the exit code.  A long-lived
+    caller (see PyHg_daemon.py) may pass in its own RepoContext.
+    """
+    # '--profile' is global, and can appear anywhere (see Profiler.py)
+    if any(arg.startswith('--profile') for arg in sys.argv[1:]):
+        from Profiler import Profiler
+        profiler = Profiler.from_arguments(sys.argv, COMMANDS)
+        if profiler is not None:
+            return profiler.run(run, context)
+
+    return run(context)
+
+def run(context=None):
+    """ Parse the options for, and dispatch, the command named in sys.argv """
+    # shared by every command run by this process, so that the same
+    # question is never put to Mercurial twice
+    if context is None:
+        context = RepoContext()
+
+    options = Options(context)
+
+    try:
+        if not options.action:
+            print('Nothing to do!  Please specify an action.')
+            return 0
+
+        if options.action not in 'update|status|shelved':
+            if (options.branch == None) and (len(options.args) == 0):
+                print('You must be in a valid Mercurial working folder!')
+                return 0
+
+        result = 0
+        pyhg_action = None
+
+        entry = options.command.load()
+        if options.command.action:
+            pyhg_action = entry(context)
         else:
-            if not pyhg_action.cleanup(options):
+            entry(options, context)
+
+        if pyhg_action:
+            if not pyhg_action.execute(options):
                 print(pyhg_action.message, file=sys.stderr)
                 result = 1
+            else:
+                if not pyhg_action.cleanup(options):
+                    print(pyhg_action.message, file=sys.stderr)
+                    result = 1
 
-    if os.name != 'nt':
-        # reset the console colors to defaults
-        print(Colors['Reset'])
+        if (os.name != 'nt') and (getattr(options, 'output_format', 'text') == 'text'):
+            # reset the console colors to defaults
+            print(Colors['Reset'])
 
-    sys.exit(result)
+        return result
+    finally:
+        options.cleanup()
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+The thin client for PyHg_daemon.py.  It stands in for PyHg.py (e.g., in
+shell prompts and editor hooks): commands the daemon can serve are forwarded
+to it along with the current folder and environment, and the daemon's output
+and exit code are passed back.  Anything else -- or everything, if no daemon
+is listening -- runs here through PyHg.py as usual.
+
+This module is deliberately small, since its start-up time is the point.
+"""
+
+import sys
+import os
+import struct
+
+# the commands a daemon may serve: they neither prompt nor hand the
+# terminal over to another program ('incoming' may have to ask for
+# credentials, so it is not among them)
+DAEMON_COMMANDS = ['status', 'staged', 'shelved', 'log', 'conflicts']
+
+#--------------------------------------------
+
+def socket_path():
+    """ The per-user socket the daemon listens on (PYHG_DAEMON_SOCKET overrides) """
+    if 'PYHG_DAEMON_SOCKET' in os.environ:
+        return os.environ['PYHG_DAEMON_SOCKET']
+    if 'XDG_RUNTIME_DIR' in os.environ:
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'pyhg.sock')
+    import tempfile
+    return os.path.join(tempfile.gettempdir(), 'pyhg-%d.sock' % os.getuid())
+
+def encode(text):
+    if isinstance(text, bytes):
+        return text
+    return text.encode('utf-8', 'surrogateescape')
+
+def decode(data):
+    if sys.version_info[0] < 3:
+        return data
+    return data.decode('utf-8', 'surrogateescape')
+
+def receive(connection, length):
+    """ Read exactly 'length' bytes from a socket """
+    data = b''
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise EOFError('The connection was closed.')
+        data += chunk
+    return data
+
+def forward(argv):
+    """
+    Run a command through the daemon; returns its exit code, or None if
+    there is no daemon to run it.
+
+    A request is a length-prefixed block of NUL-separated fields: the
+    current folder, the argument count, the arguments, and the environment
+    as 'name=value' pairs.  Replies arrive on channels, as with Mercurial's
+    command server: 'o' and 'e' carry output and error text, and 'r' ends
+    the command with its exit code.
+    """
+    import socket
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path())
+    except socket.error:
+        connection.close()
+        return None
+
+    fields = [os.getcwd(), str(len(argv))] + list(argv)
+    fields += ['%s=%s' % (key, value) for key, value in os.environ.items()]
+    request = b'\0'.join([encode(field) for field in fields])
+
+    output = getattr(sys.stdout, 'buffer', sys.stdout)
+    error = getattr(sys.stderr, 'buffer', sys.stderr)
+    try:
+        connection.sendall(struct.pack('>I', len(request)) + request)
+        while True:
+            channel, length = struct.unpack('>cI', receive(connection, 5))
+            data = receive(connection, length)
+            if channel == b'o':
+                output.write(data)
+                output.flush()
+            elif channel == b'e':
+                error.write(data)
+                error.flush()
+            elif channel == b'r':
+                return struct.unpack('>i', data)[0]
+    except (socket.error, EOFError, struct.error):
+        # the command may have been partly run, so it is not safe to retry
+        error.write(b'ERROR: Lost the connection to the PyHg daemon.\n')
+        return 255
+    finally:
+        connection.close()
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if (os.name == 'posix') and ('PYHG_NO_DAEMON' not in os.environ) and \
+       (len(argv) > 0) and (argv[0] in DAEMON_COMMANDS):
+        result = forward(argv)
+        if result is not None:
+            sys.exit(result)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import PyHg
+    sys.exit(PyHg.main())
@@ -0,0 +1,198 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+A resident PyHg server for the commands that are run most often and most
+eagerly (e.g., 'status' from a shell prompt).  It listens on a per-user Unix
+socket and runs the commands forwarded by PyHg_client.py in-process, so the
+interpreter, the suite's modules, the Mercurial backend, parsed hgrc files,
+staging databases and microbranch manifests all stay warm between commands.
+On Linux, working copies are also watched with inotify (see Watcher.py), so
+'hg status' only has to re-check the files that have changed.
+
+    python PyHg_daemon.py           (serve until interrupted)
+    python PyHg_daemon.py --stop    (ask a running daemon to exit)
+
+Status is always gathered afresh; everything else the shared RepoContext
+remembers is dropped whenever the repository's dirstate, branch or staging
+areas change.
+"""
+
+import sys
+import os
+import struct
+import socket
+import traceback
+
+import PyHg
+
+from PyHg_client import DAEMON_COMMANDS, socket_path, forward, decode, receive
+from RepoContext import RepoContext
+
+#--------------------------------------------
+
+class ChannelWriter(object):
+    """ A stand-in for sys.stdout/sys.stderr that sends text to the client """
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def write(self, text):
+        if len(text) == 0:
+            return
+        data = text if isinstance(text, bytes) else text.encode('utf-8', 'replace')
+        self.connection.sendall(struct.pack('>cI', self.channel, len(data)) + data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class Daemon(object):
+    def __init__(self, path):
+        self.path = path
+        self.context = RepoContext(watch=True)
+        self.running = False
+
+    def serve(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                probe.close()
+                print('ERROR: A PyHg daemon is already listening on "%s".' % self.path, file=sys.stderr)
+                return 1
+            except socket.error:
+                os.remove(self.path)    # left behind by a daemon that died
+
+        # load everything the served commands need up front
+        for name in DAEMON_COMMANDS:
+            PyHg.COMMANDS[name].load()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)     # the socket is for our user alone
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(5)
+
+        print('PyHg daemon listening on "%s".' % self.path)
+        sys.stdout.flush()
+
+        self.running = True
+        try:
+            while self.running:
+                connection, address = listener.accept()
+                try:
+                    self.handle(connection)
+                except Exception:
+                    traceback.print_exc()
+                finally:
+                    connection.close()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            self.context.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+        return 0
+
+    def handle(self, connection):
+        length = struct.unpack('>I', receive(connection, 4))[0]
+        fields = [decode(field) for field in receive(connection, length).split(b'\0')]
+
+        cwd = fields[0]
+        argc = int(fields[1])
+        argv = fields[2:2 + argc]
+        env = {}
+        for field in fields[2 + argc:]:
+            key, sep, value = field.partition('=')
+            if len(sep):
+                env[key] = value
+
+        if argv == ['--stop']:
+            self.running = False
+            result = 0
+        elif (len(argv) == 0) or (argv[0] not in DAEMON_COMMANDS):
+            ChannelWriter(connection, b'e').write('ERROR: The PyHg daemon does not serve "%s".\n' % ' '.join(argv))
+            result = 1
+        else:
+            result = self.run(connection, cwd, argv, env)
+
+        connection.sendall(struct.pack('>cI', b'r', 4) + struct.pack('>i', result))
+
+    def run(self, connection, cwd, argv, env):
+        """ Run one PyHg command as though it were started from the client """
+        saved = (os.getcwd(), dict(os.environ), sys.argv, sys.stdout, sys.stderr)
+
+        result = 255
+        try:
+            os.chdir(cwd)
+            os.environ.clear()
+            os.environ.update(env)
+            sys.argv = [PyHg.__file__] + argv
+            sys.stdout = ChannelWriter(connection, b'o')
+            sys.stderr = ChannelWriter(connection, b'e')
+
+            self.context.refresh()
+            try:
+                result = PyHg.main(self.context)
+            except SystemExit as e:
+                if e.code is None:
+                    result = 0
+                elif isinstance(e.code, int):
+                    result = e.code
+                else:
+                    print(e.code, file=sys.stderr)
+                    result = 1
+            except Exception:
+                traceback.print_exc()
+                result = 255
+        finally:
+            cwd, environ, sys.argv, sys.stdout, sys.stderr = saved
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+
+        return result
+
+if __name__ == "__main__":
+    if os.name != 'posix':
+        print('ERROR: The PyHg daemon requires Unix domain sockets.', file=sys.stderr)
+        sys.exit(1)
+
+    if (len(sys.argv) > 1) and (sys.argv[1] == '--stop'):
+        result = forward(['--stop'])
+        if result is None:
+            print('No PyHg daemon is listening on "%s".' % socket_path())
+            result = 0
+        sys.exit(result)
+
+    sys.exit(Daemon(socket_path()).serve())
@@ -31,20 +31,13 @@ Common routines used by the rest of the elements in the HG Suite.
 import sys
 import os
 import re
-import shutil
-import subprocess
-import struct
-import tempfile
-try:
-    import ConfigParser
-except ImportError:
-    import configparser as ConfigParser
-import tempfile
-import binascii
-import mimetypes
-
-if sys.version_info[0] < 3:
-    import codecs
+
+# (modules needed by only a few commands, such as ConfigParser, mimetypes,
+# multiprocessing, shutil and tempfile, are imported where they are used to
+# keep start-up quick)
+
+from HgClient import find_repository
+from HgQuery import StatusEntry, get_changesets
 
 LF=1
 CRLF=2
@@ -52,11 +45,12 @@ MANIFEST_VERSION=2
 
 # These are the extensions of common text-based files that we might encounter
 # when processing embedded commit comments.
-# (FYI: mimetypes.guess_type() will fail on some of these, even though they
-# are clearly text-based, so when it fails, we fall back to checking these
-# extensions manually)
+# files with these extensions are known to be text; any other file is
+# judged by its first few bytes.  (FYI: mimetypes.guess_type() fails on
+# some of these, even though they are clearly text-based, and the ones it
+# does know as 'text/plain' by default are included)
 
-__valid_extensions = [
+__valid_extensions = set([
                     '.h','.cpp','.c','.i','.xml','.y','.l',
                     '.mm','.htm','.html','.im', '.cfg', '.sln',
                     '.vcproj',
@@ -65,9 +59,13 @@ __valid_extensions = [
                     '.pl',                      # Perl
                     '.rst',                     # Sphinx
                     '.pro','.pri','.qrc','.ui', # Qt
-                    '.dart'                     # Flutter/Dart
-                    ]
-DISPLAY_PLAIN, DISPLAY_COMMENT, DISPLAY_ANSI, DISPLAY_HTML = range(0, 4)
+                    '.dart',                    # Flutter/Dart
+                    '.txt','.text','.bat','.ksh','.srt','.pot',
+                    ])
+
+# how much of a file is looked at to decide if it is text
+HEADER_SIZE = 1024
+DISPLAY_PLAIN, DISPLAY_COMMENT, DISPLAY_ANSI, DISPLAY_HTML, DISPLAY_RAW = range(0, 5)
 
 Colors = {
     'Reset'         : '\033[0m',
@@ -90,24 +88,39 @@ Colors = {
 __textchars = bytearray({7,8,9,10,12,13,27} | set(range(0x20, 0x100)) - {0x7f})
 __is_binary_string = lambda bytes: bool(bytes.translate(None, __textchars))
 
-class Changeset(object):
-    pass
-
 #--------------------------------------------
 # helper functions
 
-class MyParser(ConfigParser.ConfigParser):
+class MyParser(object):
+    # parsed files are remembered (until they change) for the benefit of
+    # long-lived processes
+    __parsed = {}
+
     def __init__(self, ini_file):
-        ConfigParser.ConfigParser.__init__(self)
-        if (type(ini_file) is str) and os.path.exists(ini_file):
-            self.read(ini_file)
+        self.ini_file = ini_file
 
     def as_dict(self):
-        d = dict(self._sections)
-        for k in d:
-            d[k] = dict(self._defaults, **d[k])
-            d[k].pop('__name__', None)
-        return d
+        key = None
+        if (type(self.ini_file) is str) and os.path.exists(self.ini_file):
+            st = os.stat(self.ini_file)
+            key = (os.path.abspath(self.ini_file), st.st_size, st.st_mtime)
+
+        if key not in MyParser.__parsed:
+            try:
+                import ConfigParser
+            except ImportError:
+                import configparser as ConfigParser
+            parser = ConfigParser.ConfigParser()
+            if key is not None:
+                parser.read(self.ini_file)
+            d = dict(parser._sections)
+            for k in d:
+                d[k] = dict(parser._defaults, **d[k])
+                d[k].pop('__name__', None)
+            MyParser.__parsed[key] = d
+
+        d = MyParser.__parsed[key]
+        return dict([(k, dict(d[k])) for k in d])
 
 def wrap_line(line, new_lines, col=80):
     while len(line) > col:
@@ -172,18 +185,18 @@ def wrap_lines(data, col=80):
 
     return new_lines
 
-def find_hg_root():
+def find_hg_root(context=None):
     """ Find the Mercurial .hg folder location """
-    with open(os.devnull, 'w') as f:
-        try:
-            root = subprocess.check_output(['hg', 'root'], stderr=f).decode("utf-8")
-            root = os.path.join(root.rstrip(), '.hg')
-        except:
-            root = None
+    if context is not None:
+        return context.hg_root()
+
+    root = find_repository(os.getcwd())
+    if root is not None:
+        root = os.path.join(root, '.hg')
 
     return root
 
-def find_mb_root():
+def find_mb_root(context=None):
     """ Find the microbranch root location """
     have_first_choice = False
     root = None
@@ -203,15 +216,11 @@ def find_mb_root():
 
     if not root:
         # choice #3: Mercurial folder of the working copy
-        with open(os.devnull, 'w') as f:
-            try:
-                root = subprocess.check_output(['hg', 'root'], stderr=f).decode("utf-8")
-                root = os.path.join(root.rstrip(), '.hg')
-            except:
-                root = None
+        root = find_hg_root(context)
 
     if not root:
         # last choice: System temp folder
+        import tempfile
         root = tempfile.gettempdir()
         if not os.path.exists(root):
             root = None
@@ -238,6 +247,7 @@ def determine_line_endings(file_name):
     return endings
 
 def fix_line_endings(from_name, to_name, endings):
+    import struct
     lines = open(from_name, 'r').readlines()
     with open(to_name, 'wb') as f:
         for line in lines:
@@ -316,107 +326,135 @@ def get_changeset_for(options, file):
         return None
 
     command = ['hg', 'log', '-l', '1', '-b', options.branch, file]
-    output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-    if len(output) == 0:
+    changesets = get_changesets(command)
+    if not changesets:
         # probably no changes for the current branch...use the latest change instead
         command = ['hg', 'log', '-l', '1', file]
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+        changesets = get_changesets(command)
 
     changeset = None
-    lines = output.split('\n')
-    for line in lines:
-        line = line.rstrip()
-        if line.startswith('changeset:   '):
-            changeset = line[13:].strip()
-            break
+    if changesets:
+        changeset = changesets[0].changeset
 
     return changeset
 
 def fixup_renames(lines):
     # this function assumes an 'hg status' was executed
     # with the '-C' option to identify the "source of
-    # copied files".
-    #
-    # if one is identified, it is either a copy or a
-    # rename.  if it's a rename, then the source file
-    # will no longer exist.
+    # copied files".  the text lines are converted into
+    # status records for fixup_status().
 
-    renames = {}
-    actions = {}
+    entries = []
+    for line in lines:
+        if len(line) == 0:
+            continue
+        if line[0] == ' ':
+            if len(entries) and (entries[-1].state == 'A'):
+                entries[-1].source = line[2:]
+        else:
+            entries.append(StatusEntry(line[0], line[2:]))
+
+    return fixup_status(entries)
+
+def fixup_status(entries):
+    # 'entries' are StatusEntry records from an 'hg status'
+    # executed with the '-C' option.  if an added file has
+    # a source, it is either a copy or a rename.  if it's a
+    # rename, then the source file will no longer exist.
+    return list(iter_fixup_status(entries))
+
+def iter_fixup_status(entries):
+    # fixup_status() as a generator: each line is produced as
+    # soon as it can be.  Mercurial lists entries by state
+    # (modified, added, removed, ...), so the adds with a
+    # source are held until the adds are done, when they can
+    # be sorted into renames (shown before the removes that
+    # they suppress) and copies (shown last).
+
+    renames = []
+    sources = {}
+    clean = []
+    copies = []
+
+    for entry in entries:
+        if (entry.state == 'A') and (entry.source is not None):
+            # this is a copy or a rename
+            renames.append((entry.source, entry.path))
+            sources[entry.source] = True
+            continue
 
-    previous_action = None
-    previous_value = None
+        if (renames is not None) and (entry.state not in ('M', 'A')):
+            for line in __resolve_renames(renames, copies):
+                yield line
+            renames = None
 
-    for i in range(len(lines)):
-        if len(lines[i]) == 0:
+        if (entry.state == 'R') and (entry.path in sources):
+            # this remove is part of a rename, so it
+            # needs to be suppressed
             continue
-        action = lines[i][0]
-        value = lines[i][2:]
-        if action == 'A':
-            if action not in actions:
-                actions[action] = []
-            actions[action].append((None,value))
-            previous_action = action
-            previous_value = value
-        elif action == ' ' and previous_action == 'A':
-            # this is a copy or a rename
+        elif entry.state in ('M', 'A', 'R'):
+            yield '%s %s' % (entry.state, entry.path)
+        elif entry.state == 'C':
+            clean.append('C %s' % entry.path)
 
-            renames[value] = previous_value
-            if 'A' in actions:
-                # remove the 'A'
-                for i in range(len(actions[previous_action])):
-                    if actions[previous_action][i][1] == previous_value:
-                        del actions[previous_action][i]
-                        break
-
-            previous_action = None
-            previous_value = None
-        elif action == 'R':
-            # if this remove is in the renames map,
-            # then it needs to be suppressed
-            if value not in renames:
-                # this is a remove, not a rename
-                if action not in actions:
-                    actions[action] = []
-                actions[action].append((None,value))
-        else:
-            # all other status changes are captured
-            # without additional processing
-            if action not in actions:
-                actions[action] = []
-            actions[action].append((None,value))
-
-    # process renames (all entries are 'A')
-    for source in renames:
+    if renames is not None:
+        for line in __resolve_renames(renames, copies):
+            yield line
+
+    for line in clean + copies:
+        yield line
+
+def __resolve_renames(renames, copies):
+    # yields the renames, and sets the copies aside
+    for source, target in renames:
         if os.path.exists(source):
             # copy
-            if 'C' not in actions:
-                actions['C'] = []
-            actions['C'].append((source,renames[source]))
+            copies.append('C %s ==> %s' % (source, target))
         else:
             # rename
-            if 'V' not in actions:
-                actions['V'] = []
-            actions['V'].append((source,renames[source]))
-
-    new_lines = []
-    for key in ['M',   # modified
-                'A',   # added
-                'V',   # renamed
-                'R',   # removed
-                'C']:  # copied
-        if key in actions:
-            for item in actions[key]:
-                if item[0] is None:
-                    new_lines.append('%s %s' % (key, item[1]))
-                elif key == 'V':
-                    new_lines.append('%s %s --> %s' % (key, item[0], item[1]))
-                elif key == 'C':
-                    new_lines.append('%s %s ==> %s' % (key, item[0], item[1]))
-
-    return new_lines
+            yield 'V %s --> %s' % (source, target)
+
+def parse_status_line(line):
+    """ Split a fixup_status() line into (state, path, source) """
+    state = line[:1]
+    path = line[2:]
+    source = None
+    if (state == 'V') and (' --> ' in path):
+        source, sep, path = path.partition(' --> ')
+    elif (state == 'C') and (' ==> ' in path):
+        source, sep, path = path.partition(' ==> ')
+    return (state, path, source)
+
+def emit_records(records, output_format):
+    """
+    Print records (dictionaries) for other programs to read, in place of
+    the usual colored output: 'json' prints them as a single array, and
+    'ndjson' prints each on a line of its own as soon as it is ready.
+    """
+    import json
+    if output_format == 'ndjson':
+        for record in records:
+            print(json.dumps(record))
+            sys.stdout.flush()
+    else:
+        print(json.dumps(list(records)))
+
+def index_status(lines):
+    """
+    Index the lines produced by fixup_status() by the path text that
+    follows the status code (which is what staging areas use as their
+    keys), so staged entries can be matched to status in a single lookup.
+    Maps each key to the position of its first line.
+    """
+    index = {}
+    for i, line in enumerate(lines):
+        key = line[2:].strip()
+        if key not in index:
+            index[key] = i
+    return index
 
 def crc32(filename):
+    import binascii
     buf = open(filename, 'rb').read()
     return (binascii.crc32(buf) & 0xFFFFFFFF)
     #return "%08X" % buf
@@ -448,100 +486,130 @@ def get_common_folder(files):
 
     return common_path
 
-def __pull_comments(lines, delete_comments=False, display_type=DISPLAY_PLAIN):
-    has_comments = False
+# any of the directive tokens; the lines it finds are then looked at whole
+__directive_re = re.compile(r'@(?:comment: |public: |private: |cleaner: |diff:)')
+
+# comment directives, in order of precedence, and how their text is shown
+__comment_tags = [
+                    ('@comment: ', '%s'),   # 'comment:' is 'private' by default
+                    ('@public: ', '[PUBLIC] %s'),
+                    ('@private: ', '[PRIVATE] %s'),
+                 ]
+
+def __trim_terminator(text, terminators=('*/', '-->')):
+    """ Drop a trailing comment terminator, and any spaces before it """
+    for terminator in terminators:
+        if text.endswith(terminator):
+            return text[:-len(terminator)].rstrip(' ')
+    return text
+
+def __next_line(content, end):
+    """ The line following the one ending at 'end' (rstripped), and where it ends """
+    start = end + 1
+    end = content.find('\n', start)
+    if end < 0:
+        end = len(content)
+    return (content[start:end].rstrip(), end)
+
+def __in_ranges(line_number, ranges):
+    for first, last in ranges:
+        if first <= line_number <= last:
+            return True
+    return False
+
+def __pull_comments(content, delete_comments=False, display_type=DISPLAY_PLAIN, ranges=None):
+    """
+    Gather the embedded comments from the text of a file.  A single pass
+    over the text finds the lines holding directives; only those lines
+    (and any lines they are continued on) are examined further.  Given
+    'ranges' ((first, last) line numbers), only directives on those lines
+    are gathered (or deleted).
+    """
     gen_diff = False
-    quiet = False
 
     comments = []
 
-    for i in range(len(lines)):
-        line = lines[i].rstrip()
+    # the spans of text (whole lines) that hold comments, for deletion
+    deleted = []
+    deleted_end = 0
 
-        if ('@comment: ' in line) or \
-           ('@public: ' in line) or \
-           ('@private: ' in line):
-            has_comments = True
-            comment_text = ''
+    line_number = 1
+    counted = 0
 
-            result = re.search('@comment: (.+)$', line)
-            if result != None:
-                # 'comment:' is 'private' by default
-                comment_text = result.group(1)
-            else:
-                result = re.search('@public: (.+)$', line)
-                if result != None:
-                    comment_text = '[PUBLIC] %s' % result.group(1)
-                else:
-                    result = re.search('@private: (.+)$', line)
-                    if result != None:
-                        comment_text = '[PRIVATE] %s' % result.group(1)
-
-            if len(comment_text):
-
-                # if it's multi-line, gather up the additional text
-                # additional comment text begins on each additional
-                # line after an '@' token
-
-                while comment_text.endswith('\\'):
-                    comment_text = comment_text[:-1]
-                    i += 1
-                    line = lines[i].rstrip()
-                    if line.endswith('*/'):
-                        index = -3
-                        if line[index] == ' ':
-                            while line[index] == ' ':
-                                index -= 1
-                        line = line[:index + 1]
-                    result = re.search('@(.+)$', line)
-                    if result:
-                        comment_text += result.group(1)
-
-                index = 0
-                if comment_text.endswith('*/'):
-                    index = -3
-                elif comment_text.endswith('-->'):
-                    index = -4
-                if index != 0:
-                    if comment_text[index] == ' ':
-                        while comment_text[index] == ' ':
-                            index -= 1
-                    comment_text = comment_text[:index + 1]
-
-                comments.append(comment_text)
+    line_end = -1
+    for match in __directive_re.finditer(content):
+        if match.start() < line_end:
+            continue    # another directive on a line already looked at
+
+        line_start = content.rfind('\n', 0, match.start()) + 1
+        line_end = content.find('\n', match.start())
+        if line_end < 0:
+            line_end = len(content)
+
+        if ranges is not None:
+            line_number += content.count('\n', counted, line_start)
+            counted = line_start
+            if not __in_ranges(line_number, ranges):
+                continue
+
+        line = content[line_start:line_end].rstrip()
+
+        comment_text = ''
+        for tag, form in __comment_tags:
+            index = line.find(tag)
+            if index >= 0:
+                comment_text = form % line[index + len(tag):]
+                break
+
+        if len(comment_text):
+
+            # if it's multi-line, gather up the additional text
+            # additional comment text begins on each additional
+            # line after an '@' token
+
+            end = line_end
+            while comment_text.endswith('\\') and (end < len(content)):
+                comment_text = comment_text[:-1]
+                next_line, end = __next_line(content, end)
+                next_line = __trim_terminator(next_line, ('*/',))
+                index = next_line.find('@')
+                if (index >= 0) and (index < len(next_line) - 1):
+                    comment_text += next_line[index + 1:]
+            if comment_text.endswith('\\'):
+                comment_text = comment_text[:-1]
+
+            comments.append(__trim_terminator(comment_text))
+
+            if delete_comments and (line_start >= deleted_end):
+                # the comment goes, along with every line it is continued on
+                end = line_end
+                while line.endswith('\\') and (end < len(content)):
+                    line, end = __next_line(content, end)
+                deleted_end = end + 1
+                deleted.append((line_start, deleted_end))
 
         elif '@cleaner: ' in line:
             # this line should be one or more directives that enable
             # processing actions for just this file.  display it along
             # with any other comments.
 
-            result = re.search('@cleaner: (.+)$', line)
-            if result != None:
-                cleaner_text = result.group(1)
-
-                # are we being told to be 'quiet' about this file?
-                if '(qt)' in cleaner_text:
-                    return ['@cleaner: (qt)']
+            cleaner_text = line[line.find('@cleaner: ') + 10:]
 
-                index = 0
-                if cleaner_text.endswith('*/'):
-                    index = -3
-                elif cleaner_text.endswith('-->'):
-                    index = -4
-                if index != 0:
-                    if cleaner_text[index] == ' ':
-                        while cleaner_text[index] == ' ':
-                            index -= 1
-                    cleaner_text = cleaner_text[:index + 1]
+            # are we being told to be 'quiet' about this file?
+            if '(qt)' in cleaner_text:
+                return ['@cleaner: (qt)']
 
-                comments.append('@cleaner: %s' % cleaner_text)
+            comments.append('@cleaner: %s' % __trim_terminator(cleaner_text))
 
         elif '@diff:' in line:
             gen_diff = True
 
     fixed_comments = []
     if len(comments):
-        if display_type == DISPLAY_COMMENT:
+        if display_type == DISPLAY_RAW:
+            # just the comments, as written (for other programs to format)
+            fixed_comments = list(comments)
+        elif display_type == DISPLAY_COMMENT:
             prefix = '- ' if len(comments) > 1 else ''
             for comment in comments:
                 fixed_comments.append('%s%s' % (prefix, comment))
@@ -606,57 +674,193 @@ def __pull_comments(lines, delete_comments=False, display_type=DISPLAY_PLAIN):
 
                     fixed_comments.append('%s%s%s' % (line_prefix, comment, line_postfix))
 
-    fixed_lines = []
+    fixed_text = ''
     if delete_comments:
-        i = 0
-        while i < len(lines):
-            line = lines[i].rstrip()
-            if ('@comment: ' in line) or \
-               ('@public: ' in line) or \
-               ('@private: ' in line):
-                if line.endswith('\\'):
-                    while line.endswith('\\'):
-                        i += 1
-                        line = lines[i].rstrip()
-            else:
-                fixed_lines.append(lines[i])
-            i += 1
+        kept = []
+        start = 0
+        for end, next_start in deleted:
+            kept.append(content[start:end])
+            start = next_start
+        kept.append(content[start:])
+        fixed_text = ''.join(kept)
 
-    return (fixed_lines, fixed_comments)
+    return (fixed_text, fixed_comments)
 
-def marshall_comments(filename, display=DISPLAY_PLAIN):
-    if not os.path.exists(filename):
-        raise Exception("The provided file ('%s') does not exist." % filename)
+# the directive tokens that can yield comments, searched for in a file's
+# raw bytes before anything is decoded
+__directive_bytes_re = re.compile(b'@(?:comment|public|private|cleaner): ')
 
-    lines = []
+def __decode(data):
     if sys.version_info[0] < 3:
+        return data.decode('utf-8', 'replace')
+    return data.decode('utf-8', 'backslashreplace')
+
+def __trailing_backslashes(text):
+    return len(text) - len(text.rstrip('\\'))
+
+def __region_end(data, start):
+    """
+    Where the region that starts with the directive line at 'start' ends:
+    after every line that __pull_comments() could take as part of a
+    directive in it (as continued text, or for deletion).
+    """
+    # for each directive line still being continued: the backslashes
+    # still to be taken as continuations, and whether it is still being
+    # continued for deletion
+    continued = []
+
+    end = start
+    while end < len(data):
+        line_end = data.find(b'\n', end)
+        line_end = len(data) if line_end < 0 else line_end + 1
+
+        # (a lone CR ends a line, too, once decoded)
+        text = __decode(data[end:line_end]).replace('\r\n', '\n').replace('\r', '\n')
+        lines = text.split('\n')
+        if text.endswith('\n'):
+            lines.pop()
+        end = line_end
+
+        for line in lines:
+            line = line.rstrip()
+
+            following = []
+            for pending, deleting in continued:
+                deleting = deleting and line.endswith('\\')
+                if pending > 0:
+                    pending -= 1
+                    trimmed = __trim_terminator(line, ('*/',))
+                    index = trimmed.find('@')
+                    if (index >= 0) and (index < len(trimmed) - 1):
+                        added = trimmed[index + 1:]
+                        count = __trailing_backslashes(added)
+                        pending = (pending + count) if count == len(added) else count
+                if (pending > 0) or deleting:
+                    following.append((pending, deleting))
+            continued = following
+
+            if __directive_re.search(line):
+                continued.append((__trailing_backslashes(line), line.endswith('\\')))
+
+        if len(continued) == 0:
+            break
+
+    return end
+
+def __find_regions(data, ranges=None):
+    """
+    The parts of a file's contents ('data', as bytes or memory-mapped) that
+    hold comment directives: a list of (line number, bytes) pairs, each one
+    the whole line holding a directive along with any lines it is continued
+    on.  Given 'ranges', only directives on those lines are looked for
+    (line numbers are only counted then, and are otherwise 0).
+    """
+    regions = []
+
+    line_number = 1
+    counted = 0
+
+    end = 0
+    for match in __directive_bytes_re.finditer(data):
+        if match.start() < end:
+            continue    # already part of a region
+        start = data.rfind(b'\n', 0, match.start()) + 1
+        if ranges is not None:
+            line_number += data[counted:start].count(b'\n')
+            counted = start
+            if not __in_ranges(line_number, ranges):
+                continue
+        end = __region_end(data, start)
+        regions.append((line_number if ranges is not None else 0, data[start:end]))
+
+    return regions
+
+def __directive_regions(filename, ranges=None, check_text=False):
+    """
+    The regions of a file that hold comment directives (see
+    __find_regions()).  The file is memory-mapped and searched as bytes, so
+    one without any directives costs a single search, and is never read in
+    whole or decoded.  With 'check_text', a file that turns out not to be
+    text (see is_valid()) has none.
+    """
+    import mmap
+
+    with open(filename, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            return []
         try:
-            with codecs.open(filename, encoding='utf-8', errors='backslashreplace') as f:
-                for l in f:
-                    lines.append(l)
-        except:
-            raise Exception("Failed to read file '%s'" % filename)
-    else:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            data = f.read()
+
         try:
-            with open(filename, encoding='utf-8', errors='backslashreplace') as f:
-                for l in f:
-                    lines.append(l)
-        except:
-            raise Exception("Failed to read file '%s'" % filename)
+            if check_text and not __remember_text(filename, data[:HEADER_SIZE], st):
+                return []
+            return __find_regions(data, ranges)
+        finally:
+            if not isinstance(data, bytes):
+                data.close()
+
+def marshall_comments(filename, display=DISPLAY_PLAIN, ranges=None, check_text=False):
+    if not os.path.exists(filename):
+        raise Exception("The provided file ('%s') does not exist." % filename)
+
+    try:
+        regions = __directive_regions(filename, ranges, check_text)
+    except:
+        raise Exception("Failed to read file '%s'" % filename)
+    if len(regions) == 0:
+        return []
 
-    fixed_lines, comments = __pull_comments(lines, display_type=display)
+    # only the lines holding directives are decoded and parsed
+    text = __decode(b''.join([region for line_number, region in regions])).replace('\r\n', '\n').replace('\r', '\n')
+
+    # the ranges, renumbered for the lines of the regions
+    region_ranges = None
+    if ranges is not None:
+        region_ranges = []
+        offset = 0
+        for line_number, region in regions:
+            count = region.count(b'\n') + (0 if region.endswith(b'\n') else 1)
+            for first, last in ranges:
+                first = max(first, line_number)
+                last = min(last, line_number + count - 1)
+                if first <= last:
+                    region_ranges.append((first - line_number + offset + 1, last - line_number + offset + 1))
+            offset += count
+
+    fixed_text, comments = __pull_comments(text, display_type=display, ranges=region_ranges)
 
     return comments
 
-def extract_comments(filename, display=DISPLAY_PLAIN):
+def extract_comments(filename, display=DISPLAY_PLAIN, ranges=None, check_text=False):
     if not os.path.exists(filename):
         raise Exception("The provided file ('%s') does not exist." % filename)
 
+    # the file is read just once; its contents serve for the search, the
+    # backup and the text to be rewritten
     try:
-        lines = []
-        with open(filename) as f:
-            for line in f:
-                lines.append(line)
+        with open(filename, 'rb') as f:
+            data = f.read()
+            st = os.fstat(f.fileno())
+    except:
+        raise Exception("Failed to read file '%s'" % filename)
+
+    # a file without directives is left as it is
+    if check_text and not __remember_text(filename, data[:HEADER_SIZE], st):
+        return []
+    if len(__find_regions(data, ranges)) == 0:
+        return []
+
+    try:
+        if sys.version_info[0] < 3:
+            text = data.replace('\r\n', '\n').replace('\r', '\n')
+        else:
+            # decoded as open() would (the locale's encoding, and any line
+            # ending read as '\n')
+            import io
+            text = io.TextIOWrapper(io.BytesIO(data)).read()
     except:
         raise Exception("Failed to read file '%s'" % filename)
 
@@ -667,34 +871,127 @@ def extract_comments(filename, display=DISPLAY_PLAIN):
             raise Exception("Failed to remove file '%s.ht'" % filename)
 
     try:
-        shutil.copyfile(filename, '%s.ht' % filename)
+        with open('%s.ht' % filename, 'wb') as f:
+            f.write(data)
     except:
         raise Exception("Failed to create backup of '%s'" % filename)
 
-    fixed_lines, comments = __pull_comments(lines, delete_comments=True, display_type=display)
+    fixed_text, comments = __pull_comments(text, delete_comments=True, display_type=display, ranges=ranges)
 
     try:
-        open(filename, 'w').write(''.join(fixed_lines))
+        open(filename, 'w').write(fixed_text)
     except:
         raise Exception("Failed to write to file '%s'" % filename)
 
     return comments
 
+# below this many files, starting worker processes costs more than it saves
+MIN_PARALLEL_SCAN = 64
+
+def get_scan_jobs():
+    """ The number of processes scan_files() may use (PYHG_SCAN_JOBS, or one per processor) """
+    if 'PYHG_SCAN_JOBS' in os.environ:
+        try:
+            return max(1, int(os.environ['PYHG_SCAN_JOBS']))
+        except ValueError:
+            pass
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def __scan_file(args):
+    filename, display, delete_comments, ranges = args
+    try:
+        # a file not known to be text is judged as it is scanned, from
+        # what is read of it anyway
+        is_text = known_text(filename)
+        if is_text is False:
+            return ([], None)
+        check_text = is_text is None
+
+        if delete_comments:
+            return (extract_comments(filename, display=display, ranges=ranges, check_text=check_text), None)
+        return (marshall_comments(filename, display=display, ranges=ranges, check_text=check_text), None)
+    except Exception as e:
+        return (None, str(e))
+
+def scan_files(filenames, display=DISPLAY_PLAIN, delete_comments=False, jobs=None, ranges=None):
+    """
+    Gather the embedded comments of many files at once (with
+    extract_comments() if 'delete_comments' is set, otherwise with
+    marshall_comments()); files that are not text have none (see
+    is_valid()), but need not be left out beforehand, since they are judged
+    from what is read of them for the scan.  Scanning is spread over a pool
+    of worker processes when there are enough files to make that worthwhile.
+    'ranges' may map a file to the only lines of it to look at (see
+    get_changed_lines() in HgQuery); other files are scanned whole.
+    Returns a (comments, error) pair for each file, in the order given.
+    """
+    ranges = ranges or {}
+    work = [(filename, display, delete_comments, ranges.get(filename, None)) for filename in filenames]
+
+    jobs = get_scan_jobs() if jobs is None else jobs
+    jobs = min(jobs, len(work) // (MIN_PARALLEL_SCAN // 2) or 1)
+    if jobs > 1:
+        try:
+            import multiprocessing
+            # a worker process of some other pool may not have children
+            if multiprocessing.current_process().daemon:
+                pool = None
+            else:
+                pool = multiprocessing.Pool(jobs)
+        except Exception:
+            # whatever keeps a pool from starting, the files can still be
+            # scanned here
+            pool = None
+        if pool is not None:
+            try:
+                return pool.map(__scan_file, work, max(1, len(work) // (jobs * 4)))
+            finally:
+                pool.close()
+                pool.join()
+
+    return [__scan_file(args) for args in work]
+
+# files judged by their first bytes: path -> (signature, is text)
+__text_files = {}
+
+def __signature(st):
+    return (st.st_size, getattr(st, 'st_mtime_ns', st.st_mtime), st.st_ino)
+
+def __remember_text(filename, header, st):
+    """ Judge a file by its first bytes, remembering the verdict for as long as the file is unchanged """
+    is_text = not __is_binary_string(header)
+    __text_files[os.path.abspath(filename)] = (__signature(st), is_text)
+    return is_text
+
+def known_text(filename):
+    """
+    Whether a file is text, if that can be told without opening it: by its
+    extension, or from an earlier look at it as it is now.  Returns None
+    if its first bytes still have to be looked at.
+    """
+    if os.path.splitext(filename)[1] in __valid_extensions:
+        return True
+    path = os.path.abspath(filename)
+    if path in __text_files:
+        signature, is_text = __text_files[path]
+        try:
+            if __signature(os.stat(path)) == signature:
+                return is_text
+        except OSError:
+            pass
+    return None
+
 def is_valid(filename):
-    _is_valid = False
-    # 1. try the quickest test first: known file extensions
-    for ext in __valid_extensions:
-        if filename.endswith(ext):
-            _is_valid = True
-            break
-    if not _is_valid:
-        # 2. see if mimetypes has any luck
-        types = mimetypes.guess_type(filename)
-        _is_valid = (types[0] == 'text/plain')
-    if not _is_valid:
-        # 3. last, brute force
-        _is_valid = not __is_binary_string(open(filename, 'rb').read(1024))
-    return _is_valid
+    """ Whether a file is text (and so may hold embedded comments); it is only opened if that has to be looked at """
+    is_text = known_text(filename)
+    if is_text is None:
+        with open(filename, 'rb') as f:
+            is_text = __remember_text(filename, f.read(HEADER_SIZE), os.fstat(f.fileno()))
+    return is_text
 
 ONEYEAR   = 31536000
 ONEMONTH  = 2592000
@@ -27,14 +27,15 @@ from __future__ import print_function
 import sys
 import os
 import time
-import subprocess
 
+from HgClient import hg_output
+from HgQuery import quote_revset
 from Incoming import Incoming
 
 #--------------------------------------------
 
 class Rebase(object):
-    def __init__(self, options):
+    def __init__(self, options, context):
         if not options.branch:
             return
 
@@ -43,7 +44,7 @@ class Rebase(object):
             sys.exit(1)
 
         command = ['hg', 'status', '-q', '.']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+        output = hg_output(command)
         if len(output):
             print("ERROR: Working copy has uncommittted modifications", file=sys.stderr)
             sys.exit(1)
@@ -58,18 +59,20 @@ class Rebase(object):
             if (len(approval) == 0) or (approval.lower() == 'n'):
                 return
 
-        incoming = Incoming(options, command=['hg', 'merge', '-P', '-v', options.source_branch], database=True, ignore_branch=True)
+        # the changesets a merge would bring in (i.e., 'hg merge --preview')
+        command = ['hg', 'log', '-v', '-r', 'only(%s, .)' % quote_revset(options.source_branch)]
+        incoming = Incoming(options, context, command=command, database=True, ignore_branch=True)
 
         if len(incoming.changesets) > 0:
             log_text = incoming.format(Incoming.STYLE_PLAIN)
             command = ['hg', 'merge', options.source_branch]
-            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+            output = hg_output(command, interactive=True)  # merge tools may need the terminal
             if not options.merge_only:
                 msg = 'rebase with %s' % options.source_branch
                 if hasattr(options, 'auth_token') and (options.auth_token is not None):
                     msg += ' (%s)' % options.auth_token
                 command = ['hg', 'commit', '-m', msg]
-                output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+                output = hg_output(command)
 
                 open('sync.txt', 'a').write('\n--[ REBASE ]--------------\n%s\n\n%s\n' % \
                              (time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime()),\
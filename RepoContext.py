@@ -0,0 +1,261 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+A RepoContext holds the facts about the working copy that many commands need
+(its root, its branch, the output of 'hg status', the contents of the
+staging areas, and the cache of embedded comments).  Each one is computed on
+first use and then remembered for the life of the process, so that one
+command never has to ask Mercurial the same question twice.
+
+Because some commands walk several working copies ('--process-all'), facts
+are keyed by the directory they were gathered from.  Commands that modify the
+working copy should call invalidate() so later queries see the changes.
+
+A context may also outlive a single command (see PyHg_daemon.py), in which
+case refresh() is called between commands.  A long-lived context can also be
+asked to watch its working copies (see Watcher.py): each 'hg status' is then
+answered from the previous one, with only the paths that have changed since
+being checked again.
+"""
+
+import sys
+import os
+
+from HgClient import find_repository
+from HgQuery import get_status, get_file_status, iter_status
+from Watcher import Watcher, covers
+
+# the order in which 'hg status' lists its entries
+STATUS_ORDER = 'MAR!?IC'
+
+#--------------------------------------------
+
+class RepoContext(object):
+    def __init__(self, watch=False):
+        self.__watch = watch
+        self.__watchers = {}
+        self.__baselines = {}
+        self.__roots = {}
+        self.__branches = {}
+        self.__status = {}
+        self.__stage_dbs = {}
+        self.__staged_entries = {}
+        self.__signatures = {}
+        self.__comment_caches = {}
+
+    def root(self, cwd=None):
+        """ The top folder of the working copy containing 'cwd' (or None) """
+        cwd = os.path.abspath(cwd or os.getcwd())
+        if cwd not in self.__roots:
+            # found the way Mercurial finds it, without the cost of asking
+            root = find_repository(cwd)
+            self.__roots[cwd] = root
+            if (root is not None) and (root not in self.__signatures):
+                self.__signatures[root] = self.__signature(root)
+        return self.__roots[cwd]
+
+    def hg_root(self, cwd=None):
+        """ The Mercurial .hg folder of the working copy containing 'cwd' (or None) """
+        root = self.root(cwd)
+        if root is None:
+            return None
+        return os.path.join(root, '.hg')
+
+    def branch(self, cwd=None):
+        """ The current branch of the working copy containing 'cwd' (or None) """
+        root = self.root(cwd)
+        if root is None:
+            return None
+        if root not in self.__branches:
+            # Mercurial keeps it in .hg/branch; a missing (or empty) file
+            # means the working copy is on 'default'
+            branch = b''
+            try:
+                with open(os.path.join(root, '.hg', 'branch'), 'rb') as f:
+                    branch = f.read().strip()
+            except (IOError, OSError):
+                pass
+            if sys.version_info[0] > 2:
+                branch = branch.decode('utf-8', 'replace')
+            self.__branches[root] = branch or 'default'
+        return self.__branches[root]
+
+    def status(self, command, cwd=None):
+        """ StatusEntry records for an 'hg status' command run from 'cwd' """
+        cwd = os.path.abspath(cwd or os.getcwd())
+        key = (cwd, tuple(command))
+        if key not in self.__status:
+            if self.__watch:
+                self.__status[key] = self.__watched_status(command, cwd, key)
+            else:
+                self.__status[key] = get_status(command, cwd=cwd)
+        return list(self.__status[key])
+
+    def iter_status(self, command, cwd=None):
+        """
+        As status(), but when the answer is not already known, entries are
+        yielded as Mercurial reports them (and remembered once all are in).
+        """
+        cwd = os.path.abspath(cwd or os.getcwd())
+        key = (cwd, tuple(command))
+        if (key in self.__status) or self.__watch:
+            for entry in self.status(command, cwd):
+                yield entry
+            return
+
+        entries = []
+        for entry in iter_status(command, cwd=cwd):
+            entries.append(entry)
+            yield entry
+        self.__status[key] = entries
+
+    def get_stage_db(self, stage_db_file):
+        """ A previously loaded staging database, or None """
+        return self.__stage_dbs.get(os.path.abspath(stage_db_file), None)
+
+    def set_stage_db(self, stage_db_file, stage_db):
+        self.__stage_dbs[os.path.abspath(stage_db_file)] = stage_db
+        self.__staged_entries.clear()
+
+    def get_staged_entries(self, stage_path, stage_name):
+        """ A previously gathered staging-area listing, or None """
+        return self.__staged_entries.get((os.path.abspath(stage_path), stage_name), None)
+
+    def set_staged_entries(self, stage_path, stage_name, staged_entries):
+        self.__staged_entries[(os.path.abspath(stage_path), stage_name)] = staged_entries
+
+    def comment_cache(self, cwd=None):
+        """ The CommentCache of the working copy containing 'cwd' (or None) """
+        hg_root = self.hg_root(cwd)
+        if hg_root is None:
+            return None
+        if hg_root not in self.__comment_caches:
+            # entries are checked against each file, so nothing a change to
+            # the working copy does can make them stale
+            from CommentCache import CommentCache
+            self.__comment_caches[hg_root] = CommentCache(hg_root)
+        return self.__comment_caches[hg_root]
+
+    def invalidate(self):
+        """ Forget everything that a change to the working copy could affect """
+        self.__branches.clear()
+        self.__status.clear()
+        self.__stage_dbs.clear()
+        self.__staged_entries.clear()
+        self.__signatures.clear()
+        self.__baselines.clear()
+
+    def refresh(self):
+        """
+        Ready a long-lived context for another command.  Files in the working
+        copy may have been edited in the meantime, so status (and anything
+        built from it) is always gathered afresh; the rest is kept unless the
+        repository's dirstate, branch or staging areas have changed.
+        """
+        self.__roots.clear()
+        self.__status.clear()
+        self.__staged_entries.clear()
+        for root in self.__signatures:
+            if self.__signature(root) != self.__signatures[root]:
+                self.invalidate()
+                break
+
+    def close(self):
+        """ Stop watching working copies """
+        for watcher in self.__watchers.values():
+            if watcher is not None:
+                watcher.close()
+        self.__watchers.clear()
+        self.__baselines.clear()
+
+    def __watcher(self, root):
+        if root not in self.__watchers:
+            watcher = Watcher(root)
+            self.__watchers[root] = watcher if watcher.start() else None
+        return self.__watchers[root]
+
+    def __watched_status(self, command, cwd, key):
+        """
+        Status built from the last full 'hg status' for the same command,
+        re-checking only the paths that the watcher has seen change since.
+        Only commands scoped to the current folder ('.') are handled this
+        way; anything else, or any doubt, means a full 'hg status'.
+        """
+        root = self.root(cwd)
+        watcher = None if root is None else self.__watcher(root)
+        if (watcher is None) or (command[-1] != '.'):
+            return get_status(command, cwd=cwd)
+
+        # changes are shared out to every baseline taken in this working copy
+        changed = watcher.changes()
+        for baseline_key, (entries, pending) in list(self.__baselines.items()):
+            if baseline_key[0] == root:
+                if changed is None:
+                    del self.__baselines[baseline_key]
+                else:
+                    pending.update(changed)
+
+        baseline_key = (root, key)
+        folder = os.path.relpath(cwd, root).replace(os.sep, '/')
+        folder = '' if folder == '.' else folder
+        if (baseline_key not in self.__baselines) or covers(self.__baselines[baseline_key][1], folder):
+            entries = get_status(command, cwd=cwd)
+        else:
+            entries, pending = self.__baselines[baseline_key]
+            if len(folder):
+                pending = [path for path in pending if (path + '/').startswith(folder + '/')]
+            if len(pending):
+                pending = set(pending)
+                # entries are relative to 'cwd', the watcher's paths to the root
+                prefix = folder + '/' if len(folder) else ''
+                entries = [entry for entry in entries if not covers(pending, prefix + entry.path.replace(os.sep, '/'))]
+                entries += get_file_status(command[:-1],
+                                           [os.path.join(root, path) for path in sorted(pending)],
+                                           cwd=cwd)
+                entries.sort(key=lambda entry: (STATUS_ORDER.find(entry.state), entry.path))
+
+        self.__baselines[baseline_key] = (entries, set())
+        return entries
+
+    def __signature(self, root):
+        """ Sizes and timestamps of the files whose change invalidates the context """
+        hg = os.path.join(root, '.hg')
+        paths = [os.path.join(hg, 'dirstate'), os.path.join(hg, 'branch'), os.path.join(hg, 'stage')]
+        try:
+            for stage_name in sorted(os.listdir(paths[-1])):
+                paths.append(os.path.join(paths[-1], stage_name, 'stage.db'))
+        except OSError:
+            pass
+
+        signature = []
+        for path in paths:
+            try:
+                st = os.stat(path)
+                signature.append((path, st.st_size, st.st_mtime))
+            except OSError:
+                signature.append((path, None, None))
+        return signature
@@ -0,0 +1,137 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Times the scanning of files for embedded comments (@comment, @public,
+@private, ...) on generated source files of various sizes, against the
+line-by-line scan it replaced:
+
+    python ScanTime.py [--lines N ...] [--repeat R]
+
+By default, 10,000- and 100,000-line files are timed.
+"""
+
+import sys
+import os
+import re
+import time
+import shutil
+import tempfile
+
+from argparse import ArgumentParser
+
+#--------------------------------------------
+
+SOURCE_LINES = [
+    'int compute(int value)\n',
+    '{\n',
+    '    // scale the value before it is used\n',
+    '    return value * 2 + offset;   /* email: someone@example.com */\n',
+    '}\n',
+    '\n',
+    '    if (total > limit) { total = limit; }\n',
+    '#include "common.h"\n',
+]
+
+DIRECTIVE_LINES = [
+    '    // @comment: Scaling is now done before the value is stored.\n',
+    '    /* @public: Added the compute() entry point. */\n',
+    '    # @private: Keep this in step with the loader \\\n',
+    '    #    @ until the loader is rewritten.\n',
+    '    <!-- @cleaner: (nf) -->\n',
+]
+
+def generate(filename, line_count, every=1000):
+    """ Writes a source file of 'line_count' lines, with directives every so often """
+    with open(filename, 'w') as f:
+        for i in range(line_count):
+            if (i % every) == 0:
+                f.write(DIRECTIVE_LINES[(i // every) % len(DIRECTIVE_LINES)])
+            else:
+                f.write(SOURCE_LINES[i % len(SOURCE_LINES)])
+
+def line_scan(filename):
+    """ The previous scan: every line is tested, and matched with uncompiled patterns """
+    with open(filename) as f:
+        lines = f.readlines()
+    comments = []
+    for i in range(len(lines)):
+        line = lines[i].rstrip()
+        if ('@comment: ' in line) or ('@public: ' in line) or ('@private: ' in line):
+            result = re.search('@comment: (.+)$', line)
+            if result is None:
+                result = re.search('@public: (.+)$', line)
+            if result is None:
+                result = re.search('@private: (.+)$', line)
+            if result is not None:
+                comment_text = result.group(1)
+                while comment_text.endswith('\\') and (i + 1 < len(lines)):
+                    comment_text = comment_text[:-1]
+                    i += 1
+                    result = re.search('@(.+)$', lines[i].rstrip())
+                    if result:
+                        comment_text += result.group(1)
+                comments.append(comment_text)
+        elif '@cleaner: ' in line:
+            result = re.search('@cleaner: (.+)$', line)
+            if result is not None:
+                comments.append(result.group(1))
+        elif '@diff:' in line:
+            pass
+    return comments
+
+def best_of(repeat, function, *args):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function(*args)
+        elapsed = time.time() - start
+        if (best is None) or (elapsed < best):
+            best = elapsed
+    return best
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Hg Suite comment scanning times", prog='ScanTime')
+    parser.add_argument("-l", "--lines", dest="lines", type=int, action='append', help="The size of file (in lines) to time; may be repeated.")
+    parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=5, help="Time each scan this many times, and report the best.")
+    options = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from PyHg_lib import marshall_comments, DISPLAY_RAW
+
+    folder = tempfile.mkdtemp(prefix='pyhg-scan-')
+    try:
+        print('%10s %12s %12s %8s' % ('lines', 'line scan', 'scanner', 'speedup'))
+        for line_count in (options.lines or [10000, 100000]):
+            filename = os.path.join(folder, 'source_%d.cpp' % line_count)
+            generate(filename, line_count)
+
+            before = best_of(options.repeat, line_scan, filename)
+            after = best_of(options.repeat, marshall_comments, filename, DISPLAY_RAW)
+
+            print('%10d %10.2fms %10.2fms %7.1fx' % (line_count, before * 1000.0, after * 1000.0, before / max(after, 1e-9)))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
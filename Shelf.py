@@ -53,23 +53,56 @@ import tempfile
 import subprocess
 
 from Action import Action
+from HgClient import hg_output, hg_batch
 from PyHg_lib import MANIFEST_VERSION, \
                      colorize_status, \
                      get_changeset_for, \
                      find_hg_root, \
                      find_mb_root, \
-                     fixup_renames, \
+                     fixup_status, \
+                     emit_records, \
                      determine_line_endings, \
                      fix_line_endings, \
                      make_path, \
                      crc32
-from Commit import StageEntry, StageIO
+from Stage import StageEntry, StageIO
 
 #--------------------------------------------
 
+# parsed manifests are remembered (until they change) for the benefit of
+# long-lived processes
+__manifests = {}
+
+def read_manifest(manifest_name):
+    """ Returns (version, comment, lines) from a microbranch manifest file """
+    st = os.stat(manifest_name)
+    key = (os.path.abspath(manifest_name), st.st_size, st.st_mtime)
+    if key not in __manifests:
+        manifest_version = 0
+        manifest_lines = open(manifest_name).readlines()
+        if manifest_lines[0].startswith('version '):
+            manifest_version = int(manifest_lines[0][8:])
+            del manifest_lines[0]
+        manifest_comment = manifest_lines[0].rstrip()
+        del manifest_lines[0]
+        __manifests[key] = (manifest_version, manifest_comment, manifest_lines)
+
+    manifest_version, manifest_comment, manifest_lines = __manifests[key]
+    return (manifest_version, manifest_comment, list(manifest_lines))
+
+def describe_failures(message, failures):
+    """ Format the 'failures' from an hg_batch() call, one file at a time """
+    lines = []
+    for file_name in failures:
+        if file_name is None:
+            lines.append('%s:\n%s' % (message, '\n'.join(failures[file_name])))
+        else:
+            lines.append('%s "%s":\n%s' % (message, file_name, '\n'.join(failures[file_name])))
+    return '\n'.join(lines)
+
 class Shelve(Action):
-    def __init__(self):
-        super(Shelve, self).__init__()
+    def __init__(self, context=None):
+        super(Shelve, self).__init__(context)
 
     def execute(self, options, quiet=False, **kwargs):
         if not options.branch:
@@ -78,12 +111,12 @@ class Shelve(Action):
 
         working_dir = os.getcwd()
 
-        root = find_hg_root()
+        root = find_hg_root(self.context)
         if root:
             os.chdir(root)
             os.chdir("..")
 
-        stage_path = StageIO().get_staging_root(root, options)
+        stage_path = StageIO(self.context).get_staging_root(root, options)
         if os.path.exists(stage_path):
             stages = os.listdir(stage_path)
             stage_path = os.path.join(".hg", "stage") if len(stages) != 0 else None
@@ -99,9 +132,9 @@ class Shelve(Action):
         if (options.include_filter is None) and (len(options.exclude_filter) == 0):
             command.append(options.use_path)
 
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        if len(output) > 0:
-            lines = fixup_renames(output.split('\n'))
+        entries = self.context.status(command)
+        if len(entries) > 0:
+            lines = fixup_status(entries)
 
             shelf_name = 'shelf'
             if len(options.shelf_name) != 0:
@@ -112,7 +145,7 @@ class Shelve(Action):
             if 'mb_root' in kwargs:
                 root = kwargs['mb_root']
             else:
-                root = find_mb_root()   # this will not return if we can't find a working location
+                root = find_mb_root(self.context)   # this will not return if we can't find a working location
 
             manifest_version = 0
             manifest = []
@@ -218,21 +251,27 @@ class Shelve(Action):
             os.remove('%s.list' % shelf_name)
 
             if (options.include_filter is not None) or len(options.exclude_filter):
+                revert_files = []
                 for line in manifest:
                     action = line[0]
                     filename = line[2:]
                     if action == 'V':
                         filename =  line[2:].split(',')[1]
-                    command = ['hg', 'revert', filename]
-                    output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+                    revert_files.append(filename)
+                returncode, failures = hg_batch(['hg', 'revert'], revert_files)
+                if len(failures):
+                    print(describe_failures('WARNING: Failed to revert file', failures), file=sys.stderr)
             elif not options.no_revert:
                 command = ['hg', 'revert', '--all']
                 if options.use_path != '.':
                     command.append(options.use_path)
-                output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+                output = hg_output(command)
                 if stage_path is not None:
                     shutil.rmtree(stage_path)   # remove current staging metadata
 
+            # the working copy has changed underneath the context
+            self.context.invalidate()
+
             with open(manifest_name, 'w') as f:
                 f.write('version %d\n' % MANIFEST_VERSION)
                 f.write('%s\n' % manifest_comment)
@@ -306,19 +345,19 @@ It displays the currently archived microbranches within the working directory.
 """
 
 class Shelved(Action):
-    def __init__(self):
-        super(Shelved, self).__init__()
+    def __init__(self, context=None):
+        super(Shelved, self).__init__(context)
 
     def execute(self, options, quiet=False, **kwargs):
         working_dir = os.getcwd()
 
-        root = find_hg_root()
+        root = find_hg_root(self.context)
         if root:
             # set working directory to the top of the working copy
             os.chdir(root)
             os.chdir("..")
 
-        root = find_mb_root()   # this will not return if we can't find a working location
+        root = find_mb_root(self.context)   # this will not return if we can't find a working location
 
         shelf_name = None
         if len(options.shelf_name) != 0:
@@ -326,7 +365,21 @@ class Shelved(Action):
 
         import glob
         files = glob.glob(os.path.join(root,'*.manifest'))
-        if len(files) == 0:
+        if options.output_format != 'text':
+            records = []
+            for file in sorted(files):
+                microbranch_name = os.path.basename(file).split('.')[0]
+                if shelf_name and shelf_name != microbranch_name:
+                    continue
+                manifest_version, manifest_comment, manifest_lines = read_manifest(file)
+                changes = []
+                for line in manifest_lines:
+                    items = line.rstrip().split('?')
+                    changes.append({'state' : items[0], 'path' : items[1], 'key' : items[2] if len(items) > 2 else None})
+                records.append({'name' : microbranch_name, 'comment' : manifest_comment, 'version' : manifest_version, 'changes' : changes})
+            if not quiet:
+                emit_records(records, options.output_format)
+        elif len(files) == 0:
             if not quiet:
                 print('No microbranches are currently shelved.')
         else:
@@ -343,16 +396,7 @@ class Shelved(Action):
                     if not quiet:
                         print('Microbranch "%s" caches the following changes:' % options.args[0])
 
-                manifest_file = file
-                manifest_lines = open(manifest_file).readlines()
-                if manifest_lines[0].startswith('version '):
-                    manifest_version = int(manifest_lines[0][8:])
-                    del manifest_lines[0]
-                    if manifest_version == 1:
-                        manifest_comment = manifest_lines[0].rstrip()
-                else:
-                    manifest_comment = manifest_lines[0].rstrip()
-                del manifest_lines[0]
+                manifest_version, manifest_comment, manifest_lines = read_manifest(file)
 
                 if not quiet:
                     if len(manifest_comment):
@@ -383,8 +427,8 @@ target file).
 """
 
 class Restore(Action):
-    def __init__(self):
-        super(Restore, self).__init__()
+    def __init__(self, context=None):
+        super(Restore, self).__init__(context)
 
         self.mb_root = None
 
@@ -407,7 +451,7 @@ class Restore(Action):
 
         working_dir = os.getcwd()
 
-        root = find_hg_root()
+        root = find_hg_root(self.context)
         if root:
             os.chdir(root)
             os.chdir("..")
@@ -420,7 +464,7 @@ class Restore(Action):
         if 'mb_root' in kwargs:
             self.mb_root = kwargs['mb_root']
         else:
-            self.mb_root = find_mb_root()   # this will not return if we can't find a working location
+            self.mb_root = find_mb_root(self.context)   # this will not return if we can't find a working location
 
         if not os.path.exists(os.path.join(self.mb_root, '%s.manifest' % shelf_name)):
             os.chdir(working_dir)
@@ -428,8 +472,7 @@ class Restore(Action):
             return False
 
         command = ['hg', 'status', '-q', '.']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        if len(output) != 0:
+        if len(self.context.status(command)) != 0:
             os.chdir(working_dir)
             self.message = 'Cannot restore into pending changes.'
             return False
@@ -470,7 +513,7 @@ class Restore(Action):
         # does this archive contain any staging areas?  it won't be in the
         # archive unless it has staging areas
         shelved_stage = os.path.join(working_folder, '.hg', 'stage')
-        stage_path = StageIO().get_staging_root(root, options)
+        stage_path = StageIO(self.context).get_staging_root(root, options)
         if os.path.exists(shelved_stage):
             # ok, check to make sure there isn't one lingering
             if os.path.exists(stage_path):
@@ -498,11 +541,17 @@ class Restore(Action):
             manifest_comment = manifest_lines[0].rstrip()
             del manifest_lines[0]
 
-        abort_cleanups.append(lambda: subprocess.check_output(['hg', 'revert', '--all']))
+        abort_cleanups.append(lambda: hg_output(['hg', 'revert', '--all']))
         abort_cleanups.append(lambda: os.chdir(working_dir))
 
         merge_status = {}
         add_status = {}
+
+        # adds and removes are collected here and then handed to Mercurial
+        # in bulk once every file is back in place
+        add_files = []
+        remove_files = []
+
         for line in manifest_lines:
             line = line.rstrip()
             status, file_name, previous_key = line.split('?')  # 'previous_key' will be an md5 hash starting with MANIFEST_VERSION 2
@@ -512,15 +561,7 @@ class Restore(Action):
                 file_name = file_name.replace('\\', '/')
             if status == 'A':
                 if os.path.exists(file_name):
-                    output = subprocess.Popen(['hg', 'add', file_name], stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-                    if not len(output):
-                        add_status[file_name] = True
-                        if not quiet:
-                            print('.', end='')
-                    else:
-                        abort_cleanup(abort_cleanups)
-                        self.message = 'ERROR: Failed to restore added file "%s":\n%s\n...aborting restore...' % (file_name, output)
-                        return False
+                    add_files.append(file_name)
                 else:
                     if not os.path.exists(os.path.join(working_folder, file_name)):
                         add_status[file_name] = False
@@ -539,15 +580,7 @@ class Restore(Action):
                             abort_cleanup(abort_cleanups)
                             self.message = 'ERROR: Failed to restore added file "%s"; aborting restore...' % file_name
                             return False
-                    output = subprocess.Popen(['hg', 'add', file_name], stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-                    if not len(output):
-                        add_status[file_name] = True
-                        if not quiet:
-                            print('.', end='')
-                    else:
-                        abort_cleanup(abort_cleanups)
-                        self.message = 'ERROR: Failed to restore added file "%s":\n%s\n...aborting restore...' % (file_name, output)
-                        return False
+                        add_files.append(file_name)
 
             elif status == 'M':
                 files_are_equal = False
@@ -613,14 +646,9 @@ class Restore(Action):
 
             elif status == 'R':
                 if os.path.exists(file_name):
-                    output = subprocess.Popen(['hg', 'remove', file_name], stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-                if len(output):
-                    abort_cleanup(abort_cleanups)
-                    self.message = 'ERROR: Failed to remove file "%s":\n%s\n...aborting restore...' % (file_name, output)
-                    return False
-                else:
-                    if not quiet:
-                        print('.', end='')
+                    remove_files.append(file_name)
+                elif not quiet:
+                    print('.', end='')
 
             elif status == 'V':
                 # rename
@@ -629,7 +657,7 @@ class Restore(Action):
 
                 # first, perform a 'move' (i.e., rename) on the existing file
                 if os.path.exists(from_name):
-                    output = subprocess.Popen(['hg', 'mv', from_name, to_name], stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+                    output = hg_output(['hg', 'mv', from_name, to_name])
                 if len(output):
                     abort_cleanup(abort_cleanups)
                     self.message = 'ERROR: Failed to rename file "%s":\n%s\n...aborting restore...' % (from_name, output)
@@ -719,6 +747,24 @@ class Restore(Action):
                 if not quiet:
                     print('.', end='')
 
+        returncode, failures = hg_batch(['hg', 'add'], add_files)
+        if len(failures):
+            abort_cleanup(abort_cleanups)
+            self.message = '%s\n...aborting restore...' % describe_failures('ERROR: Failed to restore added file', failures)
+            return False
+        for file_name in add_files:
+            add_status[file_name] = True
+            if not quiet:
+                print('.', end='')
+
+        returncode, failures = hg_batch(['hg', 'remove'], remove_files)
+        if len(failures):
+            abort_cleanup(abort_cleanups)
+            self.message = '%s\n...aborting restore...' % describe_failures('ERROR: Failed to remove file', failures)
+            return False
+        if not quiet:
+            print('.' * len(remove_files), end='')
+
         if not quiet:
             for i in range(len(manifest_lines)):
                 line = manifest_lines[i].rstrip()
@@ -767,6 +813,9 @@ class Restore(Action):
                     self.message = 'ERROR: Failed to remove cached files.'
                     return False
 
+        # the working copy has changed underneath the context
+        self.context.invalidate()
+
         os.chdir(working_dir)
         return True
 
@@ -798,12 +847,12 @@ no longer equal, or their CRC32 values differ.
 """
 
 class Conflicts(object):
-    def __init__(self, options):
+    def __init__(self, options, context):
         if not options.branch:
             return
 
         working_dir = os.getcwd()
-        root = find_hg_root()
+        root = find_hg_root(context)
         if root:
             # set working directory to the top of the working copy
             os.chdir(root)
@@ -821,7 +870,7 @@ class Conflicts(object):
         shelf_name_unquoted = shelf_name
         shelf_name = quote(shelf_name, '')
 
-        root = find_mb_root()   # this will not return if we can't find a working location
+        root = find_mb_root(context)   # this will not return if we can't find a working location
 
         manifest_version = 0
         manifest = []
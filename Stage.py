@@ -26,10 +26,8 @@ from __future__ import print_function
 
 import sys
 import os
-import uuid
 import time
 import shutil
-import subprocess
 
 try:
     import cPickle
@@ -38,7 +36,7 @@ except:
 
 import Info
 
-from PyHg_lib import find_hg_root, fixup_renames, format_seconds
+from PyHg_lib import find_hg_root, fixup_status, index_status, format_seconds
 
 class StageEntry:
     __slots__ = ["version", "snapshot", "state"]
@@ -63,9 +61,13 @@ class StageEntry:
 #--------------------------------------------
 
 class StageIO(object):
-    def __init__(self):
+    def __init__(self, context=None):
         super(StageIO, self).__init__()
 
+        # when a RepoContext is provided, staging databases are only
+        # read from disk once per process
+        self.context = context
+
     def get_staging_root(self, root, options):
         staging_root = os.path.join(root, "stage")
         # this just complicates my life--not worth supporting.
@@ -78,12 +80,20 @@ class StageIO(object):
         return staging_root
 
     def load_stage_db(self, stage_db_file):
+        if self.context is not None:
+            stage_db = self.context.get_stage_db(stage_db_file)
+            if stage_db is not None:
+                return stage_db
+
         stage_db = {}
         try:
             with open(stage_db_file, 'rb') as f:
                 stage_db = cPickle.load(f)
         except:
             pass
+
+        if self.context is not None:
+            self.context.set_stage_db(stage_db_file, stage_db)
         return stage_db
 
     def save_stage_db(self, data, stage_db_file):
@@ -97,6 +107,9 @@ class StageIO(object):
                 cPickle.dump(data, f, -1)
         except:
             return False
+
+        if self.context is not None:
+            self.context.set_stage_db(stage_db_file, data)
         return True
 
     def get_staged_entry_tag(self, stage_db_path, staged_entry, source_file):
@@ -120,8 +133,8 @@ class StageIO(object):
         return snap
 
 class Stage(StageIO):
-    def __init__(self, options):
-        super(Stage, self).__init__()
+    def __init__(self, options, context):
+        super(Stage, self).__init__(context)
 
         def generate_snapshot(options, stage_db_path, file_path, entry):
             if (entry is None) or (entry.snapshot is None):
@@ -132,6 +145,7 @@ class Stage(StageIO):
                 sys.exit(1)
             ss = entry.snapshot
             if ss is None:
+                import uuid
                 ss = str(uuid.uuid4()).replace('-', '')
             snapshot_file_name = os.path.join(stage_db_path, ss)
             if os.path.exists(snapshot_file_name):
@@ -147,7 +161,7 @@ class Stage(StageIO):
             print('ERROR: Could not determine branch.', file=sys.stderr)
             sys.exit(1)
 
-        root = find_hg_root()
+        root = find_hg_root(self.context)
         if root:
             os.chdir(root)
             os.chdir("..")
@@ -169,6 +183,7 @@ class Stage(StageIO):
             if options.erase_cache:
                 print('All staged entries in "%s" cleared.' % stage_name)
                 shutil.rmtree(stage_db_path)
+                self.context.set_stage_db(stage_db_file, {})
             else:
                 stage_db = super(Stage, self).load_stage_db(stage_db_file)
 
@@ -188,8 +203,7 @@ class Stage(StageIO):
                     pass
 
         command = ['hg', 'status', '-q', '-C', '.']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        output_lines = fixup_renames(output.split('\n'))
+        output_lines = fixup_status(self.context.status(command))
 
         lines = []
         if len(options.args):
@@ -258,7 +272,7 @@ class Stage(StageIO):
         super(Stage, self).save_stage_db(stage_db, stage_db_file)
 
         if len(added_files) or len(refreshed_files):
-            s = Info.Status()
+            s = Info.Status(self.context)
             if len(added_files):
                 print('The following new %s entries were added to the "%s" staging area:' % ('snapshot' if options.snapshot else 'reference', stage_name))
                 s.process_lines(added_files, options)
@@ -269,14 +283,14 @@ class Stage(StageIO):
             print('No unique entries were added to the "%s" staging area.' % stage_name)
 
 class Unstage(StageIO):
-    def __init__(self, options):
-        super(Unstage, self).__init__()
+    def __init__(self, options, context):
+        super(Unstage, self).__init__(context)
 
         if not options.branch:
             print('ERROR: Could not determine branch.', file=sys.stderr)
             sys.exit(1)
 
-        root = find_hg_root()
+        root = find_hg_root(self.context)
         if root:
             os.chdir(root)
             os.chdir("..")
@@ -302,6 +316,7 @@ class Unstage(StageIO):
         if options.erase_cache:
             print('All entries in the "%s" staging area were cleared.' % stage_name)
             shutil.rmtree(stage_db_path)
+            self.context.set_stage_db(stage_db_file, {})
             return
 
         if len(options.args) == 0:
@@ -313,8 +328,7 @@ class Unstage(StageIO):
             stage_db = super(Unstage, self).load_stage_db(stage_db_file)
 
         command = ['hg', 'status', '-q', '-C', '.']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        output_lines = fixup_renames(output.split('\n'))
+        output_lines = fixup_status(self.context.status(command))
 
         bad_keys = []
         for key in stage_db:
@@ -326,11 +340,12 @@ class Unstage(StageIO):
             print('ERROR: Your specified filter(s) did not match any entries in the "%s" staging area.' % stage_name, file=sys.stderr)
             sys.exit(1)
 
+        status_index = index_status(output_lines)
+
         unstaged_entries = []
         for key in bad_keys:
-            for line in output_lines:
-                if key in line:
-                    unstaged_entries.append(line)
+            if key in status_index:
+                unstaged_entries.append(output_lines[status_index[key]])
 
         for key in bad_keys:
             if stage_db[key].snapshot is not None:
@@ -348,14 +363,14 @@ class Unstage(StageIO):
 
             if len(unstaged_entries):
                 print('The following existing entries were removed from the "%s" staging area:' % stage_name)
-                s = Info.Status()
+                s = Info.Status(self.context)
                 s.process_lines(unstaged_entries, options)
             else:
                 print('No unique entries were removed from the "%s" staging area.' % stage_name)
 
 class Staged(StageIO):
-    def __init__(self):
-        super(Staged, self).__init__()
+    def __init__(self, context):
+        super(Staged, self).__init__(context)
 
         self.message = None
 
@@ -365,10 +380,20 @@ class Staged(StageIO):
             return False
 
         staged_entries = self.get_staged_entries(options)
+        if (options.output_format != 'text') and (self.message is None):
+            records = []
+            for stage in staged_entries:
+                for entry in staged_entries[stage]:
+                    # entries end with their snapshot tag, e.g. "M file.c (&)"
+                    line, sep, snap = entry.rpartition(' (')
+                    records.append(Info.status_record(line, stage, snap[:-1]))
+            Info.Status(self.context).report(records, options)
+            return True
+
         if len(staged_entries):
             for stage in staged_entries:
                 print('The following entries are pending in the "%s" staging area:' % stage)
-                s = Info.Status()
+                s = Info.Status(self.context)
                 s.process_lines(staged_entries[stage], options)
         else:
             if self.message is None:
@@ -383,7 +408,7 @@ class Staged(StageIO):
     def get_staged_entries(self, options):
         working_dir = os.getcwd()
 
-        root = find_hg_root()
+        root = find_hg_root(self.context)
         if root:
             os.chdir(root)
             os.chdir("..")
@@ -393,13 +418,18 @@ class Staged(StageIO):
             self.message = 'ERROR: Must be in root of working copy to stage.'
             return []
 
-        command = ['hg', 'status', '-q', '-C', '.']
-        output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        output_lines = fixup_renames(output.split('\n'))
-
         stage_name = options.stage_name
 
         self.stage_path = super(Staged, self).get_staging_root(root, options)
+        staged_entries = self.context.get_staged_entries(self.stage_path, stage_name)
+        if staged_entries is not None:
+            os.chdir(working_dir)
+            return staged_entries
+
+        command = ['hg', 'status', '-q', '-C', '.']
+        output_lines = fixup_status(self.context.status(command))
+        status_index = index_status(output_lines)
+
         if not os.path.exists(self.stage_path):
             os.mkdir(self.stage_path)
         stage_names = []
@@ -429,16 +459,10 @@ class Staged(StageIO):
                 reference_count += 1 if staged_entry.snapshot is None else 0
                 capture_count += 1 if staged_entry.snapshot is not None else 0
 
-                found = False
-                for line in output_lines:
-                    if (key in line) or (staged_entry.snapshot is not None):
-                        snapshot_path = None
-                        snap = super(Staged, self).get_staged_entry_tag(stage_db_path, staged_entry, key)
-                        entries.append('%s (%s)' % (line, snap))
-                        found = True
-                        break
-
-                if not found:
+                if key in status_index:
+                    snap = super(Staged, self).get_staged_entry_tag(stage_db_path, staged_entry, key)
+                    entries.append('%s (%s)' % (output_lines[status_index[key]], snap))
+                else:
                     if staged_entry.snapshot is None:
                         bad_keys.append(key)
                     else:
@@ -452,8 +476,9 @@ class Staged(StageIO):
                     del stage_db[key]
 
             if len(stage_db):
-                # save the corrected database
-                super(Staged, self).save_stage_db(stage_db, stage_db_file)
+                if len(bad_keys):
+                    # save the corrected database
+                    super(Staged, self).save_stage_db(stage_db, stage_db_file)
                 staged_entries[stage_name] = entries
             else:
                 if (len(output_lines) == 0) and (reference_count != 0) and (capture_count == 0):
@@ -472,6 +497,8 @@ class Staged(StageIO):
                 if os.path.exists(stage_db_path):
                     shutil.rmtree(stage_db_path)
 
+        self.context.set_staged_entries(self.stage_path, options.stage_name, staged_entries)
+
         os.chdir(working_dir)
 
         return staged_entries
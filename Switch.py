@@ -32,21 +32,21 @@ branch, and then re-apply any pending changes for the incoming branch.
 """
 
 import os
-import re
 import sys
 import urllib
 import shutil
-import subprocess
 
 from Action import Action
+from HgClient import hg_call
+from HgQuery import get_branches
 from Shelf import Shelve, Restore
 from PyHg_lib import find_hg_root, find_mb_root
 
 #--------------------------------------------
 
 class Switch(Action):
-    def __init__(self):
-        super(Switch, self).__init__()
+    def __init__(self, context=None):
+        super(Switch, self).__init__(context)
 
         self.mb_root = None
         self.mb_switch = None
@@ -58,7 +58,7 @@ class Switch(Action):
 
         working_dir = os.getcwd()
 
-        root = find_hg_root()
+        root = find_hg_root(self.context)
         if root:
             os.chdir(root)
             os.chdir("..")
@@ -77,7 +77,7 @@ class Switch(Action):
             options.args = [options.shelf_name]
             #options.shelf_name = ''
 
-        self.mb_root = find_mb_root()   # this will not return if we can't find a working location
+        self.mb_root = find_mb_root(self.context)   # this will not return if we can't find a working location
         self.mb_switch = os.path.join(self.mb_root, 'switch')
         if not os.path.exists(self.mb_switch):
             try:
@@ -89,13 +89,9 @@ class Switch(Action):
         target_branch = options.args[0]
 
         # validate the target branch name
-        output = subprocess.Popen(['hg', 'branches'], stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
         found = False
-        for line in output.split('\n'):
-            data = re.search('([a-zA-Z0-9\.]+)\s+', line)
-            if not data:
-                continue
-            if target_branch == data.group(1):
+        for branch in get_branches():
+            if target_branch == branch.name:
                 found = True
                 break
 
@@ -105,8 +101,7 @@ class Switch(Action):
             return False
 
         # are there any pending changes?
-        output = subprocess.Popen(['hg', 'status', '--quiet'], stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
-        if len(output):
+        if len(self.context.status(['hg', 'status', '--quiet'])):
             # shelve the changes
             options.shelf_name = options.branch
             if not self.shelve(options):
@@ -114,7 +109,12 @@ class Switch(Action):
                 return False
 
         # now the easy part...
-        if subprocess.call(['hg', 'update', target_branch]) != 0:
+        returncode = hg_call(['hg', 'update', target_branch])
+
+        # the working copy has changed underneath the context
+        self.context.invalidate()
+
+        if returncode != 0:
             self.message = 'ERROR: Switching to the target branch "%s" failed.' % target_branch
             # ok, restore the shelved work above, if any
             if not self.restore(options):
@@ -168,7 +168,7 @@ class Switch(Action):
         #shelve_options = deepcopy(options)
         #shelve_options.args[0] = options.branch
         print('Shelving current working copy changes...')
-        shelve = Shelve()
+        shelve = Shelve(self.context)
         if not shelve.execute(options, quiet=True, mb_root=self.mb_switch):
             self.message = shelve.message
             return False
@@ -195,7 +195,7 @@ class Switch(Action):
             return True     # nothing to do; all good
 
         print('Restoring shelved working copy changes...')
-        restore = Restore()
+        restore = Restore(self.context)
         if not restore.execute(options, quiet=True, mb_root=self.mb_switch):
             self.message = restore.message
             return False
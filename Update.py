@@ -28,45 +28,30 @@ import sys
 import os
 import re
 import time
-import subprocess
 
-from PyHg_lib import MyParser
+from HgClient import hg_output
+from Workspace import Workspace
 from Incoming import Incoming
 
 #--------------------------------------------
 
 class Update(object):
-    def __init__(self, options, and_pull=True):
+    def __init__(self, options, context, and_pull=True):
         working_copies = ['.']
 
         if options.process_all:
-            # look at each folder in the current folder, and determine:
-            #    a. if it is a Mercurial folder
-            #    b. the value of its 'default' in .hg/hgrc
-            #    c. sync all 'off-world' folders first (those that don't have a valid local path)
-
-            hg_folders = {}
-            for entry in os.listdir('.'):
-                hgrc = os.path.join(entry, '.hg', 'hgrc')
-                if os.path.isdir(entry) and os.path.exists(hgrc):
-                    d = MyParser(hgrc).as_dict()
-                    dest = d['paths']['default']
-                    hg_folders[entry] = dest
-                    print('Found %s (%s)...' % (entry, dest))
-
-            working_copies = []
-
-            # non-local first
-            for key in hg_folders.keys():
-                dest = hg_folders[key]
-                if not os.path.exists(dest):
-                    working_copies.append(key)
-
-            # then local
-            for key in hg_folders.keys():
-                dest = hg_folders[key]
-                if os.path.exists(dest):
-                    working_copies.append(key)
+            # find the Mercurial folders beneath the current folder, along
+            # with the value of each one's 'default' in .hg/hgrc, and sync
+            # all 'off-world' folders first (those that don't have a valid
+            # local path)
+
+            hg_folders = Workspace('.').working_copies()
+            for wc in hg_folders:
+                print('Found %s (%s)...' % (wc.path, wc.default))
+
+            # non-local first, then local
+            working_copies = [wc.path for wc in hg_folders if not wc.local] + \
+                             [wc.path for wc in hg_folders if wc.local]
 
             if len(working_copies) == 0:
                 print('No valid Mercurial working copies found under current folder!')
@@ -90,25 +75,18 @@ class Update(object):
             os.chdir(start_dir)
             os.chdir(wc)
 
-            command = ['hg', 'root']
-            output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0].decode("utf-8")
-            wc_root = output.split('\n')[0]
-
-            command = ['hg', 'branch']
-            output = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).communicate()[0].decode("utf-8")
-            options.branch = output.split('\n')[0]
-            if 'no repository found' in options.branch:
-                options.branch = None
+            wc_root = context.root()
+            options.branch = context.branch()
 
             if not options.branch:
                 continue
 
-            incoming = Incoming(options, database=True)
+            incoming = Incoming(options, context, database=True)
             log_text = incoming.format(Incoming.STYLE_PLAIN)
 
             if and_pull:
                 command = ['hg', 'pull']
-                output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+                output = hg_output(command)
 
             tally = []
             total_updated = 0
@@ -117,7 +95,10 @@ class Update(object):
             total_unresolved = 0
 
             command = ['hg', 'update']
-            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0].decode("utf-8")
+            output = hg_output(command, interactive=True)  # merge tools may need the terminal
+
+            # the working copy has changed underneath the context
+            context.invalidate()
             lines = output.split('\n')
             for line in lines:
                 if 'files updated' in line:
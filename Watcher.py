@@ -0,0 +1,213 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+A Watcher follows a working copy with Linux's inotify (through ctypes, so
+nothing outside the standard library is needed) and collects the paths that
+have changed since they were last asked for.  A long-lived RepoContext (see
+PyHg_daemon.py) uses this to re-check only those paths with 'hg status',
+rather than having Mercurial stat the whole tree on every command.
+
+Paths are relative to the working copy root, with '/' separators, as
+Mercurial reports them.  A folder that was created, moved or deleted is
+reported as the folder itself, standing for everything beneath it.  If
+changes may have been missed (the kernel's event queue overflowed, or the
+watch limit was reached), the Watcher says so and the caller falls back to
+a full 'hg status'.
+"""
+
+import sys
+import os
+import errno
+import struct
+
+#--------------------------------------------
+
+IN_MODIFY       = 0x00000002
+IN_ATTRIB       = 0x00000004
+IN_CLOSE_WRITE  = 0x00000008
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_DELETE_SELF  = 0x00000400
+IN_MOVE_SELF    = 0x00000800
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+             IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+EVENT_HEADER = struct.Struct('iIII')
+
+def load_inotify():
+    """ The C library, if it provides inotify (or None) """
+    if (not sys.platform.startswith('linux')) or ('PYHG_NO_WATCHER' in os.environ):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+def covers(changed, path):
+    """ True if 'path', or a folder above it, is in the 'changed' set """
+    while len(path):
+        if path in changed:
+            return True
+        path = path.rpartition('/')[0]
+    return False
+
+class Watcher(object):
+    def __init__(self, root):
+        self.root = root
+        self.__libc = None
+        self.__fd = -1
+        self.__folders = {}     # watch descriptor -> folder
+        self.__changed = set()
+        self.__lost = False
+
+    def start(self):
+        """ Start watching the working copy; returns False if that is not possible """
+        self.__libc = load_inotify()
+        if self.__libc is None:
+            return False
+
+        flags = getattr(os, 'O_NONBLOCK', 0o4000) | getattr(os, 'O_CLOEXEC', 0o2000000)
+        self.__fd = self.__libc.inotify_init1(flags)
+        if self.__fd < 0:
+            return False
+
+        self.__watch_tree('')
+        if self.__lost:
+            self.close()
+            return False
+        return True
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+        self.__fd = -1
+        self.__folders = {}
+
+    def is_open(self):
+        return self.__fd >= 0
+
+    def changes(self):
+        """
+        The set of paths changed since the last call, or None if some changes
+        may have been missed.
+        """
+        self.__read_events()
+        changed = self.__changed
+        lost = self.__lost
+        self.__changed = set()
+        self.__lost = False
+        return None if lost else changed
+
+    def __watch_tree(self, folder):
+        """ Watch 'folder' and every folder beneath it (other than Mercurial's own) """
+        top = os.path.join(self.root, folder) if len(folder) else self.root
+        for path, folders, files in os.walk(top):
+            folders[:] = [name for name in folders if name != '.hg']
+            relative = os.path.relpath(path, self.root).replace(os.sep, '/')
+            if relative == '.':
+                relative = ''
+            encoded = path if isinstance(path, bytes) else path.encode('utf-8', 'surrogateescape')
+            wd = self.__libc.inotify_add_watch(self.__fd, encoded, WATCH_MASK)
+            if wd < 0:
+                import ctypes
+                if ctypes.get_errno() != errno.ENOENT:     # a folder may vanish as we walk
+                    self.__lost = True                     # e.g., ENOSPC: out of watches
+                    return
+                continue
+            self.__folders[wd] = relative
+
+    def __unwatch_tree(self, folder):
+        """ Forget the watches on a folder that has moved away """
+        prefix = folder + '/'
+        for wd, watched in list(self.__folders.items()):
+            if (watched == folder) or watched.startswith(prefix):
+                self.__libc.inotify_rm_watch(self.__fd, wd)
+                del self.__folders[wd]
+
+    def __read_events(self):
+        if self.__fd < 0:
+            self.__lost = True
+            return
+
+        while True:
+            try:
+                data = os.read(self.__fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not data:
+                break
+
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                self.__handle_event(wd, mask, name)
+
+    def __handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.__lost = True
+            return
+        if wd not in self.__folders:
+            return
+        folder = self.__folders[wd]
+        if mask & IN_IGNORED:
+            del self.__folders[wd]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if len(folder) == 0:
+                self.__lost = True      # the working copy itself is gone
+            return
+
+        if sys.version_info[0] > 2:
+            name = name.decode('utf-8', 'surrogateescape')
+        if (len(folder) == 0) and (name == '.hg'):
+            return
+        path = '%s/%s' % (folder, name) if len(folder) else name
+
+        if mask & IN_ISDIR:
+            if mask & (IN_MOVED_FROM | IN_DELETE):
+                self.__unwatch_tree(path)
+            elif mask & (IN_CREATE | IN_MOVED_TO):
+                self.__watch_tree(path)
+        self.__changed.add(path)
@@ -0,0 +1,244 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Finds the Mercurial working copies beneath a workspace folder for the
+'--process-all' commands.  The whole tree is searched (build output and
+other tool folders are skipped unless they are working copies themselves,
+as is anything inside a working copy), and what was found is remembered in
+an index file at the workspace root:
+
+- each working copy's 'default' path (from its .hg/hgrc), whether that path
+  is local or remote, and when it was last looked at
+- the modification time of each folder that was searched
+
+On later runs, only folders whose modification time has changed (i.e.,
+where something was added or removed) are searched again, and only working
+copies whose hgrc has changed are parsed again.
+"""
+
+import os
+import time
+
+try:
+    import cPickle
+except:
+    import pickle as cPickle
+
+from PyHg_lib import MyParser
+
+INDEX_NAME = '.pyhg_workspace'
+INDEX_VERSION = 2
+
+# folders that are not searched for working copies (unless they are one)
+PRUNED_FOLDERS = ['.hg', '.git', '.svn', 'node_modules', '__pycache__',
+                  'build', 'dist', 'out', 'bin', 'obj', 'Debug', 'Release']
+
+#--------------------------------------------
+
+class WorkingCopy(object):
+    __slots__ = ["path", "default", "local", "hgrc_mtime", "scanned"]
+    def __init__(self, path):
+        # relative to the workspace root
+        self.path = path
+        # the 'default' path from .hg/hgrc, and whether it is on this machine
+        self.default = ''
+        self.local = False
+        self.hgrc_mtime = None
+        # when the entry was last checked
+        self.scanned = 0
+
+    def read_hgrc(self, hgrc, mtime):
+        d = MyParser(hgrc).as_dict()
+        self.default = d.get('paths', {}).get('default', '')
+        self.local = os.path.exists(self.default)
+        self.hgrc_mtime = mtime
+        self.scanned = time.time()
+
+def list_folders(path):
+    """ The names of the folders in 'path' """
+    if hasattr(os, 'scandir'):
+        names = []
+        try:
+            for entry in os.scandir(path):
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        names.append(entry.name)
+                except OSError:
+                    pass
+        except OSError:
+            pass
+        return names
+
+    names = []
+    try:
+        for name in os.listdir(path):
+            full_path = os.path.join(path, name)
+            if os.path.isdir(full_path) and not os.path.islink(full_path):
+                names.append(name)
+    except OSError:
+        pass
+    return names
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+class Workspace(object):
+    def __init__(self, root='.'):
+        self.root = os.path.abspath(root)
+        self.index_file = os.path.join(self.root, INDEX_NAME)
+        # folder -> mtime, for every folder searched
+        self.folders = {}
+        # folder -> WorkingCopy
+        self.repos = {}
+
+    def working_copies(self):
+        """ The working copies in the workspace (those with an .hg/hgrc), ordered by path """
+        changed = False
+        if not self.__load():
+            self.__search('', {})
+            changed = True
+        else:
+            # search again where something was added or removed
+            for folder in sorted(self.folders):
+                if folder not in self.folders:
+                    continue        # went with a parent that was searched again
+                if get_mtime(self.__path(folder)) != self.folders[folder]:
+                    if os.path.basename(folder) == '.hg':
+                        # a working copy without an hgrc (see __search())
+                        folder = os.path.dirname(folder)
+                    old_repos = self.__forget(folder)
+                    self.__search(folder, old_repos)
+                    changed = True
+
+            # read again any hgrc that has changed
+            for folder in list(self.repos):
+                wc = self.repos[folder]
+                hgrc = os.path.join(self.__path(folder), '.hg', 'hgrc')
+                mtime = get_mtime(hgrc)
+                if mtime is None:
+                    # no longer a working copy; what is inside may hold some
+                    del self.repos[folder]
+                    self.__search(folder, {})
+                    changed = True
+                elif mtime != wc.hgrc_mtime:
+                    wc.read_hgrc(hgrc, mtime)
+                    changed = True
+
+        if changed:
+            self.__save()
+
+        return [self.repos[folder] for folder in sorted(self.repos)]
+
+    def __path(self, folder):
+        return os.path.join(self.root, folder) if len(folder) else self.root
+
+    def __forget(self, folder):
+        """ Drop what is known of 'folder' and below; returns the working copies dropped """
+        prefix = os.path.join(folder, '')
+        old_repos = {}
+        for key in list(self.folders):
+            if (key == folder) or (len(folder) == 0) or key.startswith(prefix):
+                del self.folders[key]
+        for key in list(self.repos):
+            if (len(folder) == 0) or key.startswith(prefix):
+                old_repos[key] = self.repos.pop(key)
+        return old_repos
+
+    def __search(self, folder, old_repos):
+        """ Find the working copies beneath 'folder', reusing 'old_repos' entries whose hgrc is unchanged """
+        # a folder searched before may have become a working copy itself
+        # (e.g., with 'hg init'); the workspace root is never one
+        if len(folder) and self.__add_working_copy(folder, old_repos):
+            return
+
+        pending = [folder]
+        while len(pending):
+            folder = pending.pop()
+            path = self.__path(folder)
+            self.folders[folder] = get_mtime(path)
+            for name in list_folders(path):
+                child = os.path.join(folder, name) if len(folder) else name
+                if self.__add_working_copy(child, old_repos):
+                    continue
+                if (name in PRUNED_FOLDERS) or name.startswith('.'):
+                    continue
+                pending.append(child)
+
+    def __add_working_copy(self, folder, old_repos):
+        """
+        Note 'folder' if it is a working copy (whatever is inside then
+        belongs to it, and is not searched); returns False if it is not.
+        """
+        hg = os.path.join(self.__path(folder), '.hg')
+        if not os.path.isdir(hg):
+            return False
+
+        hgrc = os.path.join(hg, 'hgrc')
+        mtime = get_mtime(hgrc)
+        if mtime is None:
+            # not counted until it has an hgrc, so watch for one appearing
+            self.folders[os.path.join(folder, '.hg')] = get_mtime(hg)
+            return True
+
+        wc = old_repos.get(folder, None)
+        if (wc is None) or (wc.hgrc_mtime != mtime):
+            wc = WorkingCopy(folder)
+            wc.read_hgrc(hgrc, mtime)
+        self.repos[folder] = wc
+        return True
+
+    def __load(self):
+        try:
+            with open(self.index_file, 'rb') as f:
+                version, folders, repos = cPickle.load(f)
+        except:
+            return False
+        if version != INDEX_VERSION:
+            return False
+        self.folders = folders
+        self.repos = repos
+        return True
+
+    def __save(self):
+        # the index is rewritten in place, because replacing it would
+        # change the modification time of the workspace root
+        created = not os.path.exists(self.index_file)
+        for attempt in range(2):
+            try:
+                with open(self.index_file, 'wb') as f:
+                    cPickle.dump((INDEX_VERSION, self.folders, self.repos), f, -1)
+            except (IOError, OSError):
+                return False
+            if not created:
+                break
+            # creating it did, though, so note the root's new time
+            self.folders[''] = get_mtime(self.root)
+            created = False
+        return True
@@ -0,0 +1,157 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests for CommentCache, the per-working-copy cache of embedded comments.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import CommentCache as CommentCacheModule
+from CommentCache import CommentCache
+
+#--------------------------------------------
+
+class CommentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.path.realpath(tempfile.mkdtemp(prefix='pyhg_test_'))
+        self.hg_root = os.path.join(self.folder, '.hg')
+        os.mkdir(self.hg_root)
+
+        # count the files actually read
+        self.scanned = []
+        self.saved = (CommentCacheModule.scan_files, CommentCacheModule.RACY_SECONDS, dict(os.environ))
+        def scan_files(filenames, display):
+            self.scanned.extend(filenames)
+            return self.saved[0](filenames, display=display)
+        CommentCacheModule.scan_files = scan_files
+        CommentCacheModule.RACY_SECONDS = 0
+
+    def tearDown(self):
+        CommentCacheModule.scan_files, CommentCacheModule.RACY_SECONDS, environ = self.saved
+        os.environ.clear()
+        os.environ.update(environ)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def make_file(self, name, comment):
+        path = os.path.join(self.folder, name)
+        with open(path, 'w') as f:
+            f.write('int x;\n// @comment: %s\n' % comment)
+        # old enough to be trusted to the cache
+        then = time.time() - 10
+        os.utime(path, (then, then))
+        return path
+
+    def cache(self):
+        return CommentCache(self.hg_root)
+
+    def comments(self, cache, paths):
+        return [comments for comments, error in cache.comments_all(paths)]
+
+    def test_unchanged_files_not_read_again(self):
+        paths = [self.make_file('%d.c' % i, 'note %d' % i) for i in range(3)]
+        cache = self.cache()
+        first = self.comments(cache, paths)
+        self.assertTrue(all(len(comments) for comments in first))
+        self.assertTrue(cache.save())
+
+        self.scanned = []
+        self.assertEqual(self.comments(self.cache(), paths), first)
+        self.assertEqual(self.scanned, [])
+
+    def test_changed_file_read_again(self):
+        path = self.make_file('a.c', 'before')
+        cache = self.cache()
+        self.comments(cache, [path])
+        cache.save()
+
+        self.make_file('a.c', 'and after')
+        self.scanned = []
+        comments = self.comments(self.cache(), [path])[0]
+        self.assertEqual(self.scanned, [path])
+        self.assertIn('and after', ''.join(comments))
+
+    def test_recent_files_not_trusted(self):
+        CommentCacheModule.RACY_SECONDS = 3600
+        path = self.make_file('a.c', 'racy')
+        cache = self.cache()
+        self.comments(cache, [path])
+        cache.save()
+        self.scanned = []
+        self.comments(self.cache(), [path])
+        self.assertEqual(self.scanned, [path])
+
+    def test_missing_file(self):
+        comments, error = self.cache().comments_all([os.path.join(self.folder, 'gone.c')])[0]
+        self.assertEqual(comments, None)
+        self.assertIn('does not exist', error)
+
+    def test_entry_limit_drops_least_recently_used(self):
+        os.environ['PYHG_COMMENT_CACHE_ENTRIES'] = '2'
+        a, b, c = [self.make_file(name, name) for name in ('a.c', 'b.c', 'c.c')]
+        cache = self.cache()
+        self.comments(cache, [a, b])
+        self.comments(cache, [a])         # 'b' is now the least recently used
+        self.comments(cache, [c])
+        self.assertEqual(sorted(cache.entries), [a, c])
+
+    def test_order_of_use_saved(self):
+        a, b = [self.make_file(name, name) for name in ('a.c', 'b.c')]
+        cache = self.cache()
+        self.comments(cache, [a, b])
+        cache.save()
+
+        # a pure hit that changes the order must still be saved
+        cache = self.cache()
+        self.comments(cache, [a])
+        self.assertTrue(cache.dirty)
+        cache.save()
+        reloaded = self.cache()
+        reloaded.load()
+        self.assertEqual(list(reloaded.entries), [b, a])
+
+        # one that does not change it need not be
+        cache = self.cache()
+        self.comments(cache, [a])
+        self.assertFalse(cache.dirty)
+
+    def test_size_limit(self):
+        os.environ['PYHG_COMMENT_CACHE_BYTES'] = '2000'
+        paths = [self.make_file('%03d.c' % i, 'a somewhat longer note, number %d' % i) for i in range(100)]
+        cache = self.cache()
+        self.comments(cache, paths)
+        self.assertTrue(cache.save())
+        self.assertLessEqual(os.path.getsize(cache.cache_file), 2000)
+        self.assertGreater(len(cache.entries), 0)
+        # the most recently used are the ones kept
+        self.assertEqual(list(cache.entries), paths[-len(cache.entries):])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests for HgClient, the connection layer between the Hg Suite and
+Mercurial.
+"""
+
+import sys
+import os
+import unittest
+
+import HgClient
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+from HgTesting import HgTestCase
+from HgClient import hg_batch, hg_run, hg_stream
+
+#--------------------------------------------
+
+class HgBatchTest(HgTestCase):
+    def setUp(self):
+        super(HgBatchTest, self).setUp()
+        self.root = self.make_repo('repo', {'a.txt': 'a\n', 'b.txt': 'b\n'})
+        self.saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+
+    def tearDown(self):
+        sys.stderr = self.saved_stderr
+        super(HgBatchTest, self).tearDown()
+
+    def test_success(self):
+        self.write(os.path.join(self.root, 'n.txt'), 'n\n')
+        self.assertEqual(hg_batch(['hg', 'add'], ['n.txt'], cwd=self.root), (0, {}))
+        self.assertEqual(self.hg(['status'], self.root), 'A n.txt\n')
+
+    def test_warnings_are_not_failures(self):
+        # "a.txt already tracked!" is only a warning
+        self.write(os.path.join(self.root, 'n.txt'), 'n\n')
+        self.assertEqual(hg_batch(['hg', 'add'], ['a.txt', 'n.txt'], cwd=self.root), (0, {}))
+        self.assertIn('already tracked', sys.stderr.getvalue())
+        self.assertEqual(self.hg(['status'], self.root), 'A n.txt\n')
+
+    def test_failures_by_file(self):
+        returncode, failures = hg_batch(['hg', 'remove'], ['a.txt', 'missing.txt'], cwd=self.root)
+        self.assertNotEqual(returncode, 0)
+        self.assertEqual(list(failures), ['missing.txt'])
+        self.assertIn('missing.txt', failures['missing.txt'][0])
+
+    def test_longest_name_blamed(self):
+        self.write(os.path.join(self.root, 'sub', 'a.txt'), 'untracked\n')
+        returncode, failures = hg_batch(['hg', 'remove'], ['a.txt', os.path.join('sub', 'a.txt')], cwd=self.root)
+        self.assertNotEqual(returncode, 0)
+        self.assertEqual(list(failures), [os.path.join('sub', 'a.txt')])
+
+    def test_nothing_to_do(self):
+        self.assertEqual(hg_batch(['hg', 'add'], [], cwd=self.root), (0, {}))
+
+class HgRunTest(HgTestCase):
+    def test_cwd_left_alone(self):
+        # the in-process backend handles '--cwd' by changing folders
+        root = self.make_repo('repo', {'sub/a.txt': 'a\n'})
+        os.chdir(self.folder)
+        returncode, output, error = hg_run(['hg', 'status', '-A', '.'], cwd=os.path.join(root, 'sub'))
+        self.assertEqual((returncode, output), (0, 'C a.txt\n'))
+        self.assertEqual(os.getcwd(), self.folder)
+
+class HgStreamTest(HgTestCase):
+    def setUp(self):
+        super(HgStreamTest, self).setUp()
+        self.root = self.make_repo('repo', {'a.txt': 'a\n'})
+        self.saved_stderr = sys.stderr
+        sys.stderr = StringIO()
+        self.saved_environ = dict(os.environ)
+
+    def tearDown(self):
+        sys.stderr = self.saved_stderr
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        super(HgStreamTest, self).tearDown()
+
+    def check(self):
+        output = b''.join(hg_stream(['hg', 'status', '-A', 'missing.txt', 'a.txt'], cwd=self.root))
+        self.assertEqual(output, b'C a.txt\n')
+        self.assertIn('missing.txt', sys.stderr.getvalue())
+
+    def test_errors_passed_along(self):
+        self.check()
+
+    def test_errors_passed_along_by_a_subprocess(self):
+        os.environ['PYHG_NO_INPROCESS'] = '1'
+        os.environ['PYHG_NO_CMDSERVER'] = '1'
+        self.check()
+
+class RemoteCommandTest(HgTestCase):
+    def setUp(self):
+        super(RemoteCommandTest, self).setUp()
+        self.upstream = self.make_repo('upstream', {'a.txt': 'a\n'})
+        self.clone = self.make_repo('clone', clone_of=self.upstream)
+        self.write(os.path.join(self.upstream, 'b.txt'), 'b\n')
+        self.hg(['add', '-q', 'b.txt'], self.upstream)
+        self.hg(['commit', '-q', '-m', 'More'], self.upstream)
+
+        # remote commands must never be handed to a backend
+        self.saved_get_server = HgClient.get_server
+        self.servers_asked = []
+        def get_server(cwd=None, slot=0):
+            self.servers_asked.append(cwd)
+            return self.saved_get_server(cwd, slot)
+        HgClient.get_server = get_server
+
+    def tearDown(self):
+        HgClient.get_server = self.saved_get_server
+        super(RemoteCommandTest, self).tearDown()
+
+    def test_run_as_subprocesses(self):
+        returncode, output, error = hg_run(['hg', 'incoming', '-q', '-T', '{desc}\\n'], cwd=self.clone)
+        self.assertEqual((returncode, output), (0, 'More\n'))
+        returncode, output, error = hg_run(['hg', 'pull', '-q'], cwd=self.clone)
+        self.assertEqual(returncode, 0, error)
+        self.assertEqual(self.servers_asked, [])
+
+    def test_local_commands_use_a_backend(self):
+        hg_run(['hg', 'status'], cwd=self.clone)
+        self.assertEqual(self.servers_asked, [self.clone])
+
+if __name__ == "__main__":
+    unittest.main()
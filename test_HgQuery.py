@@ -0,0 +1,167 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests for HgQuery: decoding Mercurial's output into records, and the
+paths that status entries carry.
+"""
+
+import sys
+import os
+import unittest
+
+from HgTesting import HgTestCase
+from HgQuery import parse_status, decode_json, Changeset, get_status, get_file_status, get_changed_lines
+
+#--------------------------------------------
+
+class ParseStatusTest(unittest.TestCase):
+    OUTPUT = b'M a.txt\0A b.txt\0  a.txt\0R c d.txt\0? e.txt\0'
+
+    def entries(self, chunks):
+        return [(e.state, e.path, e.source) for e in parse_status(chunks)]
+
+    def test_records(self):
+        self.assertEqual(self.entries([self.OUTPUT]),
+                         [('M', 'a.txt', None), ('A', 'b.txt', 'a.txt'), ('R', 'c d.txt', None), ('?', 'e.txt', None)])
+
+    def test_split_anywhere(self):
+        expected = self.entries([self.OUTPUT])
+        for size in range(1, len(self.OUTPUT)):
+            chunks = [self.OUTPUT[i:i + size] for i in range(0, len(self.OUTPUT), size)]
+            self.assertEqual(self.entries(chunks), expected)
+
+    def test_empty(self):
+        self.assertEqual(self.entries([]), [])
+        self.assertEqual(self.entries([b'']), [])
+
+    @unittest.skipIf(sys.version_info[0] < 3, 'file names are bytes under Python 2')
+    def test_not_utf8(self):
+        entry = list(parse_status([b'? \xff.txt\0']))[0]
+        self.assertEqual(os.fsencode(entry.path), b'\xff.txt')
+
+class DecodeJsonTest(unittest.TestCase):
+    def test_chatter_before_data(self):
+        output = 'comparing with /somewhere\nsearching for changes\n[\n {"rev": 1}\n]\n'
+        self.assertEqual(decode_json(output), [{'rev': 1}])
+
+    def test_no_data(self):
+        self.assertEqual(decode_json('no changes found\n'), None)
+        self.assertEqual(decode_json('[ not json'), None)
+
+class ChangesetTest(unittest.TestCase):
+    def test_files_by_state(self):
+        cs = Changeset({'rev': 3, 'modified': ['a'], 'added': ['b'], 'removed': ['c'], 'desc': 'one\ntwo'})
+        self.assertEqual(cs.rev, 3)
+        self.assertEqual(cs.files, ['a', 'b', 'c'])
+        self.assertEqual(cs.description, ['one', 'two'])
+        self.assertEqual(cs.branch, 'default')
+
+    def test_changes(self):
+        cs = Changeset({'file_mods': ['a'], 'file_adds': ['b'], 'file_dels': ['c'], 'file_copies': {'b': 'c'}})
+        self.assertEqual([(e.state, e.path, e.source) for e in cs.changes],
+                         [('M', 'a', None), ('A', 'b', 'c'), ('R', 'c', None)])
+
+class StatusPathsTest(HgTestCase):
+    def setUp(self):
+        super(StatusPathsTest, self).setUp()
+        self.root = self.make_repo('repo', {'top.txt': 'top\n', 'sub/s.txt': 'a\n', 'sub/r.txt': 'r\n'})
+        self.write(os.path.join(self.root, 'sub', 's.txt'), 'b\n', 'a')
+        self.hg(['copy', 'sub/s.txt', 'sub/c.txt'], self.root)
+        self.sub = os.path.join(self.root, 'sub')
+
+    def entries(self, entries):
+        return sorted((e.state, e.path, e.source) for e in entries)
+
+    def test_relative_to_cwd(self):
+        # as 'hg status .' prints them: relative to the folder it runs in
+        entries = get_status(['hg', 'status', '-C', '.'], cwd=self.sub)
+        self.assertEqual(self.entries(entries), [('A', 'c.txt', 's.txt'), ('M', 's.txt', None)])
+
+    def test_relative_to_root(self):
+        # with no files named, Mercurial reports paths from the root
+        entries = get_status(['hg', 'status'], cwd=self.sub)
+        self.assertEqual(self.entries(entries), [('A', 'sub/c.txt', None), ('M', 'sub/s.txt', None)])
+
+    def test_file_status_matches(self):
+        full = dict((e.path, e.state) for e in get_status(['hg', 'status', '.'], cwd=self.sub))
+        some = get_file_status(['hg', 'status'], [os.path.join(self.sub, 's.txt')], cwd=self.sub)
+        self.assertEqual([(e.path, e.state) for e in some], [('s.txt', full['s.txt'])])
+
+    @unittest.skipIf((sys.version_info[0] < 3) or (os.name != 'posix'), 'needs byte file names')
+    def test_file_status_not_utf8(self):
+        with open(os.path.join(os.fsencode(self.sub), b'\xff.txt'), 'w') as f:
+            f.write('x\n')
+        full = [e.path for e in get_status(['hg', 'status', '.'], cwd=self.sub) if e.state == '?']
+        some = get_file_status(['hg', 'status'], [os.path.join(self.sub, full[0])], cwd=self.sub)
+        self.assertEqual([e.path for e in some], full)
+        self.assertEqual(os.fsencode(full[0]), b'\xff.txt')
+
+class ChangedLinesTest(HgTestCase):
+    LINES = ['line %d\n' % n for n in range(1, 11)]
+
+    def setUp(self):
+        super(ChangedLinesTest, self).setUp()
+        self.root = self.make_repo('repo', {'a.txt': ''.join(self.LINES),
+                                            'sub/b.txt': ''.join(self.LINES),
+                                            'same.txt': 'same\n'})
+        self.sub = os.path.join(self.root, 'sub')
+
+    def test_ranges(self):
+        lines = list(self.LINES)
+        lines[2] = 'changed 3\n'
+        lines[7:7] = ['new a\n', 'new b\n']      # after line 7
+        del lines[10]                             # the old line 9
+        self.write(os.path.join(self.root, 'a.txt'), ''.join(lines))
+        # only losing lines leaves nothing to look at
+        self.write(os.path.join(self.sub, 'b.txt'), ''.join(self.LINES[:5]))
+        self.write(os.path.join(self.sub, 'new.txt'), 'one\ntwo\n')
+        self.hg(['add', '-q', 'sub/new.txt'], self.root)
+
+        files = [os.path.join(self.root, name) for name in ('a.txt', 'sub/b.txt', 'sub/new.txt', 'same.txt')]
+        changed = get_changed_lines(files, cwd=self.sub)
+        self.assertEqual(changed, {
+            os.path.join(self.root, 'a.txt'): [(3, 3), (8, 9)],
+            os.path.join(self.sub, 'b.txt'): [],
+            os.path.join(self.sub, 'new.txt'): [(1, 2)],
+        })
+
+    def test_hunk_lines_that_look_like_headers(self):
+        lines = list(self.LINES)
+        lines[1] = '++ not a header\n'
+        lines[4] = '@@ -1 +1 @@\n'
+        self.write(os.path.join(self.root, 'a.txt'), ''.join(lines))
+        changed = get_changed_lines([os.path.join(self.root, 'a.txt')], cwd=self.root)
+        self.assertEqual(changed, {os.path.join(self.root, 'a.txt'): [(2, 2), (5, 5)]})
+
+    def test_no_files(self):
+        self.assertEqual(get_changed_lines([], cwd=self.root), {})
+
+    def test_outside_a_working_copy(self):
+        self.assertEqual(get_changed_lines(['x.txt'], cwd=self.folder), None)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests for the profiling options (see Profiler.py).
+"""
+
+import os
+import tempfile
+import unittest
+
+from Profiler import Profiler, DEFAULT_TOP
+
+#--------------------------------------------
+
+COMMANDS = ['status', 'commit', 'log']
+
+class FromArgumentsTest(unittest.TestCase):
+    def parse(self, args):
+        argv = ['PyHg.py'] + args
+        profiler = Profiler.from_arguments(argv, COMMANDS)
+        return (profiler, argv[1:])
+
+    def test_not_asked_for(self):
+        self.assertEqual(self.parse(['status', '-a']), (None, ['status', '-a']))
+
+    def test_default_path(self):
+        profiler, argv = self.parse(['status', '--profile'])
+        self.assertEqual(argv, ['status'])
+        self.assertEqual(profiler.path, os.path.join(tempfile.gettempdir(), 'pyhg-status.prof'))
+        self.assertEqual(profiler.stacks_path, None)
+        self.assertEqual(profiler.top, DEFAULT_TOP)
+
+    def test_before_the_command(self):
+        # 'status' is a command, not the path
+        profiler, argv = self.parse(['--profile', 'status'])
+        self.assertEqual(argv, ['status'])
+        self.assertEqual(profiler.path, os.path.join(tempfile.gettempdir(), 'pyhg-status.prof'))
+
+    def test_path_forms(self):
+        for args in (['--profile=out.prof'], ['--profile', 'out.prof']):
+            profiler, argv = self.parse(['log'] + args + ['-v'])
+            self.assertEqual(argv, ['log', '-v'])
+            self.assertEqual(profiler.path, 'out.prof')
+
+    def test_option_not_taken_as_path(self):
+        profiler, argv = self.parse(['log', '--profile', '-v'])
+        self.assertEqual(argv, ['log', '-v'])
+        self.assertTrue(profiler.path.endswith('pyhg-log.prof'))
+
+    def test_stacks_and_top(self):
+        profiler, argv = self.parse(['status', '--profile=p.prof', '--profile-stacks', '--profile-top', '5'])
+        self.assertEqual(argv, ['status'])
+        self.assertEqual(profiler.stacks_path, 'p.folded')
+        self.assertEqual(profiler.top, 5)
+
+        profiler, argv = self.parse(['status', '--profile-stacks=s.txt', '--profile-top=0'])
+        self.assertEqual(profiler.stacks_path, 's.txt')
+        self.assertEqual(profiler.top, 0)
+
+class WriteStacksTest(unittest.TestCase):
+    def test_collapsed_stacks(self):
+        def inner():
+            return sum(range(20000))
+        def outer():
+            return [inner() for i in range(20)]
+
+        import cProfile
+        import pstats
+        profile = cProfile.Profile()
+        profile.enable()
+        outer()
+        profile.disable()
+
+        (handle, path) = tempfile.mkstemp(suffix='.folded')
+        os.close(handle)
+        try:
+            count = Profiler(None).write_stacks(pstats.Stats(profile).stats, path)
+            with open(path) as f:
+                lines = f.read().splitlines()
+        finally:
+            os.remove(path)
+
+        self.assertEqual(len(lines), count)
+        for line in lines:
+            stack, value = line.rsplit(' ', 1)
+            self.assertTrue(int(value) >= 0)
+        self.assertTrue(any(('(outer);' in line) and ('(inner)' in line) for line in lines))
+
+if __name__ == "__main__":
+    unittest.main()
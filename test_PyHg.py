@@ -0,0 +1,131 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests that run PyHg commands from start to finish, as a user would.
+"""
+
+import os
+import unittest
+
+from HgTesting import HgTestCase
+
+#--------------------------------------------
+
+class CommandTest(HgTestCase):
+    def setUp(self):
+        super(CommandTest, self).setUp()
+        self.root = self.make_repo('repo', {'top.txt': 'top\n', 'sub/s.txt': 's\n'})
+        self.sub = os.path.join(self.root, 'sub')
+        os.environ['PYHG_COMMENT_EDITOR'] = 'true' if os.name == 'posix' else 'rem'
+
+    def tearDown(self):
+        del os.environ['PYHG_COMMENT_EDITOR']
+        super(CommandTest, self).tearDown()
+
+    def test_status_from_a_subfolder(self):
+        self.write(os.path.join(self.sub, 's.txt'), 'more\n// @comment: a note\n', 'a')
+        self.hg(['copy', 'sub/s.txt', 'sub/c.txt'], self.root)
+        returncode, output = self.pyhg(['status'], self.sub)
+        self.assertEqual(returncode, 0, output)
+        self.assertIn('s.txt', output)
+        self.assertIn('a note', output)
+        self.assertIn('s.txt ==> c.txt', output)
+
+    def test_status_changed_lines(self):
+        self.write(os.path.join(self.sub, 's.txt'), '// @comment: committed note\n', 'a')
+        self.hg(['commit', '-q', '-m', 'A note'], self.root)
+        self.write(os.path.join(self.sub, 's.txt'), '// @comment: fresh note\n', 'a')
+
+        returncode, output = self.pyhg(['status'], self.sub)
+        self.assertIn('committed note', output)
+        returncode, output = self.pyhg(['status', '--changed-lines'], self.sub)
+        self.assertEqual(returncode, 0, output)
+        self.assertIn('fresh note', output)
+        self.assertNotIn('committed note', output)
+
+    def test_commit_from_a_subfolder(self):
+        self.write(os.path.join(self.sub, 's.txt'), 'more\n', 'a')
+        self.write(os.path.join(self.sub, 'n.txt'), 'new\n')
+        self.hg(['add', '-q', 'sub/n.txt'], self.root)
+        returncode, output = self.pyhg(['commit', '-m', 'From below the root'], self.sub, stdin='\n' * 8)
+        self.assertEqual(returncode, 0, output)
+        self.assertNotIn('non-existent', output)
+        self.assertEqual(self.hg(['log', '-r', '.', '-T', '{desc}|{files}'], self.root),
+                         'From below the root|sub/n.txt sub/s.txt')
+        self.assertEqual(self.hg(['status'], self.root), '')
+
+    def test_rebase(self):
+        self.hg(['branch', '-q', 'feature'], self.root)
+        self.write(os.path.join(self.root, 'feature.txt'), 'feature\n')
+        self.hg(['add', '-q', 'feature.txt'], self.root)
+        self.hg(['commit', '-q', '-m', 'Feature work'], self.root)
+        self.hg(['update', '-q', 'default'], self.root)
+
+        returncode, output = self.pyhg(['rebase', 'feature'], self.root)
+        self.assertEqual(returncode, 0, output)
+        self.assertNotIn('Traceback', output)
+        self.assertEqual(self.hg(['log', '-r', '.', '-T', '{desc}|{branch}'], self.root),
+                         'rebase with feature|default')
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'feature.txt')))
+
+class ProcessAllTest(HgTestCase):
+    def setUp(self):
+        super(ProcessAllTest, self).setUp()
+        self.saved_environ = dict(os.environ)
+        upstream = self.make_repo('upstream', {'README': 'upstream\n'})
+        self.workspace = self.path('workspace')
+        os.mkdir(self.workspace)
+        self.make_repo(os.path.join('workspace', 'one'), clone_of=upstream)
+        self.make_repo(os.path.join('workspace', 'two'), clone_of=upstream)
+
+        # enough modified files that a working copy's scan would be split
+        # over processes of its own
+        one = os.path.join(self.workspace, 'one')
+        for i in range(150):
+            self.write(os.path.join(one, 'f%03d.c' % i), 'int x;\n')
+        self.hg(['add', '-q'], one)
+        self.hg(['commit', '-q', '-m', 'Files'], one)
+        for i in range(150):
+            self.write(os.path.join(one, 'f%03d.c' % i), '// @comment: note %d\n' % i, 'a')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.saved_environ)
+        super(ProcessAllTest, self).tearDown()
+
+    def test_parallel_working_copies_and_scans(self):
+        os.environ['PYHG_JOBS'] = '2'
+        os.environ['PYHG_SCAN_JOBS'] = '4'
+        returncode, output = self.pyhg(['status', '--process-all'], self.workspace)
+        self.assertEqual(returncode, 0, output)
+        self.assertNotIn('could not be scanned', output)
+        self.assertIn('Scanned 2 working copies', output)
+        for i in range(150):
+            self.assertIn('note %d\n' % i, output)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests for scanning files for embedded comments with scan_files().
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import multiprocessing
+
+from PyHg_lib import scan_files, MIN_PARALLEL_SCAN
+
+#--------------------------------------------
+
+def scan_in_worker(filenames):
+    """ scan_files() run inside a (daemonic) pool worker """
+    return scan_files(filenames, jobs=4)
+
+class ScanFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.path.realpath(tempfile.mkdtemp(prefix='pyhg_test_'))
+        self.files = []
+        for i in range(MIN_PARALLEL_SCAN * 2):
+            path = os.path.join(self.folder, 'f%03d.c' % i)
+            with open(path, 'w') as f:
+                f.write('int x;\n')
+                if i % 3:
+                    f.write('// @comment: note %d\n' % i)
+            self.files.append(path)
+        with open(os.path.join(self.folder, 'blob.dat'), 'wb') as f:
+            f.write(b'\0\1\2// @comment: not text\n')
+        self.files.append(os.path.join(self.folder, 'blob.dat'))
+        self.files.append(os.path.join(self.folder, 'missing.c'))
+        self.saved_pool = multiprocessing.Pool
+
+    def tearDown(self):
+        multiprocessing.Pool = self.saved_pool
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def check(self, results):
+        self.assertEqual(len(results), len(self.files))
+        for i, (comments, error) in enumerate(results[:-2]):
+            self.assertEqual(error, None)
+            if i % 3:
+                self.assertIn('note %d' % i, ''.join(comments))
+            else:
+                self.assertEqual(comments, [])
+        self.assertEqual(results[-2], ([], None))       # not text
+        self.assertEqual(results[-1][0], None)          # missing
+        self.assertIn('does not exist', results[-1][1])
+
+    def test_serial(self):
+        self.check(scan_files(self.files, jobs=1))
+
+    def test_parallel_matches_serial(self):
+        self.assertEqual(scan_files(self.files, jobs=4), scan_files(self.files, jobs=1))
+
+    def test_pool_that_cannot_start(self):
+        def pool(*args, **kwargs):
+            raise AssertionError('no pool here')
+        multiprocessing.Pool = pool
+        self.check(scan_files(self.files, jobs=4))
+
+    def test_ranges(self):
+        path = os.path.join(self.folder, 'ranged.c')
+        with open(path, 'w') as f:
+            f.write('// @comment: old one\nint x;\n// @comment: new one\n// @comment: old two\n')
+        comments, error = scan_files([path], ranges={path: [(2, 3)]}, jobs=1)[0]
+        self.assertEqual(error, None)
+        self.assertIn('new one', ''.join(comments))
+        self.assertNotIn('old', ''.join(comments))
+
+        # a file that only lost lines has nothing to look at; others are scanned whole
+        self.assertEqual(scan_files([path], ranges={path: []}, jobs=1)[0], ([], None))
+        self.assertEqual(len(scan_files([path], ranges={}, jobs=1)[0][0]), 3)
+
+    def test_inside_a_pool_worker(self):
+        pool = multiprocessing.Pool(1)
+        try:
+            results = pool.map(scan_in_worker, [self.files])[0]
+        finally:
+            pool.close()
+            pool.join()
+        self.check(results)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,154 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests for RepoContext, the facts about a working copy that the commands
+of a process share.
+"""
+
+import os
+import time
+import unittest
+
+from HgTesting import HgTestCase
+from RepoContext import RepoContext
+from HgQuery import get_status
+from Watcher import Watcher
+
+#--------------------------------------------
+
+class RepoContextTest(HgTestCase):
+    def setUp(self):
+        super(RepoContextTest, self).setUp()
+        self.root = self.make_repo('repo', {'a.txt': 'a\n', 'sub/b.txt': 'b\n'})
+        self.sub = os.path.join(self.root, 'sub')
+        self.context = RepoContext()
+
+    def status(self, cwd):
+        return [(e.state, e.path) for e in self.context.status(['hg', 'status', '.'], cwd=cwd)]
+
+    def test_root_and_branch(self):
+        self.assertEqual(self.context.root(self.sub), self.root)
+        self.assertEqual(self.context.hg_root(self.sub), os.path.join(self.root, '.hg'))
+        self.assertEqual(self.context.branch(self.sub), 'default')
+        self.hg(['branch', '-q', 'feature'], self.root)
+        self.context.invalidate()
+        self.assertEqual(self.context.branch(self.sub), 'feature')
+
+    def test_outside_a_working_copy(self):
+        self.assertEqual(self.context.root(self.folder), None)
+
+    def test_status_remembered_until_invalidated(self):
+        self.assertEqual(self.status(self.sub), [])
+        self.write(os.path.join(self.sub, 'b.txt'), 'more\n', 'a')
+        self.assertEqual(self.status(self.sub), [])
+        self.context.invalidate()
+        self.assertEqual(self.status(self.sub), [('M', 'b.txt')])
+
+    def test_status_gathered_afresh_after_refresh(self):
+        self.assertEqual(self.status(self.root), [])
+        self.write(os.path.join(self.root, 'a.txt'), 'more\n', 'a')
+        self.context.refresh()
+        self.assertEqual(self.status(self.root), [('M', 'a.txt')])
+
+    def test_status_per_folder(self):
+        self.write(os.path.join(self.root, 'a.txt'), 'more\n', 'a')
+        self.write(os.path.join(self.sub, 'b.txt'), 'more\n', 'a')
+        self.assertEqual(self.status(self.root), [('M', 'a.txt'), ('M', 'sub/b.txt')])
+        self.assertEqual(self.status(self.sub), [('M', 'b.txt')])
+
+    def test_iter_status_remembered(self):
+        self.write(os.path.join(self.root, 'a.txt'), 'more\n', 'a')
+        streamed = [(e.state, e.path) for e in self.context.iter_status(['hg', 'status', '.'], cwd=self.root)]
+        self.write(os.path.join(self.sub, 'b.txt'), 'more\n', 'a')
+        self.assertEqual(self.status(self.root), streamed)
+
+def watcher_available(folder):
+    watcher = Watcher(folder)
+    available = watcher.start()
+    watcher.close()
+    return available
+
+class WatchedStatusTest(HgTestCase):
+    """ Status answered from a baseline plus the paths a Watcher saw change """
+    def setUp(self):
+        super(WatchedStatusTest, self).setUp()
+        if not watcher_available(self.folder):
+            self.skipTest('no file system watcher here')
+        self.root = self.make_repo('repo', {'a.txt': 'a\n', 'sub/b.txt': 'b\n', 'sub/c.txt': 'c\n'})
+        self.sub = os.path.join(self.root, 'sub')
+        self.context = RepoContext(watch=True)
+        self.command = ['hg', 'status', '-C', '.']
+
+    def tearDown(self):
+        self.context.close()
+        super(WatchedStatusTest, self).tearDown()
+
+    def status(self, cwd):
+        self.context.refresh()
+        return sorted((e.state, e.path, e.source) for e in self.context.status(self.command, cwd=cwd))
+
+    def expected(self, cwd):
+        return sorted((e.state, e.path, e.source) for e in get_status(self.command, cwd=cwd))
+
+    def settle(self):
+        # give the watcher's events time to arrive
+        time.sleep(0.2)
+
+    def test_changes_seen(self):
+        self.write(os.path.join(self.sub, 'b.txt'), 'more\n', 'a')
+        self.assertEqual(self.status(self.sub), [('M', 'b.txt', None)])
+
+        self.write(os.path.join(self.sub, 'c.txt'), 'more\n', 'a')
+        self.write(os.path.join(self.sub, 'new.txt'), 'new\n')
+        self.settle()
+        self.assertEqual(self.status(self.sub), self.expected(self.sub))
+        self.assertEqual(len(self.status(self.sub)), 3)
+
+        # back as committed
+        self.write(os.path.join(self.sub, 'b.txt'), 'b\n')
+        self.settle()
+        self.assertEqual(self.status(self.sub), self.expected(self.sub))
+        self.assertNotIn('b.txt', [path for state, path, source in self.status(self.sub)])
+
+    def test_from_the_root_and_below(self):
+        self.write(os.path.join(self.root, 'a.txt'), 'more\n', 'a')
+        self.assertEqual(self.status(self.root), self.expected(self.root))
+        self.assertEqual(self.status(self.sub), [])
+
+        self.write(os.path.join(self.sub, 'b.txt'), 'more\n', 'a')
+        self.settle()
+        self.assertEqual(self.status(self.root), self.expected(self.root))
+        self.assertEqual(self.status(self.sub), self.expected(self.sub))
+
+    def test_copies(self):
+        self.assertEqual(self.status(self.sub), [])
+        self.hg(['copy', 'sub/b.txt', 'sub/d.txt'], self.root)
+        self.settle()
+        self.assertEqual(self.status(self.sub), [('A', 'd.txt', 'b.txt')])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,174 @@
+from __future__ import print_function
+
+#------------------------------------------------------------------------------
+# MIT License
+#
+# Copyright (c) 2019 Bob Hood
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to
+# deal in the Software without restriction, including without limitation the
+# rights to use, copy, modify, merge, publish, distribute, sublicense, and/or
+# sell copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS
+# IN THE SOFTWARE.
+#------------------------------------------------------------------------------
+
+"""
+Tests for Workspace, which finds the working copies beneath a folder and
+keeps an index of them.  Working copies are mocked up as folders holding
+a .hg/hgrc, which is all that Workspace looks at.
+"""
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import Workspace as WorkspaceModule
+from Workspace import Workspace
+
+#--------------------------------------------
+
+class WorkspaceTest(unittest.TestCase):
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp(prefix='pyhg_test_'))
+        # count the folders listed, to tell a search from a use of the index
+        self.listed = []
+        self.saved_list_folders = WorkspaceModule.list_folders
+        def list_folders(path):
+            self.listed.append(os.path.relpath(path, self.root))
+            return self.saved_list_folders(path)
+        WorkspaceModule.list_folders = list_folders
+
+    def tearDown(self):
+        WorkspaceModule.list_folders = self.saved_list_folders
+        shutil.rmtree(self.root, ignore_errors=True)
+
+    def path(self, name):
+        return os.path.join(self.root, *name.split('/'))
+
+    def make_folder(self, name):
+        os.makedirs(self.path(name))
+        self.tick()
+
+    def make_working_copy(self, name, default='https://example.com/repo', hgrc=True):
+        hg = os.path.join(self.path(name), '.hg')
+        os.makedirs(hg)
+        if hgrc:
+            self.write_hgrc(name, default)
+        self.tick()
+
+    def write_hgrc(self, name, default):
+        with open(os.path.join(self.path(name), '.hg', 'hgrc'), 'w') as f:
+            f.write('[paths]\ndefault = %s\n' % default)
+        self.tick()
+
+    def tick(self):
+        # keep modification times apart, even where they are coarse
+        time.sleep(0.01)
+
+    def working_copies(self):
+        self.listed = []
+        return [(wc.path.replace(os.sep, '/'), wc.default) for wc in Workspace(self.root).working_copies()]
+
+    def paths(self):
+        return [path for path, default in self.working_copies()]
+
+    def test_found_at_any_depth(self):
+        self.make_working_copy('a')
+        self.make_working_copy('group/b')
+        self.make_working_copy('group/deeper/c')
+        self.make_folder('empty/folder')
+        self.assertEqual(self.paths(), ['a', 'group/b', 'group/deeper/c'])
+
+    def test_nothing_inside_a_working_copy(self):
+        self.make_working_copy('a')
+        self.make_working_copy('a/nested')
+        self.assertEqual(self.paths(), ['a'])
+
+    def test_needs_an_hgrc(self):
+        self.make_working_copy('a', hgrc=False)
+        self.assertEqual(self.paths(), [])
+
+    def test_pruned_folders(self):
+        self.make_working_copy('src/node_modules/x')
+        self.make_working_copy('src/.hidden/y')
+        self.make_working_copy('src/z')
+        self.assertEqual(self.paths(), ['src/z'])
+
+    def test_working_copies_named_like_pruned_folders(self):
+        for name in ('build', 'bin', 'out', 'dist', 'Debug', 'Release'):
+            self.make_working_copy(name)
+        self.assertEqual(self.paths(), sorted(['build', 'bin', 'out', 'dist', 'Debug', 'Release']))
+
+    def test_index_reused(self):
+        self.make_working_copy('a')
+        self.make_working_copy('group/b')
+        first = self.working_copies()
+        self.assertTrue(len(self.listed))
+        self.assertEqual(self.working_copies(), first)
+        self.assertEqual(self.listed, [])
+
+    def test_new_working_copy(self):
+        self.make_working_copy('group/a')
+        self.assertEqual(self.paths(), ['group/a'])
+        self.make_working_copy('group/b')
+        self.assertEqual(self.paths(), ['group/a', 'group/b'])
+        # only the folder that changed was searched again
+        self.assertEqual(self.listed, ['group'])
+
+    def test_removed_working_copy(self):
+        self.make_working_copy('a')
+        self.make_working_copy('b')
+        self.assertEqual(self.paths(), ['a', 'b'])
+        shutil.rmtree(self.path('b'))
+        self.tick()
+        self.assertEqual(self.paths(), ['a'])
+
+    def test_hgrc_read_again(self):
+        self.make_working_copy('a', default='https://example.com/one')
+        self.assertEqual(self.working_copies(), [('a', 'https://example.com/one')])
+        self.write_hgrc('a', 'https://example.com/two')
+        self.assertEqual(self.working_copies(), [('a', 'https://example.com/two')])
+
+    def test_searched_folder_becomes_a_working_copy(self):
+        self.make_folder('project/src')
+        self.assertEqual(self.paths(), [])
+        # as with 'hg init' (which writes no hgrc), then a [paths] entry
+        self.make_working_copy('project', hgrc=False)
+        self.assertEqual(self.paths(), [])
+        self.write_hgrc('project', 'https://example.com/project')
+        self.assertEqual(self.paths(), ['project'])
+
+    def test_working_copy_becomes_a_folder(self):
+        self.make_working_copy('a')
+        self.assertEqual(self.paths(), ['a'])
+        shutil.rmtree(os.path.join(self.path('a'), '.hg'))
+        self.make_working_copy('a/inner')
+        self.assertEqual(self.paths(), ['a/inner'])
+
+    def test_stale_index_version(self):
+        self.make_working_copy('a')
+        self.paths()
+        saved_version = WorkspaceModule.INDEX_VERSION
+        WorkspaceModule.INDEX_VERSION = saved_version + 1
+        try:
+            self.assertEqual(self.paths(), ['a'])
+            self.assertTrue(len(self.listed))
+        finally:
+            WorkspaceModule.INDEX_VERSION = saved_version
+
+if __name__ == "__main__":
+    unittest.main()